@@ -0,0 +1,53 @@
+import json
+
+import pytest
+from google.oauth2.credentials import Credentials
+
+from i3_agenda import api, cache_utils
+from i3_agenda.config import get_parser
+
+from fake_calendar import FakeCalendar
+
+
+@pytest.fixture
+def conf_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache_utils, "CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(cache_utils, "LOCK_PATH", str(tmp_path / "cache.lock"))
+    monkeypatch.setattr(
+        cache_utils, "CALENDAR_LIST_PATH", str(tmp_path / "calendars.json")
+    )
+    monkeypatch.setattr(cache_utils, "SYNC_PATH", str(tmp_path / "sync.json"))
+    monkeypatch.setattr(
+        api, "DISCOVERY_PATH", str(tmp_path / "discovery.json")
+    )
+    monkeypatch.setattr(api, "_sessions", {})
+    return tmp_path
+
+
+@pytest.fixture
+def fake_calendar(conf_dir, monkeypatch):
+    # Starts a fake API server and points the client library at it
+    servers = []
+
+    def start(**options) -> FakeCalendar:
+        fake = FakeCalendar(**options).start()
+        servers.append(fake)
+
+        document = api.load_discovery_document()
+        document = json.loads(json.dumps(document))
+        document["rootUrl"] = fake.url
+        document["baseUrl"] = fake.url + document["servicePath"]
+        monkeypatch.setattr(api, "load_discovery_document", lambda: document)
+        monkeypatch.setattr(
+            api, "get_credentials", lambda _: Credentials(token="offline")
+        )
+        return fake
+
+    yield start
+    for fake in servers:
+        fake.stop()
+
+
+@pytest.fixture
+def parse_args():
+    return get_parser().parse_args
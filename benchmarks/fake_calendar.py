@@ -0,0 +1,181 @@
+# A local stand-in for the parts of the Calendar API that i3_agenda.api
+# talks to: calendarList.list and events.list, with pagination, on their own
+# or in batch requests. Latency,
+# payload size and the number of calendars and events are configurable so
+# that refresh costs can be measured without Google.
+import datetime as dt
+import json
+import threading
+import uuid
+from email.parser import BytesParser
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs, unquote, urlparse
+
+CALENDAR_LIST_PATH = "/calendar/v3/users/me/calendarList"
+EVENTS_PATH = "/calendar/v3/calendars/"
+BATCH_PATH = "/batch/calendar/v3"
+
+
+def rfc3339(timestamp: float) -> str:
+    return dt.datetime.fromtimestamp(timestamp, dt.timezone.utc).strftime(
+        "%Y-%m-%dT%H:%M:%SZ"
+    )
+
+
+def parse_rfc3339(value: str) -> float:
+    return dt.datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+def make_event(calendar: int, i: int, start: float, description_size: int):
+    return {
+        "id": f"c{calendar}e{i}",
+        "status": "confirmed",
+        "summary": f"Event {i} of calendar {calendar}",
+        "description": "x" * description_size,
+        "start": {"dateTime": rfc3339(start)},
+        "end": {"dateTime": rfc3339(start + 1800)},
+        "_start": start,
+        "_end": start + 1800,
+    }
+
+
+class FakeCalendar:
+    def __init__(
+        self,
+        calendars: int = 5,
+        events_per_calendar: int = 50,
+        latency: float = 0.0,
+        description_size: int = 200,
+        calendar_page_size: int = 100,
+        event_spacing: float = 3600,
+    ):
+        self.latency = latency
+        self.calendar_page_size = calendar_page_size
+        self.requests = 0
+        self.bytes_sent = 0
+        now = time.time()
+        self.events: Dict[str, List[Dict[str, Any]]] = {
+            f"calendar{c}@example.com": [
+                make_event(
+                    c, i, now + (i + 1) * event_spacing, description_size
+                )
+                for i in range(events_per_calendar)
+            ]
+            for c in range(calendars)
+        }
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self) -> "FakeCalendar":
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                status, body = fake.answer(self.path)
+                self.reply(status, "application/json", json.dumps(body))
+
+            def do_POST(self):
+                if self.path != BATCH_PATH:
+                    self.reply(404, "application/json", "{}")
+                    return
+                length = int(self.headers["Content-Length"])
+                content_type, body = fake.batch(
+                    self.headers["Content-Type"], self.rfile.read(length)
+                )
+                self.reply(200, content_type, body)
+
+            def reply(self, status: int, content_type: str, body: str):
+                fake.requests += 1
+                if fake.latency:
+                    time.sleep(fake.latency)
+                payload = body.encode()
+                fake.bytes_sent += len(payload)
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(
+            target=self._server.serve_forever, daemon=True
+        ).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def answer(self, path: str):
+        url = urlparse(path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.path == CALENDAR_LIST_PATH:
+            return 200, self.calendar_list(query)
+        if url.path.startswith(EVENTS_PATH) and url.path.endswith("/events"):
+            calendar_id = unquote(url.path[len(EVENTS_PATH) : -len("/events")])
+            if calendar_id not in self.events:
+                return 404, {"error": {"code": 404, "message": "Not Found"}}
+            return 200, self.event_list(calendar_id, query)
+        return 404, {"error": {"code": 404, "message": "Not Found"}}
+
+    def batch(self, content_type: str, body: bytes):
+        # Every part is a whole HTTP request, answered by a part with the
+        # same Content-ID
+        message = BytesParser().parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body
+        )
+        boundary = uuid.uuid4().hex
+        parts = []
+        for part in message.get_payload():
+            request_line = part.get_payload().lstrip().split("\r\n", 1)[0]
+            path = request_line.split(" ")[1]
+            status, answer = self.answer(path)
+            content_id = part["Content-ID"].replace("<", "<response-", 1)
+            parts.append(
+                f"--{boundary}\r\n"
+                "Content-Type: application/http\r\n"
+                f"Content-ID: {content_id}\r\n\r\n"
+                f"HTTP/1.1 {status} OK\r\n"
+                "Content-Type: application/json\r\n\r\n"
+                f"{json.dumps(answer)}\r\n"
+            )
+        parts.append(f"--{boundary}--\r\n")
+        return f"multipart/mixed; boundary={boundary}", "".join(parts)
+
+    def page(self, items: List[Any], query: Dict[str, str], size: int):
+        start = int(query.get("pageToken", 0))
+        size = int(query.get("maxResults", size))
+        page = {"items": items[start : start + size]}
+        if start + size < len(items):
+            page["nextPageToken"] = str(start + size)
+        else:
+            page["nextSyncToken"] = "sync"
+        return page
+
+    def calendar_list(self, query: Dict[str, str]):
+        items = [{"id": calendar_id} for calendar_id in self.events]
+        return self.page(items, query, self.calendar_page_size)
+
+    def event_list(self, calendar_id: str, query: Dict[str, str]):
+        time_min = parse_rfc3339(query["timeMin"]) if "timeMin" in query else 0
+        time_max = (
+            parse_rfc3339(query["timeMax"])
+            if "timeMax" in query
+            else float("inf")
+        )
+        items = [
+            {k: v for k, v in event.items() if not k.startswith("_")}
+            for event in self.events[calendar_id]
+            if event["_end"] > time_min and event["_start"] < time_max
+        ]
+        return self.page(items, query, 250)
@@ -0,0 +1,72 @@
+# Memory and cache decode time of the slotted Event against the plain
+# dataclass it replaced
+import json
+import tracemalloc
+from dataclasses import dataclass
+from typing import Union
+
+import pytest
+
+from i3_agenda.cache_utils import get_events_from_cache
+from i3_agenda.event import Event, EventEncoder
+
+EVENTS = 10000
+
+
+@dataclass
+class DictEvent:
+    summary: str
+    start_time: int
+    end_time: int
+    location: Union[str, None]
+
+
+class DictEventEncoder(json.JSONEncoder):
+    def default(self, o):
+        return o.__dict__
+
+
+def dict_events_from_cache(raw):
+    return [
+        DictEvent(
+            event["summary"],
+            event["start_time"],
+            event["end_time"],
+            event["location"],
+        )
+        for event in raw
+    ]
+
+
+def make(cls):
+    return [
+        cls(f"Event {i}", 1670252400 + i * 3600, 1670256000 + i * 3600, None)
+        for i in range(EVENTS)
+    ]
+
+
+def memory(cls) -> int:
+    tracemalloc.start()
+    events = make(cls)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del events
+    return size
+
+
+@pytest.mark.parametrize(
+    "cls,encoder,decode",
+    [
+        (DictEvent, DictEventEncoder, dict_events_from_cache),
+        (Event, EventEncoder, get_events_from_cache),
+    ],
+    ids=["dataclass", "slotted"],
+)
+def test_cache_decode(benchmark, cls, encoder, decode):
+    encoded = encoder().encode(make(cls))
+
+    events = benchmark(lambda: decode(json.loads(encoded)))
+
+    assert len(events) == EVENTS
+    benchmark.extra_info["bytes_per_event"] = memory(cls) // EVENTS
+    benchmark.extra_info["cache_bytes"] = len(encoded)
@@ -0,0 +1,39 @@
+import time
+
+import pytest
+
+from fake_calendar import make_event
+from i3_agenda.const import MIN_DELAY
+from i3_agenda.event import Event, from_json, get_future_events
+from i3_agenda.event_index import EventIndex
+
+SIZES = [10, 1000, 100000]
+
+
+def upcoming_events(count):
+    now = int(time.time())
+    return [
+        Event(f"Event {i}", now + i * 600, now + i * 600 + 1800, None)
+        for i in range(-count // 10, count - count // 10)
+    ]
+
+
+def test_from_json_throughput(benchmark):
+    now = time.time()
+    items = [make_event(0, i, now + i * 3600, 200) for i in range(1000)]
+    events = benchmark(lambda: [from_json(item) for item in items])
+    assert len(events) == len(items)
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_get_future_events(benchmark, size):
+    events = upcoming_events(size)
+    future = benchmark(get_future_events, events, MIN_DELAY, MIN_DELAY)
+    assert future
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_event_index_closest(benchmark, size):
+    index = EventIndex(upcoming_events(size))
+    closest = benchmark(index.closest, MIN_DELAY, MIN_DELAY)
+    assert closest is not None
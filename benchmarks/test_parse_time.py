@@ -0,0 +1,35 @@
+# get_unix_time against the strptime based parser it replaced
+import datetime as dt
+import time
+
+import pytest
+
+from i3_agenda.helpers import get_unix_time
+
+SAMPLES = [
+    "2022-12-05T15:00:00+01:00",
+    "2022-12-05T15:00:00Z",
+    "2022-12-05",
+]
+
+
+def strptime_unix_time(full_time: str) -> float:
+    if "T" in full_time:
+        event_time_format = "%Y-%m-%dT%H:%M:%S%z"
+    else:
+        event_time_format = "%Y-%m-%d"
+    if full_time[-3] == ":":
+        full_time = full_time[:-3] + full_time[-2:]
+    return time.mktime(
+        dt.datetime.strptime(full_time, event_time_format)
+        .astimezone()
+        .timetuple()
+    )
+
+
+@pytest.mark.parametrize("sample", SAMPLES)
+@pytest.mark.parametrize(
+    "parse", [strptime_unix_time, get_unix_time], ids=["strptime", "fast"]
+)
+def test_parse_time(benchmark, parse, sample):
+    assert benchmark(parse, sample) == strptime_unix_time(sample)
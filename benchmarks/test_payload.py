@@ -0,0 +1,103 @@
+# Size and decode time of an events page, with and without the fields mask
+# sent by i3_agenda.api
+import gzip
+import json
+import random
+
+import pytest
+
+from i3_agenda.event import from_json
+
+EVENTS_PER_PAGE = 250
+ATTENDEES = 25
+
+
+def full_event(i: int, rng: random.Random) -> dict:
+    # Roughly what a meeting on a corporate calendar looks like
+    start = f"2030-01-{i % 28 + 1:02d}T{i % 10 + 8:02d}:00:00+01:00"
+    end = f"2030-01-{i % 28 + 1:02d}T{i % 10 + 9:02d}:00:00+01:00"
+    attendees = [
+        {
+            "email": f"person{rng.randrange(10000)}@example.com",
+            "displayName": f"Person {rng.randrange(10000)}",
+            "responseStatus": rng.choice(["accepted", "needsAction"]),
+            "optional": rng.random() < 0.2,
+        }
+        for _ in range(ATTENDEES)
+    ]
+    return {
+        "kind": "calendar#event",
+        "etag": f'"{rng.getrandbits(64)}"',
+        "id": f"event{i}",
+        "status": "confirmed",
+        "htmlLink": f"https://www.google.com/calendar/event?eid=event{i}",
+        "created": "2029-12-01T10:00:00.000Z",
+        "updated": "2029-12-02T10:00:00.000Z",
+        "summary": f"Weekly sync {i}",
+        "description": "<p>Agenda</p><ul>"
+        + "".join(f"<li>Item {n}</li>" for n in range(30))
+        + "</ul><p>Join: https://meet.example.com/abc-defg-hij</p>",
+        "creator": {"email": "organizer@example.com"},
+        "organizer": {"email": "organizer@example.com"},
+        "start": {"dateTime": start, "timeZone": "Europe/Paris"},
+        "end": {"dateTime": end, "timeZone": "Europe/Paris"},
+        "iCalUID": f"event{i}@google.com",
+        "sequence": 0,
+        "attendees": attendees,
+        "hangoutLink": "https://meet.example.com/abc-defg-hij",
+        "conferenceData": {
+            "entryPoints": [
+                {
+                    "entryPointType": "video",
+                    "uri": "https://meet.example.com/abc-defg-hij",
+                    "label": "meet.example.com/abc-defg-hij",
+                },
+                {
+                    "entryPointType": "phone",
+                    "uri": "tel:+1-555-0100",
+                    "label": "+1 555-0100",
+                    "pin": "123456789",
+                },
+            ],
+            "conferenceSolution": {
+                "key": {"type": "hangoutsMeet"},
+                "name": "Google Meet",
+            },
+            "conferenceId": "abc-defg-hij",
+        },
+        "reminders": {"useDefault": True},
+        "eventType": "default",
+    }
+
+
+def masked_event(event: dict) -> dict:
+    # What comes back for api.EVENT_FIELDS
+    masked = {
+        key: event[key]
+        for key in ("summary", "location", "description")
+        if key in event
+    }
+    for key in ("start", "end"):
+        masked[key] = {
+            field: event[key][field]
+            for field in ("date", "dateTime")
+            if field in event[key]
+        }
+    return masked
+
+
+@pytest.mark.parametrize("masked", [False, True], ids=["full", "masked"])
+def test_page_decode(benchmark, masked):
+    rng = random.Random(0)
+    events = [full_event(i, rng) for i in range(EVENTS_PER_PAGE)]
+    if masked:
+        events = [masked_event(event) for event in events]
+    body = json.dumps({"items": events}).encode()
+
+    decoded = benchmark(
+        lambda: [from_json(item) for item in json.loads(body)["items"]]
+    )
+
+    assert len(decoded) == EVENTS_PER_PAGE
+    benchmark.extra_info["page_bytes"] = len(body)
+    benchmark.extra_info["page_gzip_bytes"] = len(gzip.compress(body))
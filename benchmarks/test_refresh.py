@@ -0,0 +1,93 @@
+import shutil
+import time
+
+import pytest
+
+from i3_agenda import api, main
+
+
+def clear_caches(conf_dir):
+    def setup():
+        api._sessions.clear()
+        shutil.rmtree(conf_dir / "cache", ignore_errors=True)
+        calendars = conf_dir / "calendars.json"
+        if calendars.exists():
+            calendars.unlink()
+
+    return setup
+
+
+@pytest.mark.parametrize(
+    "calendars,latency,batch_size",
+    [(5, 0.0, 0), (20, 0.02, 0), (50, 0.02, 0), (50, 0.02, 50)],
+)
+def test_cold_refresh(
+    benchmark,
+    conf_dir,
+    fake_calendar,
+    parse_args,
+    calendars,
+    latency,
+    batch_size,
+):
+    # Session setup, calendar list and every calendar's events, then the cache
+    fake = fake_calendar(calendars=calendars, latency=latency)
+    args = parse_args(["--batch-size", str(batch_size)])
+
+    events = benchmark.pedantic(
+        main.load_events,
+        args=(args,),
+        setup=clear_caches(conf_dir),
+        rounds=5,
+    )
+
+    assert len(events) == calendars * args.maxres
+    benchmark.extra_info["requests_per_refresh"] = fake.requests // 5
+    benchmark.extra_info["bytes_per_refresh"] = fake.bytes_sent // 5
+
+
+@pytest.mark.parametrize("events_per_calendar", [10, 250])
+def test_lookahead_refresh(
+    benchmark, conf_dir, fake_calendar, parse_args, events_per_calendar
+):
+    fake_calendar(calendars=5, events_per_calendar=events_per_calendar)
+    args = parse_args(["--lookahead", "6"])
+
+    events = benchmark.pedantic(
+        main.load_events,
+        args=(args,),
+        setup=clear_caches(conf_dir),
+        rounds=5,
+    )
+    assert events
+
+
+@pytest.mark.parametrize("cache_format", ["json", "binary"])
+def test_warm_cache_render(
+    benchmark, conf_dir, fake_calendar, parse_args, cache_format
+):
+    # What a bar pays on every tick: reading the cache and rendering
+    fake = fake_calendar(calendars=20, events_per_calendar=250)
+    args = parse_args(["--cache-format", cache_format, "--maxres", "250"])
+    main.load_events(args)
+    requests = fake.requests
+
+    text, closest = benchmark(
+        lambda: main.render(args, main.load_events(args))
+    )
+
+    assert closest is not None
+    assert fake.requests == requests
+
+
+def test_timeline_render(benchmark, conf_dir, fake_calendar, parse_args):
+    # A bar tick once the refresh has precomputed what to show
+    fake_calendar(calendars=20, events_per_calendar=250)
+    args = parse_args(["--maxres", "250"])
+    main.load_events(args)
+    fetched_at = main.fresh_entry(args)
+
+    shown = benchmark(
+        lambda: main.show_from_timeline(args, fetched_at, time.time())
+    )
+    assert shown
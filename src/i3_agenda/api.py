@@ -1,26 +1,181 @@
 from pathlib import Path
 
-from typing import List
+from typing import Any, Callable, ContextManager, Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
 import datetime
+import json
 import pickle
+import sys
+import threading
+import time
+import weakref
 
+import httplib2
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build, Resource
+from googleapiclient.discovery import build, build_from_document, Resource
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.errors import HttpError
+from googleapiclient.version import __version__ as client_version
 
 from textwrap import dedent
-from i3_agenda.event import Event, from_json
+from i3_agenda import timings
+from i3_agenda.event import Event, from_json, get_future_events
+from i3_agenda.query import Query
+from i3_agenda.recurrence import expand, is_over
 from i3_agenda.config import CONF_DIR
+from i3_agenda.const import (
+    DEFAULT_CALENDAR_LIST_TTL,
+    DEFAULT_CONCURRENCY,
+    DEFAULT_FETCH_TIMEOUT,
+    LOOKAHEAD_GROWTH,
+    MAX_BATCH_SIZE,
+    MAX_LOOKAHEAD_HOURS,
+    MIN_DELAY,
+    SECONDS_PER_DAY,
+    SECONDS_PER_HOUR,
+    SYNC_HORIZON_DAYS,
+    WINDOW_PAGE_SIZE,
+)
 
 SCOPES = ["https://www.googleapis.com/auth/calendar.readonly"]
 TMP_TOKEN = f"{CONF_DIR}/i3agenda_google_token.pickle"
+DISCOVERY_PATH = f"{CONF_DIR}/i3agenda_discovery.json"
+# The only parts of the Calendar API this uses
+USED_METHODS = {"events": ["list"], "calendarList": ["list"]}
+# Bumped when trim_discovery_document changes, to replace the cached one
+DISCOVERY_FORMAT = 1
 
+# Partial responses with only what from_json reads, attendees and conference
+# data can make up most of an event otherwise. Responses are gzipped by the
+# client library already.
+EVENT_FIELDS = (
+    "summary,start(date,dateTime),end(date,dateTime),location,description"
+)
+LIST_FIELDS = f"nextPageToken,items({EVENT_FIELDS})"
+# Recurring events and the instances that replace their occurrences, in
+# their time zones, to be expanded locally
+RECURRING_EVENT_FIELDS = (
+    "id,status,recurrence,recurringEventId,"
+    "originalStartTime(date,dateTime,timeZone),summary,"
+    "start(date,dateTime,timeZone),end(date,dateTime,timeZone),location,"
+    "description"
+)
+RECURRING_FIELDS = f"nextPageToken,items({RECURRING_EVENT_FIELDS})"
+SYNC_FIELDS = (
+    f"nextPageToken,nextSyncToken,items({RECURRING_EVENT_FIELDS})"
+)
+CALENDAR_LIST_FIELDS = "nextPageToken,nextSyncToken,items(id,deleted)"
 
-def connect(credspath: str) -> Resource:
-    creds = get_credentials(credspath)
+# Credentials and service of every (credentials path, timeout), so that long
+# running modes don't set them up again on every refresh
+_sessions: Dict[Tuple[str, Optional[float]], Tuple[Any, Resource]] = {}
+_http_pools: "weakref.WeakKeyDictionary[Any, Dict]" = (
+    weakref.WeakKeyDictionary()
+)
 
-    service = build("calendar", "v3", credentials=creds)
-    return service
+
+def trim_discovery_document(document: Dict[str, Any]) -> Dict[str, Any]:
+    # Schemas and descriptions are only used to generate docstrings, but make
+    # up most of the time spent building the service. Methods without a
+    # response type return the raw body, so theirs becomes a plain object.
+    resources = {}
+    for name, methods in USED_METHODS.items():
+        resources[name] = {"methods": {}}
+        for method in methods:
+            description = document["resources"][name]["methods"][method]
+            resources[name]["methods"][method] = {
+                key: value
+                for key, value in description.items()
+                if key != "description"
+            }
+            resources[name]["methods"][method]["response"] = {
+                "type": "object"
+            }
+
+    trimmed = {
+        key: value
+        for key, value in document.items()
+        if key not in ("description", "icons", "resources", "schemas")
+    }
+    trimmed["resources"] = resources
+    trimmed["schemas"] = {}
+    return trimmed
+
+
+def load_discovery_document() -> Optional[Dict[str, Any]]:
+    # Stored with the version of the client library that shipped it, a new
+    # version may come with a newer API description
+    try:
+        with open(DISCOVERY_PATH, "r") as f:
+            cached = json.loads(f.read())
+        if (
+            cached["version"] == client_version
+            and cached.get("format") == DISCOVERY_FORMAT
+        ):
+            return cached["document"]
+    except (IOError, ValueError, KeyError, TypeError):
+        pass
+
+    document = get_static_doc("calendar", "v3")
+    if document is None:
+        return None
+    document = trim_discovery_document(json.loads(document))
+
+    from i3_agenda.cache_utils import atomic_write
+
+    try:
+        with atomic_write(DISCOVERY_PATH) as f:
+            f.write(
+                json.dumps(
+                    {
+                        "version": client_version,
+                        "format": DISCOVERY_FORMAT,
+                        "document": document,
+                    }
+                )
+            )
+    except OSError:
+        pass
+    return document
+
+
+def connect(creds, timeout: Optional[float] = None) -> Resource:
+    http = authorized_http(creds, timeout)
+    document = load_discovery_document()
+    if document is None:
+        return build("calendar", "v3", http=http)
+    return build_from_document(document, http=http)
+
+
+def open_session(
+    credentials: str, timeout: Optional[float] = None
+) -> Tuple[Any, Resource]:
+    key = (credentials, timeout)
+    if key not in _sessions:
+        with timings.phase("credentials"):
+            creds = get_credentials(credentials)
+        with timings.phase("build service"):
+            service = connect(creds, timeout)
+        _sessions[key] = (creds, service)
+    return _sessions[key]
+
+
+class CountingHttp(httplib2.Http):
+    # Reports the size of every response to timings
+    def request(self, *args, **kwargs):
+        response, content = super().request(*args, **kwargs)
+        timings.count_bytes(len(content))
+        return response, content
+
+
+def authorized_http(creds, timeout: Optional[float] = None) -> AuthorizedHttp:
+    # httplib2 is not thread safe, every thread that talks to the API needs its
+    # own instance. The timeout applies to each socket operation of a request.
+    http = CountingHttp if timings.recording() else httplib2.Http
+    return AuthorizedHttp(creds, http=http(timeout=timeout))
 
 
 def get_credentials(credspath):
@@ -56,83 +211,724 @@ def get_credentials(credspath):
     return creds
 
 
-def get_callendar_ids(
-    allowed_calendars_ids: List[str], service: Resource
-) -> List:
-    calendar_ids = []
+def list_calendar_changes(
+    service, sync_token: Optional[str]
+) -> Tuple[Optional[str], List[Dict[str, Any]]]:
+    # Like list_event_changes, for the subscribed calendars
+    items = []
+    page_token = None
     while True:
-        calendar_list = service.calendarList().list().execute()
-        for calendar_list_entry in calendar_list["items"]:
-            if (
-                not allowed_calendars_ids
-                or calendar_list_entry["id"] in allowed_calendars_ids
-            ):
-                calendar_ids.append(calendar_list_entry["id"])
+        calendar_list = (
+            service.calendarList()
+            .list(
+                pageToken=page_token,
+                syncToken=sync_token,
+                fields=CALENDAR_LIST_FIELDS,
+            )
+            .execute()
+        )
+        items.extend(calendar_list.get("items", []))
         page_token = calendar_list.get("nextPageToken")
         if not page_token:
-            break
-    return calendar_ids
+            return calendar_list.get("nextSyncToken"), items
 
 
-def get_result(service, calendar_id, max_results, time_max_rfc3339=None):
-    now = datetime.datetime.utcnow()
-    now_rfc3339 = now.isoformat() + "Z"  # 'Z' indicates UTC time
-    return (
-        service.events()
-        .list(
+def sync_calendar_list(
+    service, state: Optional[Dict[str, Any]]
+) -> Dict[str, Any]:
+    token = state.get("sync_token") if state else None
+    calendar_ids = list(state["calendars"]) if token else []
+
+    try:
+        token, items = list_calendar_changes(service, token)
+    except HttpError as e:
+        if not token or e.resp.status != 410:
+            raise
+        calendar_ids = []
+        token, items = list_calendar_changes(service, None)
+
+    for item in items:
+        if item.get("deleted"):
+            if item["id"] in calendar_ids:
+                calendar_ids.remove(item["id"])
+        elif item["id"] not in calendar_ids:
+            calendar_ids.append(item["id"])
+    return {"sync_token": token, "calendars": calendar_ids}
+
+
+def get_callendar_ids(
+    allowed_calendars_ids: List[str],
+    service: Resource,
+    calendar_list_ttl: Optional[int] = DEFAULT_CALENDAR_LIST_TTL,
+) -> List:
+    # Explicitly requested calendars can be queried without looking at the
+    # calendar list at all
+    if allowed_calendars_ids:
+        return list(allowed_calendars_ids)
+
+    from i3_agenda.cache_utils import (
+        load_calendar_list,
+        load_calendar_list_state,
+        save_calendar_list,
+    )
+
+    calendar_ids = load_calendar_list(calendar_list_ttl)
+    if calendar_ids is not None:
+        return calendar_ids
+
+    # Only the changes since the previous listing are downloaded
+    state = sync_calendar_list(service, load_calendar_list_state(None))
+    save_calendar_list(state)
+    return state["calendars"]
+
+
+def discover_calendars(
+    credentials: str,
+    calendar_list_ttl: Optional[int] = DEFAULT_CALENDAR_LIST_TTL,
+    timeout=DEFAULT_FETCH_TIMEOUT,
+) -> List[str]:
+    _, service = open_session(credentials, timeout)
+    return get_callendar_ids([], service, calendar_list_ttl)
+
+
+def list_events_request(
+    service,
+    calendar_id,
+    max_results,
+    time_max_rfc3339=None,
+    time_min_rfc3339=None,
+    expand_recurring=False,
+    page_token=None,
+):
+    if time_min_rfc3339 is None:
+        now = datetime.datetime.utcnow()
+        time_min_rfc3339 = now.isoformat() + "Z"  # 'Z' indicates UTC time
+    if expand_recurring:
+        # Only occurrences can be ordered by start time
+        return service.events().list(
             calendarId=calendar_id,
-            timeMin=now_rfc3339,
+            timeMin=time_min_rfc3339,
             timeMax=time_max_rfc3339,
             maxResults=max_results,
-            singleEvents=True,
-            orderBy="startTime",
+            singleEvents=False,
+            pageToken=page_token,
+            fields=RECURRING_FIELDS,
         )
-        .execute()
+    return service.events().list(
+        calendarId=calendar_id,
+        timeMin=time_min_rfc3339,
+        timeMax=time_max_rfc3339,
+        maxResults=max_results,
+        singleEvents=True,
+        orderBy="startTime",
+        pageToken=page_token,
+        fields=LIST_FIELDS,
     )
 
 
-def get_today_events(service, calendar_id, max_results):
+def end_of_today_rfc3339() -> str:
     now = datetime.datetime.utcnow()
-    midnight_rfc3339 = (
-        now.replace(hour=23, minute=59, second=59).isoformat() + "Z"
-    )
-    return get_result(service, calendar_id, max_results, midnight_rfc3339).get(
-        "items", []
-    )
+    return now.replace(hour=23, minute=59, second=59).isoformat() + "Z"
 
 
-def get_event_result(service, calendar_id, max_results):
-    return get_result(service, calendar_id, max_results).get("items", [])
+def to_rfc3339(timestamp: float) -> str:
+    return datetime.datetime.utcfromtimestamp(timestamp).isoformat() + "Z"
 
 
-def get_all_events(calendar_ids, service, max_results, today_only):
-    all_events = []
+def query_bounds(
+    today_only: bool, time_window: Optional[Tuple[float, float]]
+) -> Tuple[Optional[str], Optional[str]]:
+    # timeMin and timeMax of an events query, timeMin defaults to now
+    if time_window is not None:
+        return to_rfc3339(time_window[0]), to_rfc3339(time_window[1])
+    return None, end_of_today_rfc3339() if today_only else None
 
-    for calendar_id in calendar_ids:
-        if today_only:
-            events = get_today_events(service, calendar_id, max_results)
-        else:
-            events = get_event_result(service, calendar_id, max_results)
 
-        if not events:
-            continue
+def get_result(
+    service,
+    calendar_id,
+    max_results,
+    time_max_rfc3339=None,
+    http=None,
+    time_min_rfc3339=None,
+    expand_recurring=False,
+    page_token=None,
+):
+    return list_events_request(
+        service,
+        calendar_id,
+        max_results,
+        time_max_rfc3339,
+        time_min_rfc3339,
+        expand_recurring,
+        page_token,
+    ).execute(http=http)
 
-        for event in events:
-            all_events.append(from_json(event))
 
-    return all_events
+def following_pages(
+    page_token: Optional[str], get_page: Callable[[str], Dict[str, Any]]
+) -> List[Dict[str, Any]]:
+    # The items of the pages after the one that came with page_token
+    items = []
+    while page_token:
+        result = get_page(page_token)
+        items.extend(result.get("items", []))
+        page_token = result.get("nextPageToken")
+    return items
 
 
-def get_events(
-    credentials: str,
-    allowed_calendars_ids: List[str],
-    max_results: int,
-    today_only=False,
+def add_following_pages(
+    items: Dict[str, List[Dict[str, Any]]],
+    page_tokens: Dict[str, str],
+    get_page: Callable[[str, str], Dict[str, Any]],
+):
+    # Calendars whose following pages fail are dropped, they would have gaps
+    for calendar_id, page_token in page_tokens.items():
+        try:
+            items[calendar_id] += following_pages(
+                page_token, lambda token: get_page(calendar_id, token)
+            )
+        except Exception as e:
+            del items[calendar_id]
+            print(
+                f"Failed to fetch calendar {calendar_id}: {e}",
+                file=sys.stderr,
+            )
+
+
+def fetch_calendars(
+    calendar_ids: List[str],
+    fetch: Callable[[str], Any],
+    concurrency: int = DEFAULT_CONCURRENCY,
+) -> Dict[str, Any]:
+    # Runs fetch for every calendar in a bounded thread pool. A calendar that
+    # fails (or times out) is reported and left out of the results, so the
+    # others can still be shown.
+    results = {}
+    if not calendar_ids:
+        return results
+
+    fetch = timings.timed(fetch)
+    workers = max(1, min(concurrency, len(calendar_ids)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(fetch, calendar_id): calendar_id
+            for calendar_id in calendar_ids
+        }
+        for future in as_completed(futures):
+            calendar_id = futures[future]
+            try:
+                results[calendar_id] = future.result()
+            except Exception as e:
+                print(
+                    f"Failed to fetch calendar {calendar_id}: {e}",
+                    file=sys.stderr,
+                )
+    return results
+
+
+def shared_http(
+    creds, timeout
+) -> Callable[[], ContextManager[Optional[AuthorizedHttp]]]:
+    # httplib2 connections are kept open for the next request, lend them to
+    # one thread at a time and keep them around for the next refresh
+    if creds is None:
+        return nullcontext
+
+    pools = _http_pools.setdefault(creds, {})
+    lock, idle = pools.setdefault(timeout, (threading.Lock(), []))
+
+    @contextmanager
+    def borrow_http():
+        with lock:
+            http = idle.pop() if idle else None
+        if http is None:
+            http = authorized_http(creds, timeout)
+        try:
+            yield http
+        finally:
+            with lock:
+                idle.append(http)
+
+    return borrow_http
+
+
+def parse_events(
+    items: List[Dict[str, Any]],
+    time_window: Optional[Tuple[float, float]] = None,
+    expand_recurring=False,
 ) -> List[Event]:
-    service = connect(credentials)
+    if expand_recurring:
+        items = expand(items, *time_window)
+    return [from_json(item) for item in items]
+
+
+def nearest(
+    results: Dict[str, Optional[List[Event]]], max_results: int
+) -> Dict[str, Optional[List[Event]]]:
+    # The first max_results events of every calendar, like the API returns
+    # them when ordering occurrences by start time
+    return {
+        calendar_id: (
+            sorted(events, key=lambda e: e.start_time)[:max_results]
+            if events is not None
+            else None
+        )
+        for calendar_id, events in results.items()
+    }
 
-    calendar_ids = get_callendar_ids(allowed_calendars_ids, service)
 
-    all_events = get_all_events(calendar_ids, service, max_results, today_only)
+def recurrence_window(today_only: bool, days: int) -> Tuple[float, float]:
+    # Where recurring events are expanded without a --lookahead window
+    now = time.time()
+    end = now + days * SECONDS_PER_DAY
+    if today_only:
+        tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+        end = min(end, time.mktime(tomorrow.timetuple()))
+    return now, end
 
+
+def flatten(results: Dict[str, Optional[List[Event]]]) -> List[Event]:
+    all_events = []
+    for events in results.values():
+        if events:
+            all_events.extend(events)
     return all_events
+
+
+def get_all_calendar_events(
+    calendar_ids,
+    service,
+    max_results,
+    today_only,
+    creds=None,
+    concurrency=DEFAULT_CONCURRENCY,
+    timeout=DEFAULT_FETCH_TIMEOUT,
+    time_window=None,
+    expand_recurring=False,
+) -> Dict[str, Optional[List[Event]]]:
+    # The events of every calendar, None for the ones that failed. Only the
+    # first max_results, or every event of time_window when there is one.
+    # Recurring events are expanded in time_window when expand_recurring is
+    # set.
+    borrow_http = shared_http(creds, timeout)
+    time_min, time_max = query_bounds(today_only, time_window)
+
+    def fetch(calendar_id):
+        with borrow_http() as http:
+
+            def page(page_token=None):
+                return get_result(
+                    service,
+                    calendar_id,
+                    max_results,
+                    time_max,
+                    http,
+                    time_min,
+                    expand_recurring,
+                    page_token,
+                )
+
+            result = page()
+            items = result.get("items", [])
+            if time_window is not None:
+                items += following_pages(result.get("nextPageToken"), page)
+            return items
+
+    if creds is None:
+        # Without credentials there is no way to give every worker its own
+        # connection, so fall back to querying the calendars one by one
+        concurrency = 1
+
+    results = fetch_calendars(calendar_ids, fetch, concurrency)
+
+    with timings.phase("parse"):
+        return {
+            calendar_id: (
+                parse_events(
+                    results[calendar_id], time_window, expand_recurring
+                )
+                if calendar_id in results
+                else None
+            )
+            for calendar_id in calendar_ids
+        }
+
+
+def get_batched_calendar_events(
+    calendar_ids,
+    service,
+    max_results,
+    today_only,
+    batch_size,
+    creds=None,
+    concurrency=DEFAULT_CONCURRENCY,
+    timeout=DEFAULT_FETCH_TIMEOUT,
+    time_window=None,
+    expand_recurring=False,
+) -> Dict[str, Optional[List[Event]]]:
+    # Same as get_all_calendar_events, but up to batch_size calendars are
+    # queried in a single HTTP request. Batches still run concurrently.
+    borrow_http = shared_http(creds, timeout)
+    time_min, time_max = query_bounds(today_only, time_window)
+    batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+
+    def fetch(batch_ids):
+        items = {}
+        # Calendars with more events in time_window than the first page
+        page_tokens = {}
+
+        def callback(request_id, response, exception):
+            calendar_id = batch_ids[int(request_id)]
+            if exception is not None:
+                print(
+                    f"Failed to fetch calendar {calendar_id}: {exception}",
+                    file=sys.stderr,
+                )
+            else:
+                items[calendar_id] = response.get("items", [])
+                if time_window is not None and response.get("nextPageToken"):
+                    page_tokens[calendar_id] = response["nextPageToken"]
+
+        batch = service.new_batch_http_request(callback=callback)
+        for i, calendar_id in enumerate(batch_ids):
+            batch.add(
+                list_events_request(
+                    service,
+                    calendar_id,
+                    max_results,
+                    time_max,
+                    time_min,
+                    expand_recurring,
+                ),
+                request_id=str(i),
+            )
+        with borrow_http() as http:
+            batch.execute(http=http)
+            add_following_pages(
+                items,
+                page_tokens,
+                lambda calendar_id, token: get_result(
+                    service,
+                    calendar_id,
+                    max_results,
+                    time_max,
+                    http,
+                    time_min,
+                    expand_recurring,
+                    token,
+                ),
+            )
+        return items
+
+    if creds is None:
+        concurrency = 1
+
+    batches = [
+        tuple(calendar_ids[i:i + batch_size])
+        for i in range(0, len(calendar_ids), batch_size)
+    ]
+    results = {}
+    for items in fetch_calendars(batches, fetch, concurrency).values():
+        results.update(items)
+
+    with timings.phase("parse"):
+        return {
+            calendar_id: (
+                parse_events(
+                    results[calendar_id], time_window, expand_recurring
+                )
+                if calendar_id in results
+                else None
+            )
+            for calendar_id in calendar_ids
+        }
+
+
+def get_windowed_calendar_events(
+    calendar_ids,
+    service,
+    today_only,
+    lookahead,
+    min_events,
+    creds=None,
+    concurrency=DEFAULT_CONCURRENCY,
+    timeout=DEFAULT_FETCH_TIMEOUT,
+    batch_size=0,
+    expand_recurring=False,
+) -> Tuple[Dict[str, Optional[List[Event]]], float]:
+    # Every event in the next lookahead hours, however many there are. The
+    # window grows until it holds min_events upcoming events (all day events
+    # aside), each time only querying the part that was added. Returns the
+    # events and the end of the window.
+    now = time.time()
+    if today_only:
+        tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+        max_end = time.mktime(tomorrow.timetuple())
+    else:
+        max_end = now + MAX_LOOKAHEAD_HOURS * SECONDS_PER_HOUR
+
+    results = {calendar_id: [] for calendar_id in calendar_ids}
+    window_start = now
+    hours = lookahead
+    while True:
+        window_end = min(now + hours * SECONDS_PER_HOUR, max_end)
+        pending = [c for c in calendar_ids if results[c] is not None]
+        params = dict(
+            creds=creds,
+            concurrency=concurrency,
+            timeout=timeout,
+            time_window=(window_start, window_end),
+            expand_recurring=expand_recurring,
+        )
+        if batch_size:
+            part = get_batched_calendar_events(
+                pending, service, WINDOW_PAGE_SIZE, False, batch_size, **params
+            )
+        else:
+            part = get_all_calendar_events(
+                pending, service, WINDOW_PAGE_SIZE, False, **params
+            )
+
+        for calendar_id, events in part.items():
+            if events is None:
+                # Would have gaps, leave the calendar out entirely
+                results[calendar_id] = None
+            else:
+                # Events overlapping the previous part were already in it
+                results[calendar_id].extend(
+                    e
+                    for e in events
+                    if window_start == now or e.start_time >= window_start
+                )
+
+        upcoming = get_future_events(flatten(results), MIN_DELAY, MIN_DELAY)
+        if len(upcoming) >= min_events or window_end >= max_end:
+            return results, window_end
+        window_start = window_end
+        hours *= LOOKAHEAD_GROWTH
+
+
+def list_event_changes(
+    service, calendar_id, sync_token, page_size, http=None
+) -> Tuple[Optional[str], List[Dict[str, Any]]]:
+    # Without a sync token this is a full sync of the upcoming events,
+    # otherwise only the events that changed since the token was issued are
+    # returned (cancelled ones included). The next sync token only comes with
+    # the last page. Recurring events come once, an endless one would
+    # otherwise be synced as every one of its occurrences.
+    items = []
+    page_token = None
+    while True:
+        params = dict(
+            calendarId=calendar_id,
+            maxResults=page_size,
+            singleEvents=False,
+            pageToken=page_token,
+            fields=SYNC_FIELDS,
+        )
+        if sync_token:
+            params["syncToken"] = sync_token
+        else:
+            params["timeMin"] = datetime.datetime.utcnow().isoformat() + "Z"
+        result = service.events().list(**params).execute(http=http)
+        items.extend(result.get("items", []))
+        page_token = result.get("nextPageToken")
+        if not page_token:
+            return result.get("nextSyncToken"), items
+
+
+def sync_calendar(
+    service, calendar_id, state, page_size, http=None
+) -> Dict[str, Any]:
+    # The sync token, and the items it knows of by id: events, recurring
+    # events and the instances of them that were moved or cancelled
+    token = state.get("token") if state else None
+    events = dict(state["events"]) if token else {}
+
+    try:
+        token, items = list_event_changes(
+            service, calendar_id, token, page_size, http
+        )
+    except HttpError as e:
+        if not token or e.resp.status != 410:
+            raise
+        # The sync token expired, start over with a full sync
+        events = {}
+        token, items = list_event_changes(
+            service, calendar_id, None, page_size, http
+        )
+
+    for item in items:
+        if item.get("status") != "cancelled" or item.get("recurringEventId"):
+            # Cancelled instances hide an occurrence of their recurring event
+            events[item["id"]] = item
+        else:
+            events.pop(item["id"], None)
+    deleted = {
+        item["id"]
+        for item in items
+        if item.get("status") == "cancelled"
+        and not item.get("recurringEventId")
+    }
+
+    # Deltas can also touch events in the past, no need to keep those around
+    now = time.time()
+    events = {
+        event_id: item
+        for event_id, item in events.items()
+        if item.get("recurringEventId") not in deleted
+        and not is_over(item, now)
+    }
+    return {"token": token, "events": events}
+
+
+def sync_all_calendar_events(
+    calendar_ids,
+    service,
+    page_size,
+    sync_state,
+    creds=None,
+    concurrency=DEFAULT_CONCURRENCY,
+    timeout=DEFAULT_FETCH_TIMEOUT,
+    time_window=None,
+) -> Dict[str, Optional[List[Event]]]:
+    # The events of every calendar in time_window, where the recurring
+    # events are expanded
+    borrow_http = shared_http(creds, timeout)
+
+    def fetch(calendar_id):
+        with borrow_http() as http:
+            return sync_calendar(
+                service,
+                calendar_id,
+                sync_state.get(calendar_id),
+                page_size,
+                http,
+            )
+
+    if creds is None:
+        concurrency = 1
+
+    # Calendars that failed to sync keep their previous state
+    sync_state.update(fetch_calendars(calendar_ids, fetch, concurrency))
+
+    with timings.phase("parse"):
+        return {
+            calendar_id: (
+                parse_events(
+                    list(sync_state[calendar_id]["events"].values()),
+                    time_window,
+                    True,
+                )
+                if calendar_id in sync_state
+                else None
+            )
+            for calendar_id in calendar_ids
+        }
+
+
+def get_events_by_calendar(
+    query: Query,
+) -> Tuple[Dict[str, Optional[List[Event]]], Optional[float]]:
+    # The events of every calendar, and the end of the time window they were
+    # queried for (None when unbounded). With expand_recurring, recurring
+    # events come once and their occurrences are expanded locally, in the
+    # lookahead window or over the next expand_recurring days.
+    creds, service = open_session(query.credentials, query.timeout)
+
+    with timings.phase("calendar list"):
+        calendar_ids = get_callendar_ids(
+            query.calendar_ids, service, query.calendar_list_ttl
+        )
+
+    if query.incremental:
+        from i3_agenda.cache_utils import load_sync_state, save_sync_state
+
+        sync_state = load_sync_state()
+        time_window = recurrence_window(
+            query.today_only, query.expand_recurring or SYNC_HORIZON_DAYS
+        )
+        results = sync_all_calendar_events(
+            calendar_ids,
+            service,
+            WINDOW_PAGE_SIZE,
+            sync_state,
+            creds,
+            query.concurrency,
+            query.timeout,
+            time_window,
+        )
+        save_sync_state(sync_state)
+        return results, time_window[1]
+
+    if query.lookahead:
+        return get_windowed_calendar_events(
+            calendar_ids,
+            service,
+            query.today_only,
+            query.lookahead,
+            query.min_events,
+            creds,
+            query.concurrency,
+            query.timeout,
+            query.batch_size,
+            bool(query.expand_recurring),
+        )
+
+    if query.expand_recurring:
+        # Recurring events and their exceptions come in no particular order,
+        # so every page of the window is fetched before expanding them and
+        # keeping the nearest occurrences
+        time_window = recurrence_window(
+            query.today_only, query.expand_recurring
+        )
+        params = dict(
+            creds=creds,
+            concurrency=query.concurrency,
+            timeout=query.timeout,
+            time_window=time_window,
+            expand_recurring=True,
+        )
+        if query.batch_size:
+            results = get_batched_calendar_events(
+                calendar_ids,
+                service,
+                WINDOW_PAGE_SIZE,
+                False,
+                query.batch_size,
+                **params,
+            )
+        else:
+            results = get_all_calendar_events(
+                calendar_ids, service, WINDOW_PAGE_SIZE, False, **params
+            )
+        return nearest(results, query.max_results), time_window[1]
+
+    if query.batch_size:
+        results = get_batched_calendar_events(
+            calendar_ids,
+            service,
+            query.max_results,
+            query.today_only,
+            query.batch_size,
+            creds,
+            query.concurrency,
+            query.timeout,
+        )
+    else:
+        results = get_all_calendar_events(
+            calendar_ids,
+            service,
+            query.max_results,
+            query.today_only,
+            creds,
+            query.concurrency,
+            query.timeout,
+        )
+    return results, None
+
+
+def get_events(query: Query) -> Tuple[List[Event], Optional[float]]:
+    results, window_end = get_events_by_calendar(query)
+    return flatten(results), window_end
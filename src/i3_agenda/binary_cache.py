@@ -0,0 +1,205 @@
+# Fixed layout binary event cache, read through mmap so a render only decodes
+# the events it is going to look at.
+#
+# Layout (native byte order, recorded in the header):
+#   header        magic, version, byte order, event count, fetch timestamp,
+#                 end of the queried time window (0 when unbounded)
+#   start_time    int64[count], sorted
+#   end_time      int64[count]
+#   max_end       int64[count], running max of end_time so that the first
+#                 event that hasn't ended yet can be found with a bisect
+#   summary_ref   uint32[count * 2], offset and length in the string table
+#   location_ref  uint32[count * 2], NO_STRING when there is no location
+#   strings       utf-8 string table
+import mmap
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from typing import BinaryIO, Dict, List, Optional, Sequence
+
+from i3_agenda.event import Event, from_row
+
+MAGIC = b"I3AC"
+VERSION = 2
+HEADER = struct.Struct("=4sHHQdd")
+NO_STRING = 0xFFFFFFFF
+BYTE_ORDER = 1 if sys.byteorder == "little" else 2
+
+
+class InvalidCache(Exception):
+    pass
+
+
+def dump(
+    events: List[Event],
+    fetched_at: float,
+    f: BinaryIO,
+    window_end: Optional[float] = None,
+):
+    events = sorted(events, key=lambda e: e.start_time)
+
+    start_times = array("q", (e.start_time for e in events))
+    end_times = array("q", (e.end_time for e in events))
+    max_ends = array("q")
+    max_end = None
+    for end_time in end_times:
+        max_end = end_time if max_end is None else max(max_end, end_time)
+        max_ends.append(max_end)
+
+    strings = bytearray()
+    summary_refs = array("I")
+    location_refs = array("I")
+    for event in events:
+        summary = event.summary.encode()
+        summary_refs.extend((len(strings), len(summary)))
+        strings += summary
+        if event.location is None:
+            location_refs.extend((NO_STRING, NO_STRING))
+        else:
+            location = event.location.encode()
+            location_refs.extend((len(strings), len(location)))
+            strings += location
+
+    f.write(
+        HEADER.pack(
+            MAGIC,
+            VERSION,
+            BYTE_ORDER,
+            len(events),
+            fetched_at,
+            window_end or 0,
+        )
+    )
+    for column in (
+        start_times,
+        end_times,
+        max_ends,
+        summary_refs,
+        location_refs,
+    ):
+        f.write(column.tobytes())
+    f.write(strings)
+
+
+class BinaryCache:
+    def __init__(self, f: BinaryIO):
+        try:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            raise InvalidCache()
+        self._views = []
+
+        if len(self._mmap) < HEADER.size:
+            self.close()
+            raise InvalidCache()
+        (
+            magic,
+            version,
+            byte_order,
+            count,
+            fetched_at,
+            window_end,
+        ) = HEADER.unpack_from(self._mmap)
+        if (magic, version, byte_order) != (MAGIC, VERSION, BYTE_ORDER):
+            self.close()
+            raise InvalidCache()
+
+        self.count = count
+        self.fetched_at = fetched_at
+        self.window_end = window_end or None
+
+        offset = HEADER.size
+        columns = []
+        for fmt, size in [("q", count)] * 3 + [("I", count * 2)] * 2:
+            end = offset + size * struct.calcsize(fmt)
+            if end > len(self._mmap):
+                self.close()
+                raise InvalidCache()
+            columns.append(self._view(offset, end, fmt))
+            offset = end
+        (
+            self.start_times,
+            self.end_times,
+            self.max_ends,
+            self._summary_refs,
+            self._location_refs,
+        ) = columns
+        self._strings = self._view(offset, len(self._mmap))
+
+    def _view(self, start: int, end: int, fmt: str = "B") -> memoryview:
+        # Views have to be released before the mmap can be closed
+        view = memoryview(self._mmap)[start:end].cast(fmt)
+        self._views.append(view)
+        return view
+
+    def tail(self, column: memoryview, start: int) -> memoryview:
+        view = column[start:]
+        self._views.append(view)
+        return view
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        self._mmap.close()
+
+    def _string(self, refs: memoryview, i: int) -> Optional[str]:
+        offset, length = refs[2 * i], refs[2 * i + 1]
+        if offset == NO_STRING:
+            return None
+        return bytes(self._strings[offset:offset + length]).decode()
+
+    def event(self, i: int) -> Event:
+        return from_row(
+            (
+                self._string(self._summary_refs, i),
+                self.start_times[i],
+                self.end_times[i],
+                self._string(self._location_refs, i),
+            )
+        )
+
+    def first_not_ended(self, now: float) -> int:
+        # Every event before this index ended before now
+        return bisect_left(self.max_ends, now)
+
+    def events(self, start: int = 0) -> List[Event]:
+        return [self.event(i) for i in range(start, self.count)]
+
+
+class CachedEvents(Sequence[Event]):
+    # The events of a cache from start on, decoded the first time they are
+    # looked at. Keeps the mmap open, an EventIndex bisects over its columns
+    # as they are.
+    def __init__(self, cache: BinaryCache, start: int = 0):
+        self._cache = cache
+        self._start = start
+        self._decoded: Dict[int, Event] = {}
+        self.start_times = cache.tail(cache.start_times, start)
+        self.end_times = cache.tail(cache.end_times, start)
+        self.max_ends = cache.tail(cache.max_ends, start)
+
+    def __len__(self) -> int:
+        return len(self.start_times)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        if i not in self._decoded:
+            self._decoded[i] = self._cache.event(self._start + i)
+        return self._decoded[i]
@@ -1,54 +1,501 @@
 from i3_agenda.config import CONF_DIR
-from typing import Optional, List, TextIO
+from typing import Any, Dict, IO, Iterator, Optional, List, Sequence
+from contextlib import contextmanager
 
+import fcntl
 import os.path
 import time
 import json
+import zlib
 
-from i3_agenda.event import Event, EventEncoder
-from i3_agenda.const import SECONDS_PER_MINUTE
+from i3_agenda import timings
+from i3_agenda.event import Event, EventEncoder, from_row
+from i3_agenda.timeline import Timeline
+from i3_agenda.const import (
+    SECONDS_PER_MINUTE,
+    JSON_CACHE,
+    BINARY_CACHE,
+    DEFAULT_CACHE_ENTRIES,
+)
 
-CACHE_PATH = f"{CONF_DIR}/i3agenda_cache.txt"
+CACHE_DIR = f"{CONF_DIR}/cache"
+CACHE_EXTENSIONS = {JSON_CACHE: ".json", BINARY_CACHE: ".bin"}
+SHARD_FOLDER = "shards"
+TIMELINE_FOLDER = "timelines"
+SYNC_PATH = f"{CONF_DIR}/i3agenda_sync.json"
+CALENDAR_LIST_PATH = f"{CONF_DIR}/i3agenda_calendars.json"
+LOCK_PATH = f"{CONF_DIR}/i3agenda_cache.lock"
+REFRESH_FAILED_PATH = f"{CONF_DIR}/i3agenda_refresh_failed"
 
 
-def load_cache(cachettl: int) -> Optional[List[Event]]:
-    if not os.path.exists(CACHE_PATH):
+@contextmanager
+def atomic_write(path: str, mode: str = "w") -> Iterator[IO]:
+    # Readers either see the previous file or the complete new one, never a
+    # partially written one
+    import tempfile
+
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix=f".{os.path.basename(path)}."
+    )
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+@contextmanager
+def refresh_lock(blocking: bool = True) -> Iterator[bool]:
+    # Held while refreshing from the API, so that instances sharing the cache
+    # don't all query Google at the same time. Yields whether it was acquired.
+    os.makedirs(os.path.dirname(LOCK_PATH), exist_ok=True)
+    with open(LOCK_PATH, "a") as f:
+        try:
+            fcntl.flock(
+                f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            )
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def record_failed_refresh():
+    os.makedirs(os.path.dirname(REFRESH_FAILED_PATH), exist_ok=True)
+    with open(REFRESH_FAILED_PATH, "a"):
+        pass
+    os.utime(REFRESH_FAILED_PATH)
+
+
+def refresh_failed_recently(minutes: int) -> bool:
+    try:
+        failed_at = os.path.getmtime(REFRESH_FAILED_PATH)
+    except OSError:
+        return False
+    return time.time() - failed_at < minutes * SECONDS_PER_MINUTE
+
+
+def is_expired(
+    fetched_at: float,
+    cachettl: Optional[int],
+    window_end: Optional[float] = None,
+) -> bool:
+    # A None TTL accepts a cache of any age. Past the end of the time window
+    # it was fetched for, a cache knows nothing about the upcoming events.
+    now = time.time()
+    if window_end is not None and now >= window_end:
+        return True
+    return (
+        cachettl is not None and now - fetched_at > cachettl * SECONDS_PER_MINUTE
+    )
+
+
+def cache_key(
+    calendar_ids: List[str],
+    max_results: int,
+    today_only: bool,
+    incremental,
+    lookahead: int = 0,
+    expand_recurring: int = 0,
+) -> str:
+    params = [
+        sorted(calendar_ids),
+        max_results,
+        today_only,
+        incremental,
+        lookahead,
+    ]
+    if expand_recurring:
+        # Left out otherwise, the existing entries keep their keys
+        params.append(expand_recurring)
+    params = json.dumps(params)
+    # Plenty for a handful of entries and, unlike hashlib, free to import
+    return f"{zlib.crc32(params.encode()):08x}"
+
+
+def cache_keys(
+    calendar_ids: List[str],
+    max_results: int,
+    today_only: bool,
+    incremental,
+    lookahead: int = 0,
+    expand_recurring: int = 0,
+) -> List[str]:
+    # Results are saved under the first key. Only today's events of a query
+    # are also among the results of the same query for all upcoming events,
+    # so that cache can answer it too. Not when the upcoming events are
+    # limited to a time window, it may end before today does.
+    keys = [
+        cache_key(
+            calendar_ids,
+            max_results,
+            today_only,
+            incremental,
+            lookahead,
+            expand_recurring,
+        )
+    ]
+    if today_only and not lookahead:
+        keys.append(
+            cache_key(
+                calendar_ids,
+                max_results,
+                False,
+                incremental,
+                0,
+                expand_recurring,
+            )
+        )
+    return keys
+
+
+def cache_path(key: str, cache_format: str = JSON_CACHE) -> str:
+    return os.path.join(CACHE_DIR, key + CACHE_EXTENSIONS[cache_format])
+
+
+def load_cache(
+    cachettl: Optional[int],
+    keys: List[str],
+    cache_format: str = JSON_CACHE,
+) -> Optional[Sequence[Event]]:
+    for key in keys:
+        path = cache_path(key, cache_format)
+        events = load_entry(path, cachettl, cache_format)
+        if events is not None:
+            mark_used(path)
+            return events
+    return None
+
+
+def save_cache(
+    events: List[Event],
+    key: str,
+    cache_format: str = JSON_CACHE,
+    max_entries: int = DEFAULT_CACHE_ENTRIES,
+    window_end: Optional[float] = None,
+):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    save_entry(cache_path(key, cache_format), events, cache_format, window_end)
+    evict(max_entries)
+
+
+def load_entry(
+    path: str, cachettl: Optional[int], cache_format: str
+) -> Optional[Sequence[Event]]:
+    with timings.phase("cache read"):
+        if cache_format == BINARY_CACHE:
+            return load_binary_cache(path, cachettl)
+        return load_json_cache(path, cachettl)
+
+
+def save_entry(
+    path: str,
+    events: List[Event],
+    cache_format: str,
+    window_end: Optional[float] = None,
+):
+    with timings.phase("cache write"):
+        if cache_format == BINARY_CACHE:
+            save_binary_cache(path, events, window_end)
+        elif window_end is None:
+            with atomic_write(path) as f:
+                f.write(EventEncoder().encode(events))
+        else:
+            with atomic_write(path) as f:
+                f.write(
+                    EventEncoder().encode(
+                        {"window_end": window_end, "events": events}
+                    )
+                )
+
+
+def shard_key(
+    calendar_id: str,
+    max_results: int,
+    today_only: bool,
+    incremental,
+    lookahead: int = 0,
+    expand_recurring: int = 0,
+) -> str:
+    return cache_key(
+        [calendar_id],
+        max_results,
+        today_only,
+        incremental,
+        lookahead,
+        expand_recurring,
+    )
+
+
+def shard_path(key: str, cache_format: str = JSON_CACHE) -> str:
+    return os.path.join(
+        CACHE_DIR, SHARD_FOLDER, key + CACHE_EXTENSIONS[cache_format]
+    )
+
+
+def load_shard(
+    key: str, cachettl: Optional[int], cache_format: str = JSON_CACHE
+) -> Optional[Sequence[Event]]:
+    # Shards hold the events of a single calendar, so each one can expire on
+    # its own. They are not evicted, there is one per calendar.
+    return load_entry(shard_path(key, cache_format), cachettl, cache_format)
+
+
+def save_shard(
+    key: str,
+    events: List[Event],
+    cache_format: str = JSON_CACHE,
+    window_end: Optional[float] = None,
+):
+    os.makedirs(os.path.join(CACHE_DIR, SHARD_FOLDER), exist_ok=True)
+    save_entry(shard_path(key, cache_format), events, cache_format, window_end)
+
+
+def mark_used(path: str):
+    # The access time orders entries for eviction, the modification time
+    # still tells when it was fetched
+    try:
+        os.utime(path, (time.time(), os.path.getmtime(path)))
+    except OSError:
+        pass
+
+
+def evict(max_entries: int):
+    # Drop the least recently used entries beyond max_entries
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        path = os.path.join(CACHE_DIR, name)
+        if name.startswith(".") or not os.path.isfile(path):
+            continue
+        try:
+            entries.append((os.stat(path).st_atime, path))
+        except OSError:
+            continue
+
+    entries.sort(reverse=True)
+    for _, path in entries[max(max_entries, 1):]:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+    evict_timelines()
+
+
+def evict_timelines():
+    # Drop the timelines of the entries that are gone
+    try:
+        names = os.listdir(os.path.join(CACHE_DIR, TIMELINE_FOLDER))
+    except OSError:
+        return
+    for name in names:
+        key = os.path.splitext(name)[0]
+        if not any(
+            os.path.exists(cache_path(key, cache_format))
+            for cache_format in CACHE_EXTENSIONS
+        ):
+            try:
+                os.unlink(timeline_path(key))
+            except OSError:
+                pass
+
+
+def timeline_path(key: str) -> str:
+    return os.path.join(CACHE_DIR, TIMELINE_FOLDER, key + ".json")
+
+
+def entry_fetched_at(key: str, cache_format: str) -> Optional[float]:
+    # When the cache entry was written, timelines are only valid for it
+    try:
+        return os.path.getmtime(cache_path(key, cache_format))
+    except OSError:
         return None
 
-    if (
-        time.time() - os.path.getmtime(CACHE_PATH)
-        > cachettl * SECONDS_PER_MINUTE
-    ):
+
+def load_timelines_file(
+    key: str, fetched_at: float
+) -> Optional[Dict[str, Any]]:
+    # The timelines of the cache entry that was fetched at fetched_at, with the
+    # end of the time window it was fetched for
+    try:
+        with open(timeline_path(key), "r") as f:
+            raw = json.loads(f.read())
+        if raw["fetched_at"] != fetched_at or not isinstance(
+            raw["timelines"], dict
+        ):
+            return None
+        return raw
+    except (IOError, ValueError, KeyError, TypeError):
         return None
 
+
+def load_timelines(key: str, fetched_at: float) -> Dict[str, Any]:
+    # The timelines of every output configuration rendered from the events of
+    # the cache entry that was fetched at fetched_at
+    raw = load_timelines_file(key, fetched_at)
+    return {} if raw is None else raw["timelines"]
+
+
+def load_timeline(
+    key: str, fetched_at: float, config: str
+) -> Optional[Timeline]:
+    rows = load_timelines(key, fetched_at).get(config)
+    return None if rows is None else parse_timeline(rows)
+
+
+def parse_timeline(rows: Any) -> Optional[Timeline]:
     try:
-        with open(CACHE_PATH, "r") as f:
-            events = get_events_from_cache(f)
-        return events
-    except IOError:
-        # Invalid cache
+        return Timeline.from_rows(rows)
+    except (ValueError, TypeError):
+        # Invalid timeline, it gets built again
         return None
 
 
-def save_cache(events: List[Event]):
-    with open(CACHE_PATH, "w+") as f:
-        f.write(EventEncoder().encode(events))
+def save_timeline(
+    key: str,
+    fetched_at: float,
+    config: str,
+    timeline: Timeline,
+    window_end: Optional[float] = None,
+):
+    save_timelines(key, fetched_at, {config: timeline}, window_end)
 
 
-def get_events_from_cache(f: TextIO):
-    events = []
-    raw = json.loads(f.read())
-    for event in raw:
-        try:
-            events.append(
-                Event(
-                    event["summary"],
-                    event["start_time"],
-                    event["end_time"],
-                    event["location"],
-                )
+def save_timelines(
+    key: str,
+    fetched_at: float,
+    new_timelines: Dict[str, Timeline],
+    window_end: Optional[float] = None,
+):
+    timelines = load_timelines(key, fetched_at)
+    for config, timeline in new_timelines.items():
+        timelines[config] = timeline.rows()
+    os.makedirs(os.path.join(CACHE_DIR, TIMELINE_FOLDER), exist_ok=True)
+    with atomic_write(timeline_path(key)) as f:
+        f.write(
+            json.dumps(
+                {
+                    "fetched_at": fetched_at,
+                    "window_end": window_end,
+                    "timelines": timelines,
+                }
             )
-        except KeyError:
-            # At least one of the events in cache are invalid, must mean that the entire cache is invalid
+        )
+
+
+def load_json_cache(path: str, cachettl: Optional[int]):
+    if not os.path.exists(path):
+        return None
+
+    if is_expired(os.path.getmtime(path), cachettl):
+        return None
+
+    try:
+        with open(path, "r") as f:
+            raw = json.loads(f.read())
+        if isinstance(raw, dict):
+            # Fetched for a limited time window
+            if is_expired(0, None, raw["window_end"]):
+                return None
+            raw = raw["events"]
+        return get_events_from_cache(raw)
+    except (IOError, ValueError, TypeError, KeyError):
+        # Invalid cache
+        return None
+
+
+def load_binary_cache(
+    path: str, cachettl: Optional[int]
+) -> Optional[Sequence[Event]]:
+    from i3_agenda.binary_cache import BinaryCache, CachedEvents, InvalidCache
+
+    try:
+        with open(path, "rb") as f:
+            cache = BinaryCache(f)
+    except (IOError, InvalidCache):
+        # Missing or invalid cache
+        return None
+    if is_expired(cache.fetched_at, cachettl, cache.window_end):
+        cache.close()
+        return None
+    # Events that already ended are never shown, don't even look at them
+    return CachedEvents(cache, cache.first_not_ended(time.time()))
+
+
+def save_binary_cache(
+    path: str, events: List[Event], window_end: Optional[float] = None
+):
+    from i3_agenda.binary_cache import dump
+
+    with atomic_write(path, "wb") as f:
+        dump(events, time.time(), f, window_end)
+
+
+def get_events_from_cache(raw: List[Any]):
+    try:
+        return [from_row(event) for event in raw]
+    except (KeyError, ValueError):
+        # At least one of the events in cache are invalid, must mean that the entire cache is invalid
+        return None
+
+
+def load_sync_state() -> Dict[str, Dict[str, Any]]:
+    # Maps every calendar id to its last sync token and the API items it
+    # knows of
+    if not os.path.exists(SYNC_PATH):
+        return {}
+
+    try:
+        with open(SYNC_PATH, "r") as f:
+            raw = json.loads(f.read())
+        state = {
+            calendar_id: {
+                "token": calendar["token"],
+                "events": dict(calendar["events"]),
+            }
+            for calendar_id, calendar in raw.items()
+        }
+        for calendar in state.values():
+            items = calendar["events"].values()
+            if not all(isinstance(item, dict) for item in items):
+                # Events synced by an older version
+                raise ValueError("invalid item")
+        return state
+    except (IOError, ValueError, KeyError, TypeError, AttributeError):
+        # Invalid sync state, the next refresh will do a full sync
+        return {}
+
+
+def save_sync_state(state: Dict[str, Dict[str, Any]]):
+    with atomic_write(SYNC_PATH) as f:
+        f.write(json.dumps(state))
+
+
+def load_calendar_list_state(
+    cachettl: Optional[int],
+) -> Optional[Dict[str, Any]]:
+    # The ids of the subscribed calendars and the sync token to update them
+    try:
+        if is_expired(os.path.getmtime(CALENDAR_LIST_PATH), cachettl):
             return None
-    return events
+        with open(CALENDAR_LIST_PATH, "r") as f:
+            state = json.loads(f.read())
+        if not isinstance(state["calendars"], list):
+            return None
+        return state
+    except (IOError, ValueError, KeyError, TypeError):
+        return None
+
+
+def load_calendar_list(cachettl: Optional[int]) -> Optional[List[str]]:
+    state = load_calendar_list_state(cachettl)
+    return state["calendars"] if state else None
+
+
+def save_calendar_list(state: Dict[str, Any]):
+    with atomic_write(CALENDAR_LIST_PATH) as f:
+        f.write(json.dumps(state))
@@ -0,0 +1,63 @@
+# Talks to a running `i3-agenda --daemon`. This module is what the bar starts
+# on every tick so it must stay cheap to import: standard library only.
+import json
+import os
+import socket
+import sys
+from typing import List, Tuple
+
+SOCKET_NAME = "i3agenda.sock"
+DEFAULT_CONF_DIR = os.path.join(os.path.expanduser("~"), ".i3agenda")
+CONNECT_TIMEOUT = 5
+
+
+def socket_path(argv: List[str]) -> str:
+    if os.getenv("I3_AGENDA_SOCKET"):
+        return os.environ["I3_AGENDA_SOCKET"]
+
+    conf_dir = DEFAULT_CONF_DIR
+    for i, arg in enumerate(argv[:-1]):
+        if arg in ("--conf", "-cd"):
+            conf_dir = argv[i + 1]
+    return os.path.join(conf_dir, SOCKET_NAME)
+
+
+def query(path: str, argv: List[str], button: str = "") -> Tuple[str, bool]:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(CONNECT_TIMEOUT)
+        sock.connect(path)
+        request = {"argv": argv, "button": button}
+        sock.sendall(json.dumps(request).encode() + b"\n")
+
+        with sock.makefile("rb") as f:
+            reply = json.loads(f.readline())
+
+    if "error" in reply:
+        raise ValueError(reply["error"])
+    return reply["output"], reply["urgent"]
+
+
+def main():
+    argv = sys.argv[1:]
+    try:
+        output, urgent = query(
+            socket_path(argv), argv, os.getenv("BLOCK_BUTTON", "")
+        )
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        exit(2)
+    except OSError:
+        # No daemon to talk to, do the work in process instead
+        from i3_agenda.main import main as standalone_main
+
+        standalone_main()
+        return
+
+    print(output)
+    if urgent:
+        # special i3blocks exit code to set the block urgent
+        exit(33)
+
+
+if __name__ == "__main__":
+    main()
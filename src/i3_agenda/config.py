@@ -1,7 +1,20 @@
 import os
 from os.path import expanduser
 import argparse
-from i3_agenda.const import MIN_DELAY, MIN_CHARS
+from typing import Tuple
+from i3_agenda.const import (
+    MIN_DELAY,
+    MIN_CHARS,
+    DEFAULT_CONCURRENCY,
+    DEFAULT_FETCH_TIMEOUT,
+    JSON_CACHE,
+    BINARY_CACHE,
+    DEFAULT_CACHE_ENTRIES,
+    DEFAULT_CALENDAR_LIST_TTL,
+    MAX_BATCH_SIZE,
+    LOOKAHEAD_MIN_EVENTS,
+    SYNC_HORIZON_DAYS,
+)
 
 
 CONF_DIR = expanduser("~") + os.path.sep + ".i3agenda"
@@ -12,104 +25,262 @@ URL_REGEX = "(((http|https)://)?[a-zA-Z0-9./?:@\\-_=#]+\\.([a-zA-Z]){2,6}([a-zA-
 button = os.getenv("BLOCK_BUTTON", "")
 
 
-parser = argparse.ArgumentParser(description="Show next Google Calendar event")
-parser.add_argument(
-    "--credentials",
-    "-c",
-    type=str,
-    default="",
-    help="path to your credentials.json file",
-)
-parser.add_argument(
-    "--conf",
-    "-cd",
-    type=str,
-    default=CONF_DIR,
-    help="path to the i3agenda configuration and cache folder",
-)
-parser.add_argument(
-    "--cachettl",
-    "-ttl",
-    type=int,
-    default=30,
-    help="time for cache to be kept in minutes",
-)
-parser.add_argument(
-    "--update",
-    "-u",
-    action="store_true",
-    default=False,
-    help="""when using this flag it will not load previous results from cache, it will however save
-            new results to cache. You can use this flag to refresh all the cache forcefully""",
-)
-parser.add_argument(
-    "--ids",
-    "-i",
-    type=str,
-    default=[],
-    nargs="+",
-    help="list of calendar ids to fetch, space separated. If none is specified all calendars will be fetched",
-)
-parser.add_argument(
-    "--maxres",
-    "-r",
-    type=int,
-    default=10,
-    help="""max number of events to query Google's API for each of your calendars. Increase this number if you
-            have lot of events in your google calendar""",
-)
-parser.add_argument(
-    "--today", "-d", action="store_true", help="print only today events"
-)
-parser.add_argument(
-    "--no-event-text",
-    default="No events",
-    metavar="TEXT",
-    help="text to display when there are no events",
-)
-parser.add_argument(
-    "--hide-event-after",
-    type=int,
-    default=MIN_DELAY,
-    help="""minutes to show events after they start before showing the next event. If not specified, the current event
-            will be shown until it ends""",
-)
-parser.add_argument(
-    "--show-event-before",
-    type=int,
-    default=MIN_DELAY,
-    help="""minutes to show events before they start. If not specified, the next event
-            will be shown regardless of when it starts""",
-)
-parser.add_argument(
-    "--date-format",
-    type=str,
-    default="%d/%m",
-    help="the date format like %%d/%%m/%%y used for events starting in more than on week. Default is %%d/%%m",
-)
-parser.add_argument(
-    "--limchar",
-    "-l",
-    type=int,
-    default=MIN_CHARS,
-    help="the max characters that the displayed event can contain",
-)
-parser.add_argument(
-    "--skip",
-    "-s",
-    type=int,
-    default=0,
-    help="the number of events to skip from the most recent",
-)
-parser.add_argument(
-    "--ongoing-time-left",
-    "-o",
-    action="store_true",
-    help="print time left instead of the end time for ongoing events (22m left) instead of (ends 12:00)",
-)
-parser.add_argument(
-    "--next-event-time-left",
-    "-n",
-    action="store_true",
-    help="print the time remaining before the next event starts (event_name in 22m) instead of (12:00 event_name)",
-)
+_parser = None
+
+
+def calendar_ttl(value: str) -> Tuple[str, int]:
+    calendar_id, separator, minutes = value.rpartition("=")
+    if not separator or not calendar_id or not minutes.isdigit():
+        raise argparse.ArgumentTypeError(
+            f"expected CALENDAR_ID=MINUTES, got {value}"
+        )
+    return calendar_id, int(minutes)
+
+
+def get_parser() -> argparse.ArgumentParser:
+    # Built on first use, most modules only need the constants above
+    global _parser
+    if _parser is not None:
+        return _parser
+
+    parser = argparse.ArgumentParser(
+        description="Show next Google Calendar event"
+    )
+    parser.add_argument(
+        "--credentials",
+        "-c",
+        type=str,
+        default="",
+        help="path to your credentials.json file",
+    )
+    parser.add_argument(
+        "--conf",
+        "-cd",
+        type=str,
+        default=CONF_DIR,
+        help="path to the i3agenda configuration and cache folder",
+    )
+    parser.add_argument(
+        "--cachettl",
+        "-ttl",
+        type=int,
+        default=30,
+        help="time for cache to be kept in minutes",
+    )
+    parser.add_argument(
+        "--update",
+        "-u",
+        action="store_true",
+        default=False,
+        help="""when using this flag it will not load previous results from cache, it will however save
+                new results to cache. You can use this flag to refresh all the cache forcefully""",
+    )
+    parser.add_argument(
+        "--ids",
+        "-i",
+        type=str,
+        default=[],
+        nargs="+",
+        help="list of calendar ids to fetch, space separated. If none is specified all calendars will be fetched",
+    )
+    parser.add_argument(
+        "--maxres",
+        "-r",
+        type=int,
+        default=10,
+        help="""max number of events to query Google's API for each of your calendars. Increase this number if you
+                have lot of events in your google calendar""",
+    )
+    parser.add_argument(
+        "--today", "-d", action="store_true", help="print only today events"
+    )
+    parser.add_argument(
+        "--no-event-text",
+        default="No events",
+        metavar="TEXT",
+        help="text to display when there are no events",
+    )
+    parser.add_argument(
+        "--hide-event-after",
+        type=int,
+        default=MIN_DELAY,
+        help="""minutes to show events after they start before showing the next event. If not specified, the current event
+                will be shown until it ends""",
+    )
+    parser.add_argument(
+        "--show-event-before",
+        type=int,
+        default=MIN_DELAY,
+        help="""minutes to show events before they start. If not specified, the next event
+                will be shown regardless of when it starts""",
+    )
+    parser.add_argument(
+        "--date-format",
+        type=str,
+        default="%d/%m",
+        help="the date format like %%d/%%m/%%y used for events starting in more than on week. Default is %%d/%%m",
+    )
+    parser.add_argument(
+        "--limchar",
+        "-l",
+        type=int,
+        default=MIN_CHARS,
+        help="the max characters that the displayed event can contain",
+    )
+    parser.add_argument(
+        "--skip",
+        "-s",
+        type=int,
+        default=0,
+        help="the number of events to skip from the most recent",
+    )
+    parser.add_argument(
+        "--list",
+        action="store_true",
+        help="""print every upcoming event (after --skip) on its own line, instead of the closest one.
+        Prints nothing when there are none""",
+    )
+    parser.add_argument(
+        "--ongoing-time-left",
+        "-o",
+        action="store_true",
+        help="print time left instead of the end time for ongoing events (22m left) instead of (ends 12:00)",
+    )
+    parser.add_argument(
+        "--next-event-time-left",
+        "-n",
+        action="store_true",
+        help="print the time remaining before the next event starts (event_name in 22m) instead of (12:00 event_name)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="max number of calendars to query Google's API for in parallel",
+    )
+    parser.add_argument(
+        "--fetch-timeout",
+        type=int,
+        default=DEFAULT_FETCH_TIMEOUT,
+        help="""seconds to wait for each calendar before giving up on it. Events from the calendars that did answer
+                are still shown""",
+    )
+    parser.add_argument(
+        "--lookahead",
+        type=int,
+        default=0,
+        metavar="HOURS",
+        help=f"""fetch every event of the next HOURS hours instead of --maxres events per calendar. The window
+                grows while it has less than {LOOKAHEAD_MIN_EVENTS} upcoming events (or --skip + 1). Not used
+                with --incremental""",
+    )
+    parser.add_argument(
+        "--expand-recurring",
+        type=int,
+        default=0,
+        metavar="DAYS",
+        help=f"""get recurring events once with their recurrence rules and expand their occurrences of the next
+                DAYS days (or of the --lookahead window) locally, instead of getting every occurrence from
+                Google. Much smaller responses for calendars full of recurring meetings. --incremental always
+                expands them, over {SYNC_HORIZON_DAYS} days unless this is set""",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=0,
+        help=f"""query up to this many calendars in a single HTTP request (at most {MAX_BATCH_SIZE}). Saves a
+                round-trip per calendar when you have many of them. Not used with --incremental""",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help=f"""only download the events that changed since the previous refresh, using Google's sync tokens.
+                The sync state is kept next to the cache. Shows the events of the next {SYNC_HORIZON_DAYS} days""",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="""keep running, refresh the events in the background every cachettl minutes and answer
+                i3-agenda-client over a unix socket in the configuration folder""",
+    )
+    parser.add_argument(
+        "--follow",
+        "-f",
+        action="store_true",
+        help="""keep running and print a new line every time the displayed text changes, for polybar tail
+                modules and persistent i3blocks""",
+    )
+    parser.add_argument(
+        "--i3bar",
+        action="store_true",
+        help="""with --follow, write the i3bar JSON protocol instead of plain lines so urgency is shown as it happens.
+                With --profiles, print every profile as one i3bar JSON array""",
+    )
+    parser.add_argument(
+        "--profiles",
+        type=str,
+        default=None,
+        metavar="FILE",
+        help="""render every profile of an INI file in one go, from a single cache read. Each section
+                sets display flags (skip, today, limchar, ...) on top of the command line ones, and
+                an output file or FIFO to write the text to""",
+    )
+    parser.add_argument(
+        "--cache-format",
+        choices=[JSON_CACHE, BINARY_CACHE],
+        default=JSON_CACHE,
+        help="""format of the event cache. The binary cache is faster to load when there are a lot of
+                events""",
+    )
+    parser.add_argument(
+        "--max-stale",
+        type=int,
+        default=0,
+        help="""minutes after the cache TTL during which the expired cache is still shown while it is
+                refreshed in the background. Disabled by default""",
+    )
+    parser.add_argument(
+        "--cache-entries",
+        type=int,
+        default=DEFAULT_CACHE_ENTRIES,
+        help="""max number of cached queries. Every combination of --ids, --maxres and --today has its own
+                cache, the least recently used ones are removed""",
+    )
+    parser.add_argument(
+        "--calendar-ttl",
+        type=calendar_ttl,
+        default=[],
+        nargs="+",
+        metavar="ID=MINUTES",
+        help="""cache every calendar on its own, with its own TTL in minutes. Calendars that are not listed
+                use --cachettl. Only the expired calendars are fetched again""",
+    )
+    parser.add_argument(
+        "--calendar-list-ttl",
+        type=int,
+        default=DEFAULT_CALENDAR_LIST_TTL,
+        help="""time for the list of your calendars to be kept in minutes, when --ids is not used. New calendars
+                show up after at most this long, or with --update""",
+    )
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="""append the time spent in each phase and on each request to
+                i3agenda_timings.log in the conf folder, as JSON lines. Also
+                enabled by setting I3_AGENDA_PROFILE=1""",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="""like --timings, and dump cProfile stats of the run to
+                i3agenda_profile.prof in the conf folder. Also enabled by
+                setting I3_AGENDA_PROFILE=cprofile""",
+    )
+    parser.add_argument(
+        "--refresh-only",
+        action="store_true",
+        help=argparse.SUPPRESS,
+    )
+
+    _parser = parser
+    return parser
@@ -1,4 +1,8 @@
-from typing_extensions import Final
+try:
+    from typing import Final
+except ImportError:
+    # Python < 3.8
+    from typing_extensions import Final
 
 DAYS_PER_WEEK: Final = 7
 HOURS_PER_DAY: Final = 24
@@ -11,5 +15,38 @@ URGENT_DELAY_MN: Final = 5
 MIN_CHARS: Final = -1
 MIN_DELAY: Final = -1
 
+# Shaped summaries kept around by long running modes
+SHAPE_CACHE_SIZE: Final = 1024
+
 LEFT_MOUSE_BUTTON: Final = "1"
 RIGHT_MOUSE_BUTTON: Final = "3"
+
+# The long running modes refresh at most this often, whatever --cachettl is
+MIN_REFRESH_MINUTES: Final = 1
+
+DEFAULT_CONCURRENCY: Final = 8
+DEFAULT_FETCH_TIMEOUT: Final = 10
+# Google Calendar rejects batches of more than 50 requests
+MAX_BATCH_SIZE: Final = 50
+
+# Time windows start at --lookahead hours and grow by this factor, up to a year
+LOOKAHEAD_GROWTH: Final = 4
+MAX_LOOKAHEAD_HOURS: Final = 366 * 24
+LOOKAHEAD_MIN_EVENTS: Final = 5
+# Largest page the API allows, windows with more events are paged through
+WINDOW_PAGE_SIZE: Final = 2500
+
+# Days of events that --incremental shows, recurring events are expanded
+# over them unless --expand-recurring says otherwise
+SYNC_HORIZON_DAYS: Final = 31
+
+JSON_CACHE: Final = "json"
+BINARY_CACHE: Final = "binary"
+DEFAULT_CACHE_ENTRIES: Final = 10
+DEFAULT_CALENDAR_LIST_TTL: Final = 1440
+# Refreshes that failed are retried after this long: in the background with
+# --max-stale, and for the calendars missing from a cache entry
+REFRESH_RETRY_MINUTES: Final = 5
+
+# The --timings log is rotated once it gets this big
+MAX_TIMINGS_LOG_BYTES: Final = 1024 * 1024
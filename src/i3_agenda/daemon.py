@@ -0,0 +1,130 @@
+import argparse
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Tuple, Union
+
+from i3_agenda import config, timings
+from i3_agenda.client import SOCKET_NAME
+from i3_agenda.event import Event
+from i3_agenda.event_index import EventIndex
+from i3_agenda.main import button_action, load_events, refresh_interval
+from i3_agenda.timeline import Timeline, timeline_config
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            reply = self.server.answer(request["argv"], request["button"])
+        except (ValueError, KeyError, TypeError):
+            reply = {"error": "invalid request"}
+        self.wfile.write(json.dumps(reply).encode() + b"\n")
+
+
+class AgendaServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(
+        self, path: str, args, events: Union[List[Event], EventIndex]
+    ):
+        self.args = args
+        self.events = events
+        # The timelines of every set of flags asked for, for these events
+        self.timelines: Tuple[Any, Dict[str, Timeline]] = (events, {})
+        self.stopped = threading.Event()
+        super().__init__(path, RequestHandler)
+        os.chmod(path, 0o600)
+
+    def answer(self, argv: List[str], button: str):
+        try:
+            args = config.get_parser().parse_args(argv)
+        except SystemExit:
+            return {"error": f"invalid arguments: {' '.join(argv)}"}
+
+        now = time.time()
+        with timings.phase("render"):
+            segment = self.timeline(args, now).at(now)
+        if segment is None:
+            return {"output": args.no_event_text, "urgent": False}
+
+        text = segment.render(now)
+        message = button_action(button, segment.location)
+        if message:
+            text = f"{message}\n{text}"
+        return {"output": text, "urgent": segment.urgent}
+
+    def timeline(self, args, now: float) -> Timeline:
+        # Keep a reference, the refresh thread may swap the events meanwhile
+        events = self.events
+        cached_events, timelines = self.timelines
+        if cached_events is not events:
+            timelines = {}
+            self.timelines = (events, timelines)
+
+        key = timeline_config(args)
+        timeline = timelines.get(key)
+        if timeline is None or not timeline.covers(now):
+            index = (
+                events
+                if isinstance(events, EventIndex)
+                else EventIndex(events)
+            )
+            # Until about the next refresh, rebuilt if that fails
+            end = now + refresh_interval(self.args)
+            timeline = Timeline.build(args, index, now, end)
+            timelines[key] = timeline
+        return timeline
+
+    def refresh_forever(self):
+        refresh_args = argparse.Namespace(**vars(self.args))
+        refresh_args.update = True
+        while not self.stopped.wait(refresh_interval(self.args)):
+            try:
+                with timings.phase("load events"):
+                    self.events = EventIndex(load_events(refresh_args))
+            except Exception as e:
+                # Keep serving the previous events until the next try
+                print(f"Failed to refresh events: {e}", file=sys.stderr)
+            timings.flush()
+
+    def server_close(self):
+        self.stopped.set()
+        super().server_close()
+
+
+def remove_stale_socket(path: str):
+    if not os.path.exists(path):
+        return
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            os.unlink(path)
+            return
+    print(f"i3-agenda is already running on {path}", file=sys.stderr)
+    exit(1)
+
+
+def run_daemon(args):
+    path = os.path.join(args.conf, SOCKET_NAME)
+    os.makedirs(args.conf, exist_ok=True)
+    remove_stale_socket(path)
+
+    server = AgendaServer(path, args, EventIndex(load_events(args)))
+    threading.Thread(target=server.refresh_forever, daemon=True).start()
+    # Make sure the socket gets removed when the bar kills us
+    signal.signal(signal.SIGTERM, lambda signum, frame: exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
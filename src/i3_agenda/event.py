@@ -2,11 +2,9 @@ import datetime as dt
 import json
 import re
 import time
-from typing import List, Optional, Any, Union, Dict
+from typing import List, Optional, Any, Tuple, Union, Dict
 
 
-from bidi.algorithm import get_display
-
 from i3_agenda.config import (
     MIN_CHARS,
     MIN_DELAY,
@@ -18,18 +16,110 @@ from i3_agenda.const import (
     DAYS_PER_WEEK,
     URGENT_DELAY_MN,
     SECONDS_PER_DAY,
+    SHAPE_CACHE_SIZE,
 )
 from i3_agenda.helpers import get_unix_time, human_delta
 from dataclasses import dataclass
+from functools import lru_cache
+
+
+# Characters of right-to-left scripts and the explicit bidi controls, text
+# without any of them is displayed as is
+RTL_REGEX = re.compile(
+    "[\u0590-\u08ff\ufb1d-\ufdff\ufe70-\ufeff\u200f\u202b\u202e\u2067"
+    "\U00010800-\U00010fff\U0001e800-\U0001efff]"
+)
+
+
+def is_ltr(text: str) -> bool:
+    return text.isascii() or RTL_REGEX.search(text) is None
+
+
+@lru_cache(maxsize=SHAPE_CACHE_SIZE)
+def shape_summary(summary: str, limit_char: int) -> str:
+    # Summaries hardly change between refreshes, the events holding them do
+    result = summary
+    if MIN_CHARS < limit_char < len(result):
+        result = result[:limit_char] + "..."
+    if is_ltr(result):
+        return result
+
+    from bidi.algorithm import get_display
+
+    # this is done to preserve RTL while adding the "..." since the get_display is applied after adding the "..."
+    return str(get_display(result))
+
+
+@dataclass(frozen=True)
+class RenderContext:
+    # The clock read once for a whole render, so that every event and
+    # predicate agrees on what "now" and "today" are
+    timestamp: float
+    now: dt.datetime
+    today: dt.date
+    tomorrow: dt.date
+    next_week: dt.date
+    end_of_today: float
+
+
+def render_context(timestamp: Optional[float] = None) -> RenderContext:
+    if timestamp is None:
+        timestamp = time.time()
+    now = dt.datetime.fromtimestamp(timestamp)
+    today = now.date()
+    return RenderContext(
+        timestamp,
+        now,
+        today,
+        today + dt.timedelta(days=1),
+        today + dt.timedelta(days=DAYS_PER_WEEK),
+        now.replace(hour=23, minute=59, second=59).timestamp(),
+    )
 
 
-@dataclass
+@dataclass(frozen=True)
 class Event:
+    # Slotted and immutable, so that the values derived from the fields can
+    # be computed once and kept on the event
+    __slots__ = (
+        "summary",
+        "start_time",
+        "end_time",
+        "location",
+        "_allday",
+        "_start_date",
+        "_display",
+    )
+
     summary: str
     start_time: int
     end_time: int
     location: Union[str, None]
 
+    def __reduce__(self):
+        return Event, tuple(self.row())
+
+    def row(self) -> list:
+        return [self.summary, self.start_time, self.end_time, self.location]
+
+    def start_date(self) -> dt.date:
+        start_date = getattr(self, "_start_date", None)
+        if start_date is None:
+            start_date = dt.date.fromtimestamp(self.start_time)
+            object.__setattr__(self, "_start_date", start_date)
+        return start_date
+
+    def display(self, limit_char: int) -> str:
+        # The summary trimmed to limit_char and shaped for RTL text, kept for
+        # the next render of the same event
+        cached = getattr(self, "_display", None)
+        if cached is not None and cached[0] == limit_char:
+            return cached[1]
+
+        result = shape_summary(self.summary, limit_char)
+        object.__setattr__(self, "_display", (limit_char, result))
+        return result
+
     def get_datetime(self) -> dt.datetime:
         return dt.datetime.fromtimestamp(self.start_time)
 
@@ -42,87 +132,132 @@ class Event:
         date_format: str,
         ongoing_time_left: bool = False,
         next_event_time_left: bool = False,
+        ctx: Optional[RenderContext] = None,
     ) -> str:
-        event_datetime = self.get_datetime()
-
-        result = self.summary
-        trimmed = ""
-        if MIN_CHARS < limit_char < len(result):
-            trimmed = "".join([c for c in result][:limit_char])
+        ctx = ctx or render_context()
+        before, countdown, after = self.get_template(
+            limit_char,
+            date_format,
+            ongoing_time_left,
+            next_event_time_left,
+            ctx,
+        )
+        if countdown is None:
+            return before
+        time_left = dt.timedelta(seconds=countdown - ctx.timestamp)
+        return f"{before}{human_delta(time_left)}{after}"
 
-        # this is done to preserve RTL while adding the "..." since the get_display is applied after adding the "..."
-        if trimmed:
-            result = trimmed + "..."
-        result = str(get_display(result))
+    def get_template(
+        self,
+        limit_char: int,
+        date_format: str,
+        ongoing_time_left: bool = False,
+        next_event_time_left: bool = False,
+        ctx: Optional[RenderContext] = None,
+    ) -> Tuple[str, Optional[int], str]:
+        # The text of get_string split around the time left until countdown,
+        # which is None when there is none. Only the time left changes from
+        # one second to the next.
+        ctx = ctx or render_context()
+        event_datetime = self.get_datetime()
+        result = self.display(limit_char)
 
-        if self.is_ongoing():
+        if self.is_ongoing(ctx):
             if ongoing_time_left:
-                time_left = self.get_end_datetime() - dt.datetime.now()
-                return f"{result} ({human_delta(time_left)} left)"
+                return f"{result} (", self.end_time, " left)"
             else:
-                return f"{result} (ends {self.get_end_datetime():%H:%M})"
-        elif self.is_today():
-            if not self.is_ongoing() and next_event_time_left:
-                time_left = event_datetime - dt.datetime.now()
-                return f"{result} in {human_delta(time_left)}"
+                return (
+                    f"{result} (ends {self.get_end_datetime():%H:%M})",
+                    None,
+                    "",
+                )
+        elif self.is_today(ctx):
+            if next_event_time_left:
+                return f"{result} in ", self.start_time, ""
             else:
-                return f"{event_datetime:%H:%M} {result}"
-        elif self.is_tomorrow():
-            return f"{event_datetime:Tomorrow at %H:%M} {result}"
-        elif self.is_this_week():
-            return f"{event_datetime:%a at %H:%M} {result}"
+                return f"{event_datetime:%H:%M} {result}", None, ""
+        elif self.is_tomorrow(ctx):
+            return f"{event_datetime:Tomorrow at %H:%M} {result}", None, ""
+        elif self.is_this_week(ctx):
+            return f"{event_datetime:%a at %H:%M} {result}", None, ""
         else:
-            return f"{event_datetime:{date_format} at %H:%M} {result}"
+            return (
+                f"{event_datetime:{date_format} at %H:%M} {result}",
+                None,
+                "",
+            )
 
-    def is_ongoing(self) -> bool:
-        now = dt.datetime.now()
-        ongoing = (
-            now > self.get_datetime() and not now > self.get_end_datetime()
-        )
-        return ongoing
-
-    def is_today(self) -> bool:
-        today = dt.datetime.today()
-        return self.get_datetime().date() == today.date()
-
-    def is_tomorrow(self) -> bool:
-        tomorrow = dt.datetime.today() + dt.timedelta(days=1)
-        return self.get_datetime().date() == tomorrow.date()
-
-    def is_this_week(self) -> bool:
-        today = dt.datetime.today()
-        next_week = today + dt.timedelta(days=DAYS_PER_WEEK)
-        return today.date() <= self.get_datetime().date() < next_week.date()
-
-    def is_urgent(self) -> bool:
-        now = dt.datetime.now()
-        urgent = now + dt.timedelta(minutes=URGENT_DELAY_MN)
-        five_minutes_started = self.get_datetime() + dt.timedelta(
-            minutes=URGENT_DELAY_MN
-        )
+    def is_ongoing(self, ctx: Optional[RenderContext] = None) -> bool:
+        now = (ctx or render_context()).timestamp
+        return now > self.start_time and not now > self.end_time
+
+    def is_today(self, ctx: Optional[RenderContext] = None) -> bool:
+        return self.start_date() == (ctx or render_context()).today
+
+    def is_tomorrow(self, ctx: Optional[RenderContext] = None) -> bool:
+        return self.start_date() == (ctx or render_context()).tomorrow
+
+    def is_this_week(self, ctx: Optional[RenderContext] = None) -> bool:
+        ctx = ctx or render_context()
+        return ctx.today <= self.start_date() < ctx.next_week
+
+    def is_urgent(self, ctx: Optional[RenderContext] = None) -> bool:
+        now = (ctx or render_context()).timestamp
+        urgent_delay = URGENT_DELAY_MN * SECONDS_PER_MINUTE
         # is urgent if it begins in URGENT_DELAY_MN minutes and if it hasn't
         # passed URGENT_DELAY_MN minutes it started
-        return self.get_datetime() < urgent and not now > five_minutes_started
-
-    def is_allday(self) -> bool:
-        time_delta = self.end_time - self.start_time
-        # event is considered all day if its start time and end time are both 00:00:00
-        # and the time difference between start and finish is divisible by 24
         return (
-            self.get_datetime().time() == dt.time(0)
-            and self.get_end_datetime().time() == dt.time(0)
-            and time_delta % SECONDS_PER_DAY == 0
+            self.start_time < now + urgent_delay
+            and not now > self.start_time + urgent_delay
         )
 
+    def is_allday(self) -> bool:
+        allday = getattr(self, "_allday", None)
+        if allday is None:
+            time_delta = self.end_time - self.start_time
+            # event is considered all day if its start time and end time are both 00:00:00
+            # and the time difference between start and finish is divisible by 24
+            allday = (
+                self.get_datetime().time() == dt.time(0)
+                and self.get_end_datetime().time() == dt.time(0)
+                and time_delta % SECONDS_PER_DAY == 0
+            )
+            object.__setattr__(self, "_allday", allday)
+        return allday
+
 
 class EventEncoder(json.JSONEncoder):
     def default(self, o):  # pylint: disable=E0202
         if isinstance(o, Event):
-            return o.__dict__
+            # [summary, start_time, end_time, location]
+            return o.row()
         else:
             return json.JSONEncoder.default(self, o)
 
 
+# Setting the slots directly skips the frozen dataclass __init__, which goes
+# through object.__setattr__ for every field. Used to decode caches.
+_set_summary = Event.summary.__set__  # type: ignore
+_set_start_time = Event.start_time.__set__  # type: ignore
+_set_end_time = Event.end_time.__set__  # type: ignore
+_set_location = Event.location.__set__  # type: ignore
+
+
+def from_row(row: Union[List[Any], Dict[str, Any]]) -> Event:
+    # Caches written before events were stored as rows hold dicts
+    if type(row) is dict:
+        return Event(
+            row["summary"], row["start_time"], row["end_time"], row["location"]
+        )
+    summary, start_time, end_time, location = row
+    event = object.__new__(Event)
+    _set_summary(event, summary)
+    _set_start_time(event, start_time)
+    _set_end_time(event, end_time)
+    _set_location(event, location)
+    return event
+
+
 def sort_events(events: List[Event]) -> List[Event]:
     return sorted(events, key=lambda e: e.start_time, reverse=False)
 
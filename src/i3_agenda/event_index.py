@@ -0,0 +1,100 @@
+# Events sorted by start time once, with their times in parallel arrays, so
+# that picking the event to show is a couple of bisections instead of a scan
+# over every event on each render. Events read from a binary cache already
+# are, their columns are used as they are.
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Iterator, Optional, Sequence
+
+from i3_agenda.binary_cache import CachedEvents
+from i3_agenda.const import MIN_DELAY, SECONDS_PER_MINUTE
+from i3_agenda.event import Event
+
+UNKNOWN = -1
+
+
+class EventIndex:
+    def __init__(self, events: Sequence[Event]):
+        # Filled in the first time an event is looked at, most never are
+        self.allday = array("b", [UNKNOWN]) * len(events)
+        if isinstance(events, CachedEvents):
+            self.events: Sequence[Event] = events
+            self.start_times = events.start_times
+            self.end_times = events.end_times
+            self.max_ends = events.max_ends
+            return
+
+        self.events = sorted(events, key=lambda e: e.start_time)
+        self.start_times = array("q", (e.start_time for e in self.events))
+        self.end_times = array("q", (e.end_time for e in self.events))
+        # Running max of the end times: every event before the first index
+        # where it reaches now has already ended
+        self.max_ends = array("q")
+        max_end = None
+        for end_time in self.end_times:
+            max_end = end_time if max_end is None else max(max_end, end_time)
+            self.max_ends.append(max_end)
+
+    def __len__(self) -> int:
+        return len(self.events)
+
+    def is_allday(self, i: int) -> bool:
+        if self.allday[i] == UNKNOWN:
+            self.allday[i] = self.events[i].is_allday()
+        return bool(self.allday[i])
+
+    def first_not_ended(self, now: float) -> int:
+        # Every event before this index ended before now
+        return bisect_left(self.max_ends, now)
+
+    def future(
+        self,
+        hide_event_after: int,
+        show_event_before: int,
+        now: Optional[float] = None,
+        until: Optional[float] = None,
+    ) -> Iterator[Event]:
+        # Same events as get_future_events, by start time. until excludes the
+        # events starting at or after it.
+        if now is None:
+            now = time.time()
+
+        lo = self.first_not_ended(now)
+        if hide_event_after > MIN_DELAY:
+            lo = max(
+                lo,
+                bisect_left(
+                    self.start_times,
+                    now - SECONDS_PER_MINUTE * hide_event_after,
+                ),
+            )
+        hi = len(self.events)
+        if show_event_before > MIN_DELAY:
+            hi = bisect_right(
+                self.start_times, now + SECONDS_PER_MINUTE * show_event_before
+            )
+        if until is not None:
+            hi = min(hi, bisect_left(self.start_times, until))
+
+        for i in range(lo, hi):
+            if self.end_times[i] < now or self.is_allday(i):
+                continue
+            yield self.events[i]
+
+    def closest(
+        self,
+        hide_event_after: int,
+        show_event_before: int,
+        skip: int = 0,
+        now: Optional[float] = None,
+        until: Optional[float] = None,
+    ) -> Optional[Event]:
+        # The skip-th upcoming event, without looking at the ones after it
+        for event in self.future(
+            hide_event_after, show_event_before, now, until
+        ):
+            if skip == 0:
+                return event
+            skip -= 1
+        return None
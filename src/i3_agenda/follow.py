@@ -0,0 +1,79 @@
+import argparse
+import json
+import sys
+import time
+from typing import Callable, TextIO
+
+from i3_agenda import timings
+from i3_agenda.event_index import EventIndex
+from i3_agenda.main import load_events, refresh_interval
+from i3_agenda.timeline import Timeline
+
+# Predicates compare with strict inequalities against whole seconds, wake up a
+# bit after a boundary so that it is already crossed
+WAKEUP_MARGIN = 0.05
+
+
+def write_i3bar_header(out: TextIO):
+    out.write(json.dumps({"version": 1}) + "\n[\n")
+
+
+def write_i3bar_block(out: TextIO, text: str, urgent: bool, first: bool):
+    block = [{"name": "i3-agenda", "full_text": text, "urgent": urgent}]
+    out.write(("" if first else ",") + json.dumps(block) + "\n")
+
+
+def follow(
+    args,
+    out: TextIO = sys.stdout,
+    sleep: Callable[[float], None] = time.sleep,
+):
+    index = EventIndex(load_events(args))
+    refresh_at = time.time() + refresh_interval(args)
+    timeline = None
+    # Later refreshes go through the cache, another instance may have
+    # refreshed it already
+    refresh_args = argparse.Namespace(**vars(args))
+    refresh_args.update = False
+
+    if args.i3bar:
+        write_i3bar_header(out)
+
+    last = None
+    while True:
+        now = time.time()
+        if now >= refresh_at:
+            try:
+                with timings.phase("load events"):
+                    index = EventIndex(load_events(refresh_args))
+            except Exception as e:
+                # Keep showing the previous events until the next try
+                print(f"Failed to refresh events: {e}", file=sys.stderr)
+            timings.flush()
+            refresh_at = now + refresh_interval(args)
+            timeline = None
+
+        if timeline is None or not timeline.covers(now):
+            # Everything to show until the next refresh
+            with timings.phase("timeline"):
+                timeline = Timeline.build(
+                    args, index, now, max(refresh_at, now + 1)
+                )
+
+        segment = timeline.at(now)
+        if segment is None:
+            text, urgent = args.no_event_text, False
+        else:
+            text, urgent = segment.render(now), segment.urgent
+        # Plain lines have no way to show urgency, only the text matters
+        current = (text, urgent) if args.i3bar else text
+        if current != last:
+            if args.i3bar:
+                write_i3bar_block(out, text, urgent, last is None)
+            else:
+                out.write(text + "\n")
+            out.flush()
+            last = current
+
+        wakeup = min(timeline.next_change(now), refresh_at)
+        sleep(max(0, wakeup - time.time()) + WAKEUP_MARGIN)
@@ -27,25 +27,50 @@ def human_delta(tdelta: dt.timedelta) -> str:
     return fmt.format(d=duration)
 
 
-def make_tz_backward_compatible(full_time: str) -> str:
-    # Python introduced the ability to parse ":" in the timezone format (in strptime()) only from version 3.7 and up.
-    # We need to remove the : before the timezone to support older versions
-    # See https://stackoverflow.com/questions/30999230/how-to-parse-timezone-with-colon for more information
-    if full_time[-3] == ":":
-        full_time = full_time[:-3] + full_time[-2:]
-    return full_time
+EPOCH_ORDINAL = dt.date(1970, 1, 1).toordinal()
 
 
 def get_unix_time(full_time: str) -> float:
-    if "T" in full_time:
-        event_time_format = "%Y-%m-%dT%H:%M:%S%z"
-    else:
-        event_time_format = "%Y-%m-%d"
+    # Parses the two forms the Calendar API uses: "2022-12-05T15:00:00+01:00"
+    # (or "Z", or an offset without ":") and all day "2022-12-05", which is
+    # midnight local time
+    if len(full_time) == 10:
+        return time.mktime(
+            (
+                int(full_time[0:4]),
+                int(full_time[5:7]),
+                int(full_time[8:10]),
+                0,
+                0,
+                0,
+                0,
+                0,
+                -1,
+            )
+        )
 
-    full_time = make_tz_backward_compatible(full_time)
-
-    return time.mktime(
-        dt.datetime.strptime(full_time, event_time_format)
-        .astimezone()
-        .timetuple()
+    if full_time[10] != "T" or len(full_time) < 20:
+        raise ValueError(f"Invalid time: {full_time}")
+    days = (
+        dt.date(
+            int(full_time[0:4]), int(full_time[5:7]), int(full_time[8:10])
+        ).toordinal()
+        - EPOCH_ORDINAL
+    )
+    seconds = (
+        int(full_time[11:13]) * SECONDS_PER_HOUR
+        + int(full_time[14:16]) * SECONDS_PER_MINUTE
+        + int(full_time[17:19])
     )
+
+    zone = full_time[19:]
+    if zone != "Z":
+        if zone[0] not in "+-" or len(zone) not in (5, 6):
+            raise ValueError(f"Invalid time zone: {full_time}")
+        offset = (
+            int(zone[1:3]) * SECONDS_PER_HOUR
+            + int(zone[-2:]) * SECONDS_PER_MINUTE
+        )
+        seconds -= offset if zone[0] == "+" else -offset
+
+    return float(days * SECONDS_PER_DAY + seconds)
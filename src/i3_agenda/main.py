@@ -1,98 +1,480 @@
 from __future__ import print_function
 
-import subprocess
-from i3_agenda import config
+import sys
+import time
+from itertools import islice
+from i3_agenda import config, timings
 
-from typing import List, Optional
-import datetime
+from typing import Dict, List, Optional, Sequence, Tuple
 
-from i3_agenda.event import Event, get_closest, sort_events, get_future_events
+from i3_agenda.event import Event, RenderContext, render_context
+from i3_agenda.event_index import EventIndex
+from i3_agenda.query import Query, events_query
 
 from typing import Union
 from i3_agenda.const import (
     LEFT_MOUSE_BUTTON,
+    MIN_REFRESH_MINUTES,
+    REFRESH_RETRY_MINUTES,
     RIGHT_MOUSE_BUTTON,
+    SECONDS_PER_MINUTE,
 )
 
 DEFAULT_CAL_WEBPAGE = "https://calendar.google.com/calendar/r/day"
 
 
-def button_action(button_code: str, closest: Event):
+def button_action(button_code: str, location: Optional[str]) -> Optional[str]:
     if button_code != "":
+        import subprocess
+
         if button_code == LEFT_MOUSE_BUTTON:
-            print("Opening calendar page...")
             subprocess.Popen(["xdg-open", DEFAULT_CAL_WEBPAGE])
+            return "Opening calendar page..."
         elif button_code == RIGHT_MOUSE_BUTTON:
-            if closest.location:
-                print("Opening location link...")
-                subprocess.Popen(["xdg-open", closest.location])
-
-
-def filter_only_todays_events(events: List[Event]) -> Optional[List[Event]]:
-    now = datetime.datetime.now()
-    midnight_rfc3339 = now.replace(hour=23, minute=59, second=59)
-    return list(
-        filter(
-            lambda event: datetime.datetime.fromtimestamp(event.start_time)
-            < midnight_rfc3339,
-            events,
+            if location:
+                subprocess.Popen(["xdg-open", location])
+                return "Opening location link..."
+    return None
+
+
+def query_cache_keys(args) -> List[str]:
+    from i3_agenda.cache_utils import cache_keys
+
+    return cache_keys(
+        args.ids,
+        args.maxres,
+        args.today,
+        args.incremental,
+        args.lookahead,
+        args.expand_recurring,
+    )
+
+
+def refresh_interval(args) -> float:
+    # Seconds between the refreshes of the long running modes
+    return max(args.cachettl, MIN_REFRESH_MINUTES) * SECONDS_PER_MINUTE
+
+
+def fetch_events(args) -> List[Event]:
+    from i3_agenda.api import flatten
+    from i3_agenda.cache_utils import entry_fetched_at, save_cache
+
+    results, window_end = fetch_events_by_calendar(events_query(args))
+    events = flatten(results)
+    failed = [calendar is None for calendar in results.values()]
+    if failed and all(failed):
+        # Nothing to cache, fetched again on the next run
+        return events
+    if any(failed):
+        # Without the calendars that failed, so kept until they are retried
+        # instead of the TTL. One that always fails doesn't turn caching off.
+        retry_at = time.time() + REFRESH_RETRY_MINUTES * SECONDS_PER_MINUTE
+        window_end = min(window_end or retry_at, retry_at)
+
+    key = query_cache_keys(args)[0]
+    save_cache(events, key, args.cache_format, args.cache_entries, window_end)
+    fetched_at = entry_fetched_at(key, args.cache_format)
+    if fetched_at is not None:
+        # Also with --list, so that the end of the time window is known when
+        # timelines are built for the entry later
+        save_query_timeline(args, events, fetched_at, window_end)
+    return events
+
+
+def fresh_entry(args) -> Optional[float]:
+    # When the cache entry of the query was fetched, if it is still fresh
+    from i3_agenda.cache_utils import entry_fetched_at, is_expired
+
+    fetched_at = entry_fetched_at(query_cache_keys(args)[0], args.cache_format)
+    if fetched_at is None or is_expired(fetched_at, args.cachettl):
+        return None
+    return fetched_at
+
+
+def timeline_end(
+    args, fetched_at: float, window_end: Optional[float]
+) -> float:
+    # Timelines of the cache entry fetched at fetched_at are valid until it
+    # expires, or its time window ends
+    end = fetched_at + args.cachettl * SECONDS_PER_MINUTE
+    return end if window_end is None else min(end, window_end)
+
+
+def save_query_timeline(
+    args,
+    events: List[Event],
+    fetched_at: float,
+    window_end: Optional[float] = None,
+):
+    # What to show until the cache entry of the query, fetched at fetched_at,
+    # is no longer valid
+    from i3_agenda.cache_utils import save_timelines
+    from i3_agenda.timeline import Timeline, timeline_config
+
+    now = time.time()
+    end = timeline_end(args, fetched_at, window_end)
+    timelines = {}
+    if not args.list and end > now:
+        with timings.phase("timeline"):
+            timelines[timeline_config(args)] = Timeline.build(
+                args, EventIndex(events), now, end
+            )
+    save_timelines(
+        query_cache_keys(args)[0], fetched_at, timelines, window_end
+    )
+
+
+def add_query_timeline(args, events: List[Event], fetched_at: float):
+    # For flags the cache entry fetched at fetched_at has no timeline for yet.
+    # Entries whose time window is not known get one when refreshed.
+    from i3_agenda.cache_utils import load_timelines_file
+
+    raw = load_timelines_file(query_cache_keys(args)[0], fetched_at)
+    if raw is not None:
+        save_query_timeline(args, events, fetched_at, raw.get("window_end"))
+
+
+def show_from_timeline(args, fetched_at: float, now: float) -> bool:
+    # Prints what the timeline of the cache entry fetched at fetched_at has
+    # for now, if there is one. Nothing needs to be loaded or rendered then.
+    from i3_agenda.cache_utils import load_timeline
+    from i3_agenda.timeline import timeline_config
+
+    timeline = load_timeline(
+        query_cache_keys(args)[0], fetched_at, timeline_config(args)
+    )
+    if timeline is None or not timeline.covers(now):
+        return False
+
+    segment = timeline.at(now)
+    if segment is None:
+        print(args.no_event_text)
+        return True
+    show(segment.render(now), segment.location, segment.urgent)
+    return True
+
+
+def show(text: str, location: Optional[str], urgent: bool):
+    message = button_action(config.button, location)
+    if message:
+        print(message)
+
+    print(text)
+
+    if urgent:
+        # special i3blocks exit code to set the block urgent
+        exit(33)
+
+
+def fetch_events_by_calendar(
+    query: Query,
+) -> Tuple[Dict[str, Optional[List[Event]]], Optional[float]]:
+    # The Google client libraries are slow to import, only pay for them when
+    # actually talking to the API
+    with timings.phase("import api"):
+        from i3_agenda.api import get_events_by_calendar
+
+    with timings.phase("fetch"):
+        return get_events_by_calendar(query)
+
+
+def spawn_refresh():
+    import subprocess
+
+    # Detached from the bar so that it doesn't wait for it
+    subprocess.Popen(
+        [sys.executable, "-m", "i3_agenda.main"]
+        + sys.argv[1:]
+        + ["--refresh-only"],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def refresh_cache(args):
+    from i3_agenda.cache_utils import (
+        load_cache,
+        record_failed_refresh,
+        refresh_lock,
+    )
+
+    with refresh_lock(blocking=False) as locked:
+        if not locked:
+            # Someone else is already on it
+            return
+        keys = query_cache_keys(args)
+        if load_cache(args.cachettl, keys, args.cache_format) is not None:
+            return
+        try:
+            fetch_events(args)
+        finally:
+            # Nothing was cached if it raised or if a calendar failed
+            if load_cache(args.cachettl, keys, args.cache_format) is None:
+                record_failed_refresh()
+
+
+def load_sharded_events(args) -> List[Event]:
+    from i3_agenda.cache_utils import (
+        load_calendar_list,
+        load_shard,
+        refresh_lock,
+        shard_key,
+    )
+
+    query = events_query(args)
+    ttls = dict(args.calendar_ttl)
+
+    def key(calendar_id):
+        return shard_key(
+            calendar_id,
+            args.maxres,
+            args.today,
+            args.incremental,
+            args.lookahead,
+            args.expand_recurring,
         )
+
+    def split(calendar_ids):
+        # Events of the calendars that are still fresh, and the expired ids
+        events, expired = [], []
+        for calendar_id in calendar_ids:
+            shard = None
+            if not args.update:
+                shard = load_shard(
+                    key(calendar_id),
+                    ttls.get(calendar_id, args.cachettl),
+                    args.cache_format,
+                )
+            if shard is None:
+                expired.append(calendar_id)
+            else:
+                events.extend(shard)
+        return events, expired
+
+    calendar_ids = args.ids or load_calendar_list(query.calendar_list_ttl)
+    if calendar_ids is None:
+        from i3_agenda.api import discover_calendars
+
+        calendar_ids = discover_calendars(
+            query.credentials, query.calendar_list_ttl, query.timeout
+        )
+
+    events, expired = split(calendar_ids)
+    if not expired:
+        return events
+
+    with refresh_lock():
+        # Some may have been refreshed while waiting for the lock
+        events, expired = split(calendar_ids)
+        if not expired:
+            return events
+        results, window_end = fetch_events_by_calendar(
+            query._replace(calendar_ids=expired)
+        )
+        for calendar_id in expired:
+            events.extend(
+                update_shard(
+                    args,
+                    key(calendar_id),
+                    results.get(calendar_id),
+                    window_end,
+                )
+            )
+
+    return events
+
+
+def update_shard(
+    args,
+    key: str,
+    calendar_events: Optional[List[Event]],
+    window_end: Optional[float],
+) -> Sequence[Event]:
+    # Saves what was fetched for a calendar, None when it failed
+    from i3_agenda.cache_utils import load_shard, save_shard
+
+    if calendar_events is None:
+        # Keep showing what we had for a calendar that failed
+        return load_shard(key, None, args.cache_format) or []
+    save_shard(key, calendar_events, args.cache_format, window_end)
+    return calendar_events
+
+
+def load_cached_events(args, keys: List[str]) -> Optional[List[Event]]:
+    # Events that can be shown without waiting for a refresh. A stale cache
+    # is refreshed in the background.
+    from i3_agenda.cache_utils import (
+        load_cache,
+        refresh_failed_recently,
+        refresh_lock,
     )
 
+    events = load_cache(args.cachettl, keys, args.cache_format)
+    if events is not None:
+        return events
+
+    stale_ttl = args.cachettl + args.max_stale if args.max_stale > 0 else None
+    with refresh_lock(blocking=False) as locked:
+        if not locked:
+            # Another instance is refreshing, show what it had until then
+            events = load_cache(stale_ttl, keys, args.cache_format)
+            if events is not None:
+                return events
+
+    if args.max_stale > 0:
+        events = load_cache(stale_ttl, keys, args.cache_format)
+        if events is not None:
+            if not refresh_failed_recently(REFRESH_RETRY_MINUTES):
+                spawn_refresh()
+            return events
+    return None
+
 
 def load_events(args) -> List[Event]:
-    from i3_agenda.api import get_events
-    from i3_agenda.cache_utils import load_cache, save_cache
+    from i3_agenda.cache_utils import load_cache, refresh_lock
+
+    if args.calendar_ttl:
+        return load_sharded_events(args)
 
     events: Union[None, list[Event]] = None
+    keys = query_cache_keys(args)
 
     if not args.update:
-        events = load_cache(args.cachettl)
-        if args.today:
-            if events:
-                events = filter_only_todays_events(events)
-
-    if events is None or args.update:
-        events = get_events(
-            args.credentials, args.ids, args.maxres, args.today
-        )
-        save_cache(events)
+        events = load_cached_events(args, keys)
+        if events is not None:
+            return events
+
+    with refresh_lock():
+        if not args.update:
+            # It may have been refreshed while waiting for the lock
+            events = load_cache(args.cachettl, keys, args.cache_format)
+            if events is not None:
+                return events
+
+        events = fetch_events(args)
+
     return events
 
 
+def render(
+    args,
+    events: Union[List[Event], EventIndex],
+    ctx: Optional[RenderContext] = None,
+) -> Tuple[str, Optional[Event]]:
+    ctx = ctx or render_context()
+    # Long running modes index their events once per refresh
+    index = events if isinstance(events, EventIndex) else EventIndex(events)
+
+    closest = index.closest(
+        args.hide_event_after,
+        args.show_event_before,
+        max(args.skip, 0),
+        now=ctx.timestamp,
+        until=ctx.end_of_today if args.today else None,
+    )
+    if closest is None:
+        return args.no_event_text, None
+
+    return format_event(args, closest, ctx), closest
+
+
+def render_list(
+    args,
+    events: Union[List[Event], EventIndex],
+    ctx: Optional[RenderContext] = None,
+) -> List[Tuple[str, Event]]:
+    # Every upcoming event (after --skip), all rendered against the same clock
+    ctx = ctx or render_context()
+    index = events if isinstance(events, EventIndex) else EventIndex(events)
+
+    upcoming = index.future(
+        args.hide_event_after,
+        args.show_event_before,
+        now=ctx.timestamp,
+        until=ctx.end_of_today if args.today else None,
+    )
+    return [
+        (format_event(args, event, ctx), event)
+        for event in islice(upcoming, max(args.skip, 0), None)
+    ]
+
+
+def format_event(args, event: Event, ctx: RenderContext) -> str:
+    return event.get_string(
+        args.limchar,
+        args.date_format,
+        args.ongoing_time_left,
+        args.next_event_time_left,
+        ctx,
+    )
+
+
 def main():
-    args = config.parser.parse_args()
+    args = config.get_parser().parse_args()
     config.CONF_DIR = args.conf
 
-    events = load_events(args)
+    with timings.record(timings.requested(args)):
+        run(args)
 
-    events = get_future_events(
-        events, args.hide_event_after, args.show_event_before
-    )
 
-    if args.skip > 0:
-        events = sort_events(events)
-        events = events[args.skip:]
+def run(args):
+    if args.refresh_only:
+        refresh_cache(args)
+        return
 
-    closest = get_closest(events)
-    if closest is None:
-        print(args.no_event_text)
+    if args.profiles:
+        from i3_agenda.profiles import render_profiles
+
+        render_profiles(args)
         return
 
-    button_action(config.button, closest)
+    if args.daemon:
+        from i3_agenda.daemon import run_daemon
 
-    print(
-        closest.get_string(
-            args.limchar,
-            args.date_format,
-            args.ongoing_time_left,
-            args.next_event_time_left,
-        )
-    )
+        run_daemon(args)
+        return
 
-    if closest.is_urgent():
-        # special i3blocks exit code to set the block urgent
-        exit(33)
+    if args.follow:
+        from i3_agenda.follow import follow
+
+        follow(args)
+        return
+
+    fetched_at = None
+    if not (args.list or args.update or args.calendar_ttl):
+        fetched_at = fresh_entry(args)
+    if fetched_at is not None:
+        with timings.phase("timeline"):
+            if show_from_timeline(args, fetched_at, time.time()):
+                return
+
+    with timings.phase("load events"):
+        events = load_events(args)
+    if fetched_at is not None:
+        # Built for the next renders
+        add_query_timeline(args, events, fetched_at)
+
+    show_events(args, events)
+
+
+def show_events(args, events: List[Event]):
+    ctx = render_context()
+    with timings.phase("render"):
+        if args.list:
+            rendered = render_list(args, events, ctx)
+            text = "\n".join(line for line, _ in rendered)
+            closest = rendered[0][1] if rendered else None
+        else:
+            text, closest = render(args, events, ctx)
+    if closest is None:
+        # An empty list is no lines, not a line saying there are none
+        if not args.list:
+            print(args.no_event_text)
+        return
+
+    show(text, closest.location, closest.is_urgent(ctx))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,212 @@
+# Renders several blocks from one invocation: every section of a --profiles
+# INI file is a set of display flags and where to write the result. The
+# events are loaded once for all of them, and not at all when the cached
+# timelines of every profile are there.
+import argparse
+import configparser
+import errno
+import json
+import os
+import stat
+import sys
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from i3_agenda import config, timings
+from i3_agenda.event_index import EventIndex
+from i3_agenda.main import (
+    fresh_entry,
+    load_events,
+    query_cache_keys,
+    timeline_end,
+)
+from i3_agenda.timeline import Segment, Timeline, segment_at, timeline_config
+
+# What a profile may set, the fetch related flags come from the command line
+# so that every profile is rendered from the same events
+VALUE_FLAGS = [
+    "no-event-text",
+    "hide-event-after",
+    "show-event-before",
+    "date-format",
+    "limchar",
+    "skip",
+]
+BOOLEAN_FLAGS = ["today", "ongoing-time-left", "next-event-time-left"]
+OUTPUT = "output"
+
+
+class Profile(NamedTuple):
+    name: str
+    args: argparse.Namespace
+    # Printed on stdout when None
+    output: Optional[str]
+
+
+def section_flags(
+    parser: argparse.ArgumentParser,
+    name: str,
+    section: configparser.SectionProxy,
+) -> Tuple[List[str], Dict[str, bool]]:
+    # The value flags of a profile as command line arguments, and its boolean
+    # flags by destination
+    argv = []
+    booleans = {}
+    for key, value in section.items():
+        if key in VALUE_FLAGS:
+            argv += [f"--{key}", value]
+        elif key in BOOLEAN_FLAGS:
+            try:
+                booleans[key.replace("-", "_")] = section.getboolean(key)
+            except ValueError:
+                parser.error(f"{key} of profile {name} is not a boolean")
+        elif key != OUTPUT:
+            parser.error(f"unknown option {key} in profile {name}")
+    return argv, booleans
+
+
+def load_profiles(path: str, args) -> List[Profile]:
+    parser = config.get_parser()
+    sections = configparser.ConfigParser(interpolation=None)
+    try:
+        with open(path, "r") as f:
+            sections.read_file(f)
+    except (OSError, configparser.Error) as e:
+        parser.error(f"invalid profiles file {path}: {e}")
+    if not sections.sections():
+        parser.error(f"no profiles in {path}")
+
+    profiles = []
+    for name in sections.sections():
+        section = sections[name]
+        argv, booleans = section_flags(parser, name, section)
+        # On top of the command line flags
+        profile_args = parser.parse_args(
+            argv, namespace=argparse.Namespace(**vars(args))
+        )
+        for dest, value in booleans.items():
+            setattr(profile_args, dest, value)
+        profiles.append(Profile(name, profile_args, section.get(OUTPUT)))
+    return profiles
+
+
+def cached_segments(
+    args, profiles: List[Profile], now: float
+) -> Dict[str, Optional[Segment]]:
+    # What every profile with a timeline in the cache shows at now
+    from i3_agenda.cache_utils import load_timelines, parse_timeline
+
+    fetched_at = fresh_entry(args)
+    if fetched_at is None:
+        return {}
+
+    timelines = load_timelines(query_cache_keys(args)[0], fetched_at)
+    segments = {}
+    for profile in profiles:
+        rows = timelines.get(timeline_config(profile.args))
+        timeline = None if rows is None else parse_timeline(rows)
+        if timeline is not None and timeline.covers(now):
+            segments[profile.name] = timeline.at(now)
+    return segments
+
+
+def rendered_segments(
+    args, profiles: List[Profile], index: EventIndex, now: float
+) -> Dict[str, Optional[Segment]]:
+    # What the profiles show at now, with their timelines saved for the next
+    # renders when the cache entry they come from is known
+    from i3_agenda.cache_utils import load_timelines_file, save_timelines
+
+    key = query_cache_keys(args)[0]
+    fetched_at = None if args.calendar_ttl else fresh_entry(args)
+    # Not known for the entries whose time window is not
+    raw = None if fetched_at is None else load_timelines_file(key, fetched_at)
+    end = 0.0
+    if raw is not None:
+        end = timeline_end(args, fetched_at, raw.get("window_end"))
+
+    segments = {}
+    timelines = {}
+    for profile in profiles:
+        if end <= now:
+            segments[profile.name] = segment_at(profile.args, index, now)
+            continue
+        timeline = Timeline.build(profile.args, index, now, end)
+        timelines[timeline_config(profile.args)] = timeline
+        segments[profile.name] = timeline.at(now)
+
+    if timelines:
+        save_timelines(key, fetched_at, timelines, raw.get("window_end"))
+    return segments
+
+
+def write_output(path: str, text: str):
+    # FIFOs are written without blocking, nobody may be reading them yet
+    try:
+        is_fifo = stat.S_ISFIFO(os.stat(path).st_mode)
+    except FileNotFoundError:
+        is_fifo = False
+
+    if not is_fifo:
+        from i3_agenda.cache_utils import atomic_write
+
+        with atomic_write(path) as f:
+            f.write(text + "\n")
+        return
+
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+    except OSError as e:
+        if e.errno == errno.ENXIO:
+            # No reader
+            return
+        raise
+    try:
+        os.write(fd, (text + "\n").encode())
+    except BlockingIOError:
+        # The reader is behind, it gets the next one
+        pass
+    finally:
+        os.close(fd)
+
+
+def render_profiles(args):
+    profiles = load_profiles(args.profiles, args)
+    now = time.time()
+
+    segments = {}
+    if not (args.update or args.calendar_ttl):
+        with timings.phase("timeline"):
+            segments = cached_segments(args, profiles, now)
+    missing = [p for p in profiles if p.name not in segments]
+    if missing:
+        with timings.phase("load events"):
+            index = EventIndex(load_events(args))
+        with timings.phase("render"):
+            segments.update(rendered_segments(args, missing, index, now))
+
+    blocks = []
+    for profile in profiles:
+        segment = segments[profile.name]
+        if segment is None:
+            text, urgent = profile.args.no_event_text, False
+        else:
+            text, urgent = segment.render(now), segment.urgent
+
+        if args.i3bar:
+            blocks.append(
+                {"name": profile.name, "full_text": text, "urgent": urgent}
+            )
+        elif profile.output is None:
+            print(text)
+        else:
+            try:
+                write_output(profile.output, text)
+            except OSError as e:
+                print(
+                    f"Failed to write profile {profile.name}: {e}",
+                    file=sys.stderr,
+                )
+
+    if args.i3bar:
+        print(json.dumps(blocks))
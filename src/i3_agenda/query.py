@@ -0,0 +1,46 @@
+# What to fetch from the API, built once from the command line flags
+from typing import List, NamedTuple
+
+from i3_agenda.const import (
+    DEFAULT_CALENDAR_LIST_TTL,
+    DEFAULT_CONCURRENCY,
+    DEFAULT_FETCH_TIMEOUT,
+    LOOKAHEAD_MIN_EVENTS,
+)
+
+
+class Query(NamedTuple):
+    credentials: str
+    # Every subscribed calendar when empty
+    calendar_ids: List[str]
+    max_results: int
+    today_only: bool = False
+    concurrency: int = DEFAULT_CONCURRENCY
+    timeout: float = DEFAULT_FETCH_TIMEOUT
+    incremental: bool = False
+    calendar_list_ttl: int = DEFAULT_CALENDAR_LIST_TTL
+    batch_size: int = 0
+    # Hours of the first --lookahead window, and the upcoming events it
+    # should hold at least
+    lookahead: int = 0
+    min_events: int = 1
+    # Days to expand recurring events over, 0 to let the API do it
+    expand_recurring: int = 0
+
+
+def events_query(args) -> Query:
+    return Query(
+        args.credentials,
+        args.ids,
+        args.maxres,
+        args.today,
+        args.concurrency,
+        args.fetch_timeout,
+        args.incremental,
+        # --update also looks for new calendars
+        0 if args.update else args.calendar_list_ttl,
+        args.batch_size,
+        args.lookahead,
+        max(LOOKAHEAD_MIN_EVENTS, args.skip + 1),
+        args.expand_recurring,
+    )
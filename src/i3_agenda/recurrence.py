@@ -0,0 +1,133 @@
+# Recurring events can be fetched once (singleEvents=False) instead of as
+# every one of their occurrences, and expanded here. The API then returns the
+# recurring events with their RRULE, RDATE and EXDATE lines, the instances that
+# were moved or edited (with the id of their recurring event and the start
+# they replace) and the instances that were cancelled.
+import datetime as dt
+import re
+import sys
+from typing import Any, Dict, Iterator, List, Tuple
+
+from dateutil import rrule, tz
+from dateutil.parser import isoparse
+
+from i3_agenda.const import SECONDS_PER_DAY
+from i3_agenda.helpers import get_unix_time
+
+Item = Dict[str, Any]
+
+UNTIL_REGEX = re.compile(r"UNTIL=(\d{8})(T\d{6})?Z?")
+
+
+def event_time(value: Item) -> str:
+    return value.get("dateTime", value.get("date"))
+
+
+def start_time(item: Item, key: str = "start") -> float:
+    return get_unix_time(event_time(item[key]))
+
+
+def is_over(item: Item, now: float) -> bool:
+    # Whether an item has nothing left to show. Recurring events may go on
+    # whenever their first occurrence was, instances are kept for a day after
+    # the occurrence they replace started since its end is not known.
+    if item.get("recurrence"):
+        return False
+    ends = []
+    if "end" in item:
+        ends.append(start_time(item, "end"))
+    if "originalStartTime" in item:
+        ends.append(start_time(item, "originalStartTime") + SECONDS_PER_DAY)
+    return bool(ends) and max(ends) < now
+
+
+def local_time(value: Item) -> dt.datetime:
+    # Naive for all day events. Otherwise in the time zone of the event, so
+    # that the occurrences keep their wall clock time across DST changes.
+    if "date" in value:
+        return dt.datetime.strptime(value["date"], "%Y-%m-%d")
+    moment = isoparse(value["dateTime"])
+    zone = tz.gettz(value["timeZone"]) if value.get("timeZone") else None
+    return moment.astimezone(zone) if zone is not None else moment
+
+
+def normalize_until(line: str, aware: bool) -> str:
+    # dateutil wants UNTIL in UTC with a time zone aware start, and in local
+    # time with a naive one, the API is not as strict
+    def replace(match):
+        if aware:
+            return f"UNTIL={match.group(1)}{match.group(2) or 'T235959'}Z"
+        return f"UNTIL={match.group(1)}{match.group(2) or ''}"
+
+    return UNTIL_REGEX.sub(replace, line)
+
+
+def as_value(moment: dt.datetime, all_day: bool) -> Item:
+    if all_day:
+        return {"date": moment.strftime("%Y-%m-%d")}
+    return {"dateTime": moment.isoformat()}
+
+
+def occurrences(
+    item: Item, time_min: float, time_max: float
+) -> Iterator[Item]:
+    # Every occurrence of a recurring event that overlaps (time_min, time_max)
+    start = local_time(item["start"])
+    duration = local_time(item["end"]) - start
+    all_day = "date" in item["start"]
+    aware = start.tzinfo is not None
+
+    try:
+        rules = rrule.rrulestr(
+            "\n".join(
+                normalize_until(line, aware) for line in item["recurrence"]
+            ),
+            dtstart=start,
+            forceset=True,
+        )
+    except (ValueError, TypeError) as e:
+        print(
+            f"Failed to expand recurring event {item.get('id')}: {e}",
+            file=sys.stderr,
+        )
+        yield item
+        return
+
+    zone = dt.timezone.utc if aware else None
+    after = dt.datetime.fromtimestamp(time_min, zone) - duration
+    before = dt.datetime.fromtimestamp(time_max, zone)
+    if not aware:
+        after, before = after.replace(tzinfo=None), before.replace(tzinfo=None)
+    for moment in rules.between(after, before, inc=True):
+        occurrence = dict(item)
+        occurrence["start"] = as_value(moment, all_day)
+        occurrence["end"] = as_value(moment + duration, all_day)
+        yield occurrence
+
+
+def expand(items: List[Item], time_min: float, time_max: float) -> List[Item]:
+    # The single events, and the occurrences of the recurring events between
+    # time_min and time_max with the instances that replace them
+    exceptions: Dict[Tuple[str, float], Item] = {}
+    recurring = []
+    events = []
+    for item in items:
+        if item.get("recurrence"):
+            recurring.append(item)
+        elif item.get("recurringEventId") and item.get("originalStartTime"):
+            key = (
+                item["recurringEventId"],
+                start_time(item, "originalStartTime"),
+            )
+            exceptions[key] = item
+        else:
+            events.append(item)
+
+    for item in recurring:
+        for occurrence in occurrences(item, time_min, time_max):
+            key = (item.get("id"), start_time(occurrence))
+            events.append(exceptions.pop(key, occurrence))
+    # Instances moved here from an occurrence outside of the window
+    events.extend(exceptions.values())
+
+    return [item for item in events if item.get("status") != "cancelled"]
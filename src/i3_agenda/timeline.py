@@ -0,0 +1,206 @@
+# What the bar shows only changes at a few known instants: events starting
+# and ending, entering and leaving the urgency and display windows, and
+# midnight moving the date labels. A timeline renders the text once for every
+# stretch of time between them, so that showing it is a bisection.
+import datetime as dt
+import json
+import time
+from bisect import bisect_right
+from typing import Any, Iterator, List, NamedTuple, Optional, Tuple
+
+from i3_agenda.const import (
+    MIN_DELAY,
+    SECONDS_PER_MINUTE,
+    URGENT_DELAY_MN,
+)
+from i3_agenda.event import render_context
+from i3_agenda.event_index import EventIndex
+from i3_agenda.helpers import human_delta
+
+# Predicates compare instants with strict and non-strict inequalities, so an
+# instant may render differently from the time right before and right after
+# it. A segment starts either at an instant (AT) or right after it (AFTER).
+AT = 0
+AFTER = 1
+
+
+class Segment(NamedTuple):
+    text: str
+    # With the countdown modes the time left until countdown goes between
+    # text and suffix
+    countdown: Optional[int]
+    suffix: str
+    urgent: bool
+    location: Optional[str]
+
+    def render(self, now: float) -> str:
+        if self.countdown is None:
+            return self.text
+        time_left = dt.timedelta(seconds=self.countdown - now)
+        return f"{self.text}{human_delta(time_left)}{self.suffix}"
+
+
+def next_midnight(now: float) -> float:
+    tomorrow = dt.date.fromtimestamp(now) + dt.timedelta(days=1)
+    return dt.datetime.combine(tomorrow, dt.time(0)).timestamp()
+
+
+def timeline_config(args) -> str:
+    # The flags that change what the bar shows, and the time zone the labels
+    # are in. --no-event-text is left out, it is applied when rendering.
+    return json.dumps(
+        [
+            args.hide_event_after,
+            args.show_event_before,
+            max(args.skip, 0),
+            args.today,
+            args.limchar,
+            args.date_format,
+            args.ongoing_time_left,
+            args.next_event_time_left,
+            time.timezone,
+            time.altzone,
+            list(time.tzname),
+        ]
+    )
+
+
+def change_instants(
+    args, index: EventIndex, start: float, end: float
+) -> Iterator[float]:
+    # Every instant in (start, end) at which what is shown may change
+    urgent_delay = URGENT_DELAY_MN * SECONDS_PER_MINUTE
+    hide_after = show_before = None
+    if args.hide_event_after > MIN_DELAY:
+        hide_after = args.hide_event_after * SECONDS_PER_MINUTE
+    if args.show_event_before > MIN_DELAY:
+        show_before = args.show_event_before * SECONDS_PER_MINUTE
+
+    midnight = next_midnight(start)
+    while midnight < end:
+        yield midnight
+        midnight = next_midnight(midnight)
+
+    # Events that end before start or begin long after end change nothing
+    last_start = end + max(urgent_delay, show_before or 0)
+    for i in range(index.first_not_ended(start), len(index)):
+        if index.start_times[i] > last_start:
+            break
+        if index.is_allday(i):
+            continue
+        event = index.events[i]
+        yield from (
+            event.start_time,
+            event.end_time,
+            event.start_time - urgent_delay,
+            event.start_time + urgent_delay,
+        )
+        if show_before is not None:
+            yield event.start_time - show_before
+        if hide_after is not None:
+            yield event.start_time + hide_after
+
+
+def segment_at(args, index: EventIndex, now: float) -> Optional[Segment]:
+    # What render shows at now, None when there is no event to show
+    ctx = render_context(now)
+    closest = index.closest(
+        args.hide_event_after,
+        args.show_event_before,
+        max(args.skip, 0),
+        now=now,
+        until=ctx.end_of_today if args.today else None,
+    )
+    if closest is None:
+        return None
+    text, countdown, suffix = closest.get_template(
+        args.limchar,
+        args.date_format,
+        args.ongoing_time_left,
+        args.next_event_time_left,
+        ctx,
+    )
+    return Segment(
+        text, countdown, suffix, closest.is_urgent(ctx), closest.location
+    )
+
+
+class Timeline:
+    def __init__(
+        self,
+        starts: List[Tuple[float, int]],
+        segments: List[Optional[Segment]],
+        end: float,
+    ):
+        # segments[i] is shown from starts[i] (AT or AFTER it) until the next
+        # one starts, and the last one until end
+        self.starts = starts
+        self.segments = segments
+        self.end = end
+
+    @classmethod
+    def build(
+        cls, args, index: EventIndex, start: float, end: float
+    ) -> "Timeline":
+        instants = sorted(
+            {
+                instant
+                for instant in change_instants(args, index, start, end)
+                if start < instant < end
+            }
+        )
+        bounds = [start] + instants + [end]
+
+        starts: List[Tuple[float, int]] = []
+        segments: List[Optional[Segment]] = []
+        for instant, following in zip(bounds, bounds[1:]):
+            # The instant itself, then everything up to the next one
+            for key, sample in [
+                ((instant, AT), instant),
+                ((instant, AFTER), (instant + following) / 2),
+            ]:
+                segment = segment_at(args, index, sample)
+                if not segments or segment != segments[-1]:
+                    starts.append(key)
+                    segments.append(segment)
+        return cls(starts, segments, end)
+
+    def covers(self, now: float) -> bool:
+        return bool(self.starts) and self.starts[0][0] <= now < self.end
+
+    def position(self, now: float) -> int:
+        return bisect_right(self.starts, (now, AT)) - 1
+
+    def at(self, now: float) -> Optional[Segment]:
+        # Only meaningful for the instants the timeline covers
+        return self.segments[self.position(now)]
+
+    def next_change(self, now: float) -> float:
+        # When the segment shown at now ends, every second for countdowns
+        i = self.position(now)
+        if i + 1 < len(self.starts):
+            change = self.starts[i + 1][0]
+        else:
+            change = self.end
+        segment = self.segments[i]
+        if segment is not None and segment.countdown is not None:
+            change = min(change, int(now) + 1)
+        return change
+
+    def rows(self) -> List[Any]:
+        return [
+            self.end,
+            [
+                [instant, side] + (list(segment) if segment else [])
+                for (instant, side), segment in zip(self.starts, self.segments)
+            ],
+        ]
+
+    @classmethod
+    def from_rows(cls, rows: List[Any]) -> "Timeline":
+        end, segments = rows
+        return cls(
+            [(row[0], row[1]) for row in segments],
+            [Segment(*row[2:]) if len(row) > 2 else None for row in segments],
+            end,
+        )
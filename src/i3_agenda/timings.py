@@ -0,0 +1,164 @@
+# Opt-in instrumentation (--timings or I3_AGENDA_PROFILE) to find out where
+# the time of a slow refresh or render goes. Every run (every refresh of the
+# long running modes) is appended as one JSON line to TIMINGS_FILE in the conf
+# dir, with the wall and CPU time of each phase and the latency and size of
+# each request to the API. Phases may nest, e.g. "parse" happens during
+# "fetch". Everything here is a no-op unless recording.
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from i3_agenda import config
+from i3_agenda.const import MAX_TIMINGS_LOG_BYTES
+
+PROFILE_ENV = "I3_AGENDA_PROFILE"
+# Value of PROFILE_ENV that also dumps cProfile stats
+CPROFILE = "cprofile"
+TIMINGS_FILE = "i3agenda_timings.log"
+PROFILE_FILE = "i3agenda_profile.prof"
+
+_recording = False
+_phases: List[Dict[str, Any]] = []
+_requests: List[Dict[str, Any]] = []
+_lock = threading.Lock()
+# Bytes received by the request the current thread is timing
+_local = threading.local()
+
+
+def recording() -> bool:
+    return _recording
+
+
+def requested(args) -> Optional[str]:
+    # None, "timings" or CPROFILE
+    env = os.environ.get(PROFILE_ENV, "")
+    if args.profile or env == CPROFILE:
+        return CPROFILE
+    if args.timings or env not in ("", "0"):
+        return "timings"
+    return None
+
+
+def milliseconds(seconds: float) -> float:
+    return round(seconds * 1000, 3)
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    if not _recording:
+        yield
+        return
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        # CPU time is the whole process', so it includes the other threads
+        record = {
+            "phase": name,
+            "wall_ms": milliseconds(time.perf_counter() - wall),
+            "cpu_ms": milliseconds(time.process_time() - cpu),
+        }
+        with _lock:
+            _phases.append(record)
+
+
+def count_bytes(size: int):
+    if _recording:
+        _local.bytes = getattr(_local, "bytes", 0) + size
+
+
+def timed(fetch: Callable[[Any], Any]) -> Callable[[Any], Any]:
+    # Records the latency and bytes received of every call of a
+    # fetch_calendars fetch function, keyed by calendar (or batch of them)
+    if not _recording:
+        return fetch
+
+    def timed_fetch(key):
+        _local.bytes = 0
+        start = time.perf_counter()
+        ok = False
+        try:
+            result = fetch(key)
+            ok = True
+            return result
+        finally:
+            record = {
+                "calendar": ",".join(key) if isinstance(key, tuple) else key,
+                "ms": milliseconds(time.perf_counter() - start),
+                "bytes": _local.bytes,
+                "ok": ok,
+            }
+            with _lock:
+                _requests.append(record)
+
+    return timed_fetch
+
+
+def flush():
+    # Appends what was recorded since the last flush to the log
+    if not _recording:
+        return
+
+    with _lock:
+        line = {
+            "time": round(time.time(), 3),
+            "pid": os.getpid(),
+            "argv": sys.argv[1:],
+            "phases": list(_phases),
+            "requests": list(_requests),
+        }
+        _phases.clear()
+        _requests.clear()
+
+    path = os.path.join(config.CONF_DIR, TIMINGS_FILE)
+    try:
+        os.makedirs(config.CONF_DIR, exist_ok=True)
+        if os.path.getsize(path) > MAX_TIMINGS_LOG_BYTES:
+            os.replace(path, path + ".1")
+    except OSError:
+        pass
+    try:
+        with open(path, "a") as f:
+            f.write(json.dumps(line) + "\n")
+    except OSError as e:
+        print(f"Failed to write timings: {e}", file=sys.stderr)
+
+
+@contextmanager
+def record(mode: Optional[str]) -> Iterator[None]:
+    # Records everything run in it when mode is set (see requested)
+    global _recording
+    if mode is None:
+        yield
+        return
+
+    profiler = None
+    if mode == CPROFILE:
+        import cProfile
+
+        profiler = cProfile.Profile()
+
+    _recording = True
+    # CPU time spent before this, mostly importing modules
+    _phases.append(
+        {
+            "phase": "startup",
+            "wall_ms": None,
+            "cpu_ms": milliseconds(time.process_time()),
+        }
+    )
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(config.CONF_DIR, PROFILE_FILE))
+        flush()
+        _recording = False
@@ -0,0 +1,34 @@
+import datetime as dt
+
+import pytest
+
+from i3_agenda import cache_utils
+from i3_agenda.event import Event
+
+
+@pytest.fixture
+def conf_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache_utils, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(cache_utils, "LOCK_PATH", str(tmp_path / "cache.lock"))
+    monkeypatch.setattr(
+        cache_utils, "REFRESH_FAILED_PATH", str(tmp_path / "refresh_failed")
+    )
+    monkeypatch.setattr(
+        cache_utils, "CALENDAR_LIST_PATH", str(tmp_path / "calendars.json")
+    )
+    return tmp_path
+
+
+def timestamp(value: str) -> float:
+    return dt.datetime.strptime(value, "%Y-%m-%d %H:%M:%S").timestamp()
+
+
+def new_event(
+    start_time: str, end_time: str, summary="summary", location=None
+) -> Event:
+    return Event(
+        summary,
+        int(timestamp(start_time)),
+        int(timestamp(end_time)),
+        location,
+    )
@@ -0,0 +1,653 @@
+import datetime as dt
+import json
+import threading
+import time
+from urllib.parse import quote
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpMockSequence
+
+from i3_agenda import api, cache_utils
+from i3_agenda.api import (
+    fetch_calendars,
+    flatten,
+    get_all_calendar_events,
+    get_batched_calendar_events,
+    get_callendar_ids,
+    get_windowed_calendar_events,
+    sync_calendar,
+    sync_calendar_list,
+)
+from i3_agenda.query import Query
+
+
+def test_fetch_calendars_runs_in_parallel():
+    def fetch(calendar_id):
+        time.sleep(0.2)
+        return calendar_id
+
+    calendar_ids = [f"cal{i}" for i in range(5)]
+    start = time.perf_counter()
+    results = fetch_calendars(calendar_ids, fetch, concurrency=5)
+    elapsed = time.perf_counter() - start
+
+    assert results == {
+        calendar_id: calendar_id for calendar_id in calendar_ids
+    }
+    # About the time of the slowest calendar, not the sum of all of them
+    assert elapsed < 0.6
+
+
+def test_fetch_calendars_respects_concurrency():
+    lock = threading.Lock()
+    running = [0]
+    peak = [0]
+
+    def fetch(calendar_id):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+        return calendar_id
+
+    fetch_calendars([f"cal{i}" for i in range(8)], fetch, concurrency=2)
+    assert peak[0] <= 2
+
+
+def test_fetch_calendars_partial_results():
+    def fetch(calendar_id):
+        if calendar_id == "broken":
+            raise TimeoutError("timed out")
+        return calendar_id
+
+    results = fetch_calendars(["ok", "broken", "other"], fetch)
+    assert results == {"ok": "ok", "other": "other"}
+
+
+class FakeRequest:
+    def __init__(self, items, next_page_token=None):
+        self.items = items
+        self.next_page_token = next_page_token
+
+    def execute(self, http=None):
+        if isinstance(self.items, Exception):
+            raise self.items
+        if self.next_page_token:
+            return {"items": self.items, "nextPageToken": self.next_page_token}
+        return {"items": self.items}
+
+
+class FakeEvents:
+    def __init__(self, calendars):
+        self.calendars = calendars
+
+    def list(self, calendarId, **kwargs):
+        return FakeRequest(self.calendars[calendarId])
+
+
+class FakeBatch:
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self, http=None):
+        self.service.batches.append(len(self.requests))
+        for request_id, request in self.requests:
+            try:
+                self.callback(request_id, request.execute(), None)
+            except HttpError as e:
+                self.callback(request_id, None, e)
+
+
+class FakeService:
+    def __init__(self, calendars):
+        self.calendars = calendars
+        self.batches = []
+
+    def events(self):
+        return FakeEvents(self.calendars)
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self, callback)
+
+
+def event_json(summary, start, end):
+    return {
+        "summary": summary,
+        "start": {"dateTime": start},
+        "end": {"dateTime": end},
+    }
+
+
+def test_get_all_calendar_events_skips_failed_calendars():
+    service = FakeService(
+        {
+            "a": [
+                event_json(
+                    "A", "2022-12-05T15:00:00+0000", "2022-12-05T16:00:00+0000"
+                )
+            ],
+            "b": IOError("connection reset"),
+            "c": [
+                event_json(
+                    "C", "2022-12-05T17:00:00+0000", "2022-12-05T18:00:00+0000"
+                )
+            ],
+        }
+    )
+    results = get_all_calendar_events(["a", "b", "c"], service, 10, False)
+    assert results["b"] is None
+    assert [e.summary for e in flatten(results)] == ["A", "C"]
+
+
+def test_batched_events_demultiplexed_per_calendar():
+    calendars = {
+        str(i): [
+            event_json(
+                f"Event {i}",
+                "2022-12-05T15:00:00+0000",
+                "2022-12-05T16:00:00+0000",
+            )
+        ]
+        for i in range(5)
+    }
+    calendars["2"] = HttpError(httplib2.Response({"status": 404}), b"")
+    service = FakeService(calendars)
+
+    results = get_batched_calendar_events(
+        list(calendars), service, 10, False, batch_size=2
+    )
+
+    assert sorted(service.batches) == [1, 2, 2]
+    assert results["2"] is None
+    assert [e.summary for e in results["4"]] == ["Event 4"]
+    assert len([r for r in results.values() if r]) == 4
+
+
+def rfc3339_time(timestamp):
+    return dt.datetime.fromtimestamp(timestamp, dt.timezone.utc).strftime(
+        "%Y-%m-%dT%H:%M:%S+0000"
+    )
+
+
+class FakeWindowEvents:
+    # Answers like the API: events ending after timeMin and starting before
+    # timeMax
+    def __init__(self, events):
+        self.events = events
+        self.windows = []
+
+    def list(self, calendarId, timeMin, timeMax, **kwargs):
+        def parse(value):
+            return dt.datetime.fromisoformat(value[:-1] + "+00:00").timestamp()
+
+        time_min, time_max = parse(timeMin), parse(timeMax)
+        self.windows.append((time_min, time_max))
+        return FakeRequest(
+            [
+                event_json(summary, rfc3339_time(start), rfc3339_time(end))
+                for summary, start, end in self.events[calendarId]
+                if end > time_min and start < time_max
+            ]
+        )
+
+
+def test_windowed_events_widen_until_enough():
+    now = int(time.time())
+    hour = 3600
+    events = FakeWindowEvents(
+        {
+            "a": [
+                ("Ongoing", now - hour, now + 60 * hour),
+                ("Soon", now + hour, now + 2 * hour),
+                ("Tomorrow", now + 30 * hour, now + 31 * hour),
+                ("Next week", now + 100 * hour, now + 101 * hour),
+                ("Next month", now + 700 * hour, now + 701 * hour),
+            ]
+        }
+    )
+    service = FakeSyncService(events)
+
+    results, window_end = get_windowed_calendar_events(
+        ["a"], service, False, 48, 3
+    )
+    assert [e.summary for e in results["a"]] == ["Ongoing", "Soon", "Tomorrow"]
+    assert len(events.windows) == 1
+
+    events.windows.clear()
+    results, window_end = get_windowed_calendar_events(
+        ["a"], service, False, 48, 4
+    )
+    # The ongoing event overlaps both parts of the window, but shows up once
+    assert [e.summary for e in results["a"]] == [
+        "Ongoing",
+        "Soon",
+        "Tomorrow",
+        "Next week",
+    ]
+    assert window_end == pytest.approx(now + 192 * hour, abs=5)
+    assert events.windows[1][0] == pytest.approx(events.windows[0][1], abs=1)
+
+
+class FakeRecurringEvents(FakeEvents):
+    def __init__(self, calendars):
+        super().__init__(calendars)
+        self.queries = []
+
+    def list(self, calendarId, **kwargs):
+        self.queries.append(kwargs)
+        return super().list(calendarId)
+
+
+def test_recurring_events_expanded_locally(monkeypatch):
+    # Yesterday, at the start of the next hour
+    yesterday = (int(time.time()) // 3600 + 1) * 3600 - 86400
+    daily = event_json(
+        "Standup", rfc3339_time(yesterday), rfc3339_time(yesterday + 900)
+    )
+    daily.update(id="standup", recurrence=["RRULE:FREQ=DAILY"])
+    events = FakeRecurringEvents({"a": [daily]})
+    service = FakeSyncService(events)
+    monkeypatch.setattr(api, "open_session", lambda *args: (None, service))
+
+    results, window_end = api.get_events_by_calendar(
+        Query("credentials", ["a"], 3, expand_recurring=14)
+    )
+
+    query = events.queries[0]
+    assert query["singleEvents"] is False and "orderBy" not in query
+    assert query["fields"] == api.RECURRING_FIELDS
+    # The nearest --maxres occurrences
+    assert [e.start_time for e in results["a"]] == [
+        yesterday + 86400,
+        yesterday + 2 * 86400,
+        yesterday + 3 * 86400,
+    ]
+    assert window_end == pytest.approx(time.time() + 14 * 86400, abs=5)
+
+
+class FakePagedEvents:
+    # Pages of max_results events, like the API
+    def __init__(self, calendars):
+        self.calendars = calendars
+        self.pages = 0
+
+    def list(self, calendarId, maxResults, pageToken=None, **kwargs):
+        self.pages += 1
+        items = self.calendars[calendarId]
+        start = int(pageToken or 0)
+        page = {"items": items[start:start + maxResults]}
+        if start + maxResults < len(items):
+            page["nextPageToken"] = str(start + maxResults)
+        return FakeRequest(page["items"], page.get("nextPageToken"))
+
+
+def paged_calendars():
+    now = int(time.time())
+    return {
+        calendar_id: [
+            event_json(
+                f"{calendar_id} {i}",
+                rfc3339_time(now + i * 3600),
+                rfc3339_time(now + i * 3600 + 1800),
+            )
+            for i in range(5)
+        ]
+        for calendar_id in ["a", "b"]
+    }
+
+
+@pytest.mark.parametrize("batch_size", [0, 2])
+def test_time_windows_follow_every_page(batch_size):
+    events = FakePagedEvents(paged_calendars())
+    service = FakeService(events.calendars)
+    service.events = lambda: events
+    window = (time.time(), time.time() + 10 * 3600)
+
+    if batch_size:
+        results = get_batched_calendar_events(
+            ["a", "b"], service, 2, False, batch_size, time_window=window
+        )
+    else:
+        results = api.get_all_calendar_events(
+            ["a", "b"], service, 2, False, time_window=window
+        )
+    assert [e.summary for e in results["b"]] == [f"b {i}" for i in range(5)]
+    assert events.pages == 6
+
+    # Without a window only the first max_results are wanted
+    events.pages = 0
+    results = api.get_all_calendar_events(["a", "b"], service, 2, False)
+    assert [e.summary for e in results["b"]] == ["b 0", "b 1"]
+    assert events.pages == 2
+
+
+class FakeSyncEvents:
+    # Serves pages of changes keyed on the sync token that was sent
+    def __init__(self, pages, expired_tokens=()):
+        self.pages = pages
+        self.expired_tokens = expired_tokens
+        self.calls = []
+
+    def list(self, **kwargs):
+        self.calls.append(kwargs)
+        token = kwargs.get("syncToken")
+        if token in self.expired_tokens:
+            return FakeRequest(
+                HttpError(httplib2.Response({"status": 410}), b"Gone")
+            )
+        items, next_token = self.pages[token]
+        request = FakeRequest(items)
+        request.execute = lambda http=None: {
+            "items": items,
+            "nextSyncToken": next_token,
+        }
+        return request
+
+
+class FakeSyncService:
+    def __init__(self, events):
+        self._events = events
+
+    def events(self):
+        return self._events
+
+
+def future_event_json(event_id, summary, status="confirmed"):
+    return dict(
+        event_json(
+            summary, "2999-12-05T15:00:00+0000", "2999-12-05T16:00:00+0000"
+        ),
+        id=event_id,
+        status=status,
+    )
+
+
+def test_sync_calendar_merges_deltas():
+    events = FakeSyncEvents(
+        {
+            None: (
+                [future_event_json("1", "One"), future_event_json("2", "Two")],
+                "token1",
+            ),
+            "token1": (
+                [
+                    future_event_json("1", "One renamed"),
+                    future_event_json("2", "Two", status="cancelled"),
+                    future_event_json("3", "Three"),
+                ],
+                "token2",
+            ),
+        }
+    )
+    service = FakeSyncService(events)
+
+    state = sync_calendar(service, "cal", None, 10)
+    assert state["token"] == "token1"
+    assert sorted(e["summary"] for e in state["events"].values()) == [
+        "One",
+        "Two",
+    ]
+
+    state = sync_calendar(service, "cal", state, 10)
+    assert state["token"] == "token2"
+    assert sorted(e["summary"] for e in state["events"].values()) == [
+        "One renamed",
+        "Three",
+    ]
+    assert events.calls[-1]["syncToken"] == "token1"
+    assert "timeMin" not in events.calls[-1]
+
+
+def test_sync_calendar_full_resync_on_gone():
+    events = FakeSyncEvents(
+        {None: ([future_event_json("1", "Fresh")], "token2")},
+        expired_tokens=("token1",),
+    )
+    stale = {"token": "token1", "events": {"9": None}}
+
+    state = sync_calendar(FakeSyncService(events), "cal", stale, 10)
+    assert state["token"] == "token2"
+    assert [e["summary"] for e in state["events"].values()] == ["Fresh"]
+
+
+def test_sync_keeps_recurring_events_once(monkeypatch):
+    now = int(time.time())
+    daily = dict(
+        future_event_json("standup", "Standup"),
+        start={"dateTime": rfc3339_time(now - 10 * 86400 + 3600)},
+        end={"dateTime": rfc3339_time(now - 10 * 86400 + 4500)},
+        recurrence=["RRULE:FREQ=DAILY"],
+    )
+    moved = {
+        "id": "standup_1",
+        "status": "cancelled",
+        "recurringEventId": "standup",
+        "originalStartTime": {"dateTime": rfc3339_time(now + 86400 + 3600)},
+    }
+    old = dict(
+        future_event_json("old", "Old"),
+        end={"dateTime": rfc3339_time(now - 3600)},
+    )
+    events = FakeSyncEvents(
+        {
+            None: ([daily, moved, old], "token1"),
+            "token1": (
+                [{"id": "standup", "status": "cancelled"}],
+                "token2",
+            ),
+        }
+    )
+    service = FakeSyncService(events)
+    monkeypatch.setattr(api, "open_session", lambda *args: (None, service))
+    state = {}
+    monkeypatch.setattr(cache_utils, "load_sync_state", lambda: state)
+    monkeypatch.setattr(cache_utils, "save_sync_state", state.update)
+
+    results, window_end = api.get_events_by_calendar(
+        Query("credentials", ["cal"], 10, incremental=True)
+    )
+
+    assert events.calls[0]["singleEvents"] is False
+    assert events.calls[0]["maxResults"] == api.WINDOW_PAGE_SIZE
+    # The past event is dropped, the endless one is kept once
+    assert sorted(state["cal"]["events"]) == ["standup", "standup_1"]
+    starts = [e.start_time for e in results["cal"]]
+    assert len(starts) == 30
+    assert now + 86400 + 3600 not in starts
+    assert window_end == pytest.approx(now + 31 * 86400, abs=5)
+
+    # Deleting the recurring event drops its instances too
+    api.get_events_by_calendar(
+        Query("credentials", ["cal"], 10, incremental=True)
+    )
+    assert state["cal"]["events"] == {}
+
+
+def test_sync_state_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache_utils, "SYNC_PATH", str(tmp_path / "sync.json"))
+    state = {
+        "cal": {
+            "token": "token1",
+            "events": {"1": future_event_json("1", "One")},
+        }
+    }
+    cache_utils.save_sync_state(state)
+    assert cache_utils.load_sync_state() == state
+
+    # Events synced by an older version start a full sync
+    old = {"cal": {"token": "token1", "events": {"1": ["One", 0, 1, None]}}}
+    (tmp_path / "sync.json").write_text(json.dumps(old))
+    assert cache_utils.load_sync_state() == {}
+
+
+class FakeCalendarList:
+    # Pages keyed on (sync token, page token)
+    def __init__(self, pages):
+        self.pages = pages
+        self.calls = []
+
+    def list(self, pageToken=None, syncToken=None, fields=None):
+        self.calls.append((syncToken, pageToken))
+        response = self.pages[syncToken, pageToken]
+        request = FakeRequest([])
+        request.execute = lambda http=None: response
+        return request
+
+
+class FakeCalendarService:
+    def __init__(self, calendar_list):
+        self._calendar_list = calendar_list
+
+    def calendarList(self):
+        return self._calendar_list
+
+
+def test_sync_calendar_list_follows_pages():
+    calendar_list = FakeCalendarList(
+        {
+            (None, None): {"items": [{"id": "a"}], "nextPageToken": "p2"},
+            (None, "p2"): {"items": [{"id": "b"}], "nextSyncToken": "s1"},
+            ("s1", None): {
+                "items": [{"id": "a", "deleted": True}, {"id": "c"}],
+                "nextSyncToken": "s2",
+            },
+        }
+    )
+    service = FakeCalendarService(calendar_list)
+
+    state = sync_calendar_list(service, None)
+    assert state == {"sync_token": "s1", "calendars": ["a", "b"]}
+
+    state = sync_calendar_list(service, state)
+    assert state == {"sync_token": "s2", "calendars": ["b", "c"]}
+    assert calendar_list.calls == [(None, None), (None, "p2"), ("s1", None)]
+
+
+def test_get_callendar_ids_uses_cached_list(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        cache_utils, "CALENDAR_LIST_PATH", str(tmp_path / "calendars.json")
+    )
+    calendar_list = FakeCalendarList(
+        {(None, None): {"items": [{"id": "a"}], "nextSyncToken": "s1"}}
+    )
+    service = FakeCalendarService(calendar_list)
+
+    assert get_callendar_ids(["x"], service) == ["x"]
+    assert calendar_list.calls == []
+
+    assert get_callendar_ids([], service) == ["a"]
+    assert get_callendar_ids([], service) == ["a"]
+    assert len(calendar_list.calls) == 1
+
+
+def test_discovery_document_cached_per_client_version(tmp_path, monkeypatch):
+    path = tmp_path / "discovery.json"
+    monkeypatch.setattr(api, "DISCOVERY_PATH", str(path))
+
+    document = api.load_discovery_document()
+    assert json.loads(path.read_text())["version"] == api.client_version
+    assert document["schemas"] == {}
+    assert list(document["resources"]) == ["events", "calendarList"]
+
+    service = api.connect(None)
+    request = service.events().list(calendarId="work", maxResults=3)
+    assert "/calendars/work/events" in request.uri
+    # Responses are still decoded
+    http = HttpMockSequence([({"status": "200"}, '{"items": []}')])
+    assert request.execute(http=http) == {"items": []}
+
+    # Written by another version of the client library
+    path.write_text(json.dumps({"version": "0.0.1", "document": {}}))
+    assert api.load_discovery_document() == document
+
+    # Trimmed differently by an older i3-agenda
+    path.write_text(
+        json.dumps({"version": api.client_version, "document": {}})
+    )
+    assert api.load_discovery_document() == document
+
+
+def test_events_query_asks_for_minimal_gzipped_payload(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        api, "DISCOVERY_PATH", str(tmp_path / "discovery.json")
+    )
+    request = api.list_events_request(api.connect(None), "work", 10)
+    assert f"fields={quote(api.LIST_FIELDS, safe='')}" in request.uri
+    assert "gzip" in request.headers["accept-encoding"]
+    assert "gzip" in request.headers["user-agent"]
+
+
+def test_session_reused_between_refreshes(monkeypatch):
+    monkeypatch.setattr(api, "_sessions", {})
+    monkeypatch.setattr(api, "get_credentials", lambda path: object())
+    connected = []
+    monkeypatch.setattr(
+        api, "connect", lambda creds, timeout: connected.append(creds)
+    )
+
+    assert api.open_session("creds.json", 10) == api.open_session(
+        "creds.json", 10
+    )
+    assert len(connected) == 1
+
+
+class FakeCredentials:
+    pass
+
+
+def test_shared_http_keeps_connections(monkeypatch):
+    monkeypatch.setattr(
+        api, "authorized_http", lambda creds, timeout: object()
+    )
+    creds = FakeCredentials()
+
+    with api.shared_http(creds, 10)() as first:
+        with api.shared_http(creds, 10)() as second:
+            assert first is not second
+    # Next refresh
+    with api.shared_http(creds, 10)() as http:
+        assert http in (first, second)
+
+
+def test_recurring_events_expanded_after_every_page(monkeypatch):
+    tomorrow = (int(time.time()) // 3600 + 1) * 3600 + 86400
+    cancelled = {
+        "id": "standup_1",
+        "status": "cancelled",
+        "recurringEventId": "standup",
+        "originalStartTime": {"dateTime": rfc3339_time(tomorrow)},
+    }
+    single = event_json(
+        "Lunch", rfc3339_time(tomorrow + 7200), rfc3339_time(tomorrow + 9000)
+    )
+    daily = event_json(
+        "Standup",
+        rfc3339_time(tomorrow - 86400),
+        rfc3339_time(tomorrow - 86400 + 900),
+    )
+    daily.update(id="standup", recurrence=["RRULE:FREQ=DAILY;COUNT=3"])
+    # The cancelled occurrence comes pages before its recurring event
+    events = FakePagedEvents({"a": [cancelled, single, daily]})
+    service = FakeSyncService(events)
+    monkeypatch.setattr(api, "open_session", lambda *args: (None, service))
+    monkeypatch.setattr(api, "WINDOW_PAGE_SIZE", 1)
+
+    results, _ = api.get_events_by_calendar(
+        Query("credentials", ["a"], 10, expand_recurring=14)
+    )
+
+    assert events.pages == 3
+    assert [(e.summary, e.start_time) for e in results["a"]] == [
+        ("Standup", tomorrow - 86400),
+        ("Lunch", tomorrow + 7200),
+        ("Standup", tomorrow + 86400),
+    ]
@@ -0,0 +1,120 @@
+import io
+import time
+
+import pytest
+
+from i3_agenda import cache_utils
+from i3_agenda.binary_cache import (
+    BinaryCache,
+    CachedEvents,
+    InvalidCache,
+    dump,
+)
+from i3_agenda.const import BINARY_CACHE
+from i3_agenda.event import Event
+from i3_agenda.event_index import EventIndex
+
+EVENTS = [
+    Event("Later", 3000, 4000, "https://meet.example.com/abc"),
+    Event("הרפתקה חדשה", 1000, 9000, None),
+    Event("Earlier", 2000, 2500, None),
+]
+
+
+def write(tmp_path, events, fetched_at=1234.5):
+    path = tmp_path / "cache.bin"
+    with open(path, "wb") as f:
+        dump(events, fetched_at, f)
+    return path
+
+
+def test_round_trip_sorted_by_start(tmp_path):
+    path = write(tmp_path, EVENTS)
+    with open(path, "rb") as f, BinaryCache(f) as cache:
+        assert len(cache) == 3
+        assert cache.fetched_at == 1234.5
+        assert cache.events() == sorted(EVENTS, key=lambda e: e.start_time)
+
+
+@pytest.mark.parametrize(
+    "now,expected",
+    [
+        (0, ["הרפתקה חדשה", "Earlier", "Later"]),
+        # "Earlier" ended, but the long event before it did not
+        (2600, ["הרפתקה חדשה", "Earlier", "Later"]),
+        (9500, []),
+    ],
+)
+def test_first_not_ended(tmp_path, now, expected):
+    path = write(tmp_path, EVENTS)
+    with open(path, "rb") as f, BinaryCache(f) as cache:
+        events = cache.events(cache.first_not_ended(now))
+    assert [e.summary for e in events] == expected
+
+
+def test_first_not_ended_skips_finished(tmp_path):
+    events = [Event("Old", 100, 200, None), Event("New", 300, 400, None)]
+    path = write(tmp_path, events)
+    with open(path, "rb") as f, BinaryCache(f) as cache:
+        assert cache.first_not_ended(250) == 1
+
+
+@pytest.mark.parametrize(
+    "content",
+    [b"", b"garbage", b"NOPE" + bytes(40)],
+)
+def test_invalid_cache(tmp_path, content):
+    path = tmp_path / "cache.bin"
+    path.write_bytes(content)
+    with open(path, "rb") as f:
+        with pytest.raises(InvalidCache):
+            BinaryCache(f)
+
+
+def test_truncated_cache(tmp_path):
+    buffer = io.BytesIO()
+    dump(EVENTS, 0, buffer)
+    path = tmp_path / "cache.bin"
+    path.write_bytes(buffer.getvalue()[:40])
+    with open(path, "rb") as f:
+        with pytest.raises(InvalidCache):
+            BinaryCache(f)
+
+
+def test_load_binary_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache_utils, "CACHE_DIR", str(tmp_path))
+    now = int(time.time())
+    events = [
+        Event("Done", now - 7200, now - 3600, None),
+        Event("Next", now + 3600, now + 7200, None),
+    ]
+    assert cache_utils.load_cache(30, ["key"], BINARY_CACHE) is None
+
+    cache_utils.save_cache(events, "key", BINARY_CACHE)
+    cached = cache_utils.load_cache(30, ["key"], BINARY_CACHE)
+    assert list(cached) == events[1:]
+    assert cache_utils.load_cache(-1, ["key"], BINARY_CACHE) is None
+
+
+def test_event_index_decodes_only_what_it_looks_at(tmp_path, monkeypatch):
+    now = int(time.time())
+    events = [
+        Event(f"Event {i}", now + i * 3600, now + i * 3600 + 1800, None)
+        for i in range(-5, 20)
+    ]
+    path = write(tmp_path, events)
+    with open(path, "rb") as f:
+        cache = BinaryCache(f)
+    decoded = []
+    event = cache.event
+    monkeypatch.setattr(
+        cache, "event", lambda i: decoded.append(i) or event(i)
+    )
+    cached = CachedEvents(cache, cache.first_not_ended(now))
+
+    index = EventIndex(cached)
+    assert index.start_times is cached.start_times
+    assert index.closest(-1, -1, skip=1, now=now).summary == "Event 1"
+    assert decoded == [5, 6]
+    assert list(cached) == events[5:]
+    cache.close()
@@ -0,0 +1,396 @@
+import argparse
+import contextlib
+import json
+import os
+import time
+
+import pytest
+
+from i3_agenda import cache_utils, main
+from i3_agenda.config import calendar_ttl, get_parser
+from i3_agenda.const import BINARY_CACHE, JSON_CACHE, REFRESH_RETRY_MINUTES
+from i3_agenda.event import Event
+from i3_agenda.timeline import timeline_config
+
+
+def future_events(summary="Next"):
+    now = int(time.time())
+    return [Event(summary, now + 3600, now + 7200, None)]
+
+
+def save_default_cache(events):
+    keys = main.query_cache_keys(get_parser().parse_args([]))
+    cache_utils.save_cache(events, keys[0])
+
+
+def load_default_cache():
+    keys = main.query_cache_keys(get_parser().parse_args([]))
+    return cache_utils.load_cache(None, keys)
+
+
+def test_atomic_write_replaces_whole_file(conf_dir):
+    path = conf_dir / "file.txt"
+    path.write_text("old")
+
+    with pytest.raises(RuntimeError):
+        with cache_utils.atomic_write(str(path)) as f:
+            f.write("half written")
+            raise RuntimeError()
+    assert path.read_text() == "old"
+
+    with cache_utils.atomic_write(str(path)) as f:
+        f.write("new")
+    assert path.read_text() == "new"
+    assert [p.name for p in conf_dir.iterdir()] == ["file.txt"]
+
+
+def test_cache_keyed_by_query(conf_dir):
+    cache_utils.save_cache(future_events("All"), "all")
+    cache_utils.save_cache(future_events("Work"), "work")
+    assert cache_utils.load_cache(30, ["all"])[0].summary == "All"
+    assert cache_utils.load_cache(30, ["work"])[0].summary == "Work"
+    assert cache_utils.load_cache(30, ["other", "work"])[0].summary == "Work"
+    assert cache_utils.load_cache(30, ["other"]) is None
+
+
+def test_today_query_uses_upcoming_events_cache():
+    today, upcoming = cache_utils.cache_keys(["a", "b"], 10, True, False)
+    assert upcoming == cache_utils.cache_keys(["b", "a"], 10, False, False)[0]
+    assert today != upcoming
+    assert cache_utils.cache_keys(["a"], 20, False, False)[0] != upcoming
+
+
+def test_expanded_queries_cached_separately():
+    plain = cache_utils.cache_keys(["a"], 10, True, False)
+    expanded = cache_utils.cache_keys(["a"], 10, True, False, 0, 14)
+    assert plain[0] == cache_utils.cache_keys(["a"], 10, True, False, 0, 0)[0]
+    assert not set(plain) & set(expanded)
+    assert (
+        expanded[1]
+        == cache_utils.cache_keys(["a"], 10, False, False, 0, 14)[0]
+    )
+
+
+def test_cache_evicts_least_recently_used(conf_dir):
+    for i, key in enumerate(["a", "b", "c"]):
+        cache_utils.save_cache(future_events(key), key, max_entries=3)
+        os.utime(cache_utils.cache_path(key), (i, time.time()))
+
+    # Reading "a" makes "b" the least recently used entry
+    assert cache_utils.load_cache(30, ["a"]) is not None
+    cache_utils.save_cache(future_events("d"), "d", max_entries=3)
+
+    assert cache_utils.load_cache(30, ["b"]) is None
+    for key in ["a", "c", "d"]:
+        assert cache_utils.load_cache(30, [key]) is not None
+
+
+@pytest.mark.parametrize("content", ["", "[{\"summary\": ", "null", "[1]"])
+def test_load_cache_invalid_content(conf_dir, content):
+    (conf_dir / "key.json").write_text(content)
+    assert cache_utils.load_cache(30, ["key"]) is None
+
+
+def test_refresh_lock_is_exclusive(conf_dir):
+    with cache_utils.refresh_lock() as locked:
+        assert locked
+        with cache_utils.refresh_lock(blocking=False) as other:
+            assert not other
+    with cache_utils.refresh_lock(blocking=False) as locked:
+        assert locked
+
+
+def test_load_events_serves_stale_cache_while_refreshing(
+    conf_dir, monkeypatch
+):
+    def get_events(*args, **kwargs):
+        raise AssertionError("should not refresh")
+
+    monkeypatch.setattr("i3_agenda.api.get_events_by_calendar", get_events)
+    save_default_cache(future_events("Stale"))
+    args = get_parser().parse_args(["--cachettl", "-1"])
+
+    with cache_utils.refresh_lock():
+        events = main.load_events(args)
+    assert [e.summary for e in events] == ["Stale"]
+
+
+def test_load_events_refreshes_expired_cache(conf_dir, monkeypatch):
+    monkeypatch.setattr(
+        "i3_agenda.api.get_events_by_calendar",
+        lambda *args: ({"primary": future_events("Fresh")}, None),
+    )
+    save_default_cache(future_events("Stale"))
+    args = get_parser().parse_args(["--cachettl", "-1"])
+
+    events = main.load_events(args)
+    assert [e.summary for e in events] == ["Fresh"]
+    assert load_default_cache() == events
+
+
+def test_partial_refresh_is_retried_sooner(conf_dir, monkeypatch):
+    fetched = []
+    results = {"work": future_events("Work"), "home": None}
+    monkeypatch.setattr(
+        "i3_agenda.api.get_events_by_calendar",
+        lambda *args: fetched.append(1) or (dict(results), None),
+    )
+    args = get_parser().parse_args([])
+
+    # Cached without the calendar that failed, until it is retried
+    for _ in range(2):
+        events = main.load_events(args)
+        assert [e.summary for e in events] == ["Work"]
+    assert fetched == [1]
+    with open(cache_utils.cache_path(main.query_cache_keys(args)[0])) as f:
+        window_end = json.load(f)["window_end"]
+    assert window_end <= time.time() + REFRESH_RETRY_MINUTES * 60
+
+    monkeypatch.setattr(main, "REFRESH_RETRY_MINUTES", 0)
+    main.load_events(get_parser().parse_args(["--update"]))
+    results["home"] = future_events("Home")
+    main.load_events(args)
+    assert sorted(e.summary for e in load_default_cache()) == ["Home", "Work"]
+    assert fetched == [1, 1, 1]
+
+
+def test_failed_refresh_is_not_cached(conf_dir, monkeypatch):
+    fetched = []
+    monkeypatch.setattr(
+        "i3_agenda.api.get_events_by_calendar",
+        lambda *args: fetched.append(1) or ({"work": None}, None),
+    )
+    save_default_cache(future_events("Stale"))
+    args = get_parser().parse_args(["--cachettl", "-1"])
+    assert main.load_events(args) == []
+    assert main.load_events(args) == []
+    assert load_default_cache()[0].summary == "Stale"
+    assert fetched == [1, 1]
+
+
+def age_cache(conf_dir, minutes):
+    mtime = time.time() - minutes * 60
+    for path in conf_dir.glob("*.json"):
+        os.utime(path, (mtime, mtime))
+
+
+def test_load_events_stale_while_revalidate(conf_dir, monkeypatch):
+    spawned = []
+    monkeypatch.setattr(main, "spawn_refresh", lambda: spawned.append(True))
+    monkeypatch.setattr(
+        "i3_agenda.api.get_events_by_calendar",
+        lambda *args: ({"primary": future_events("Fresh")}, None),
+    )
+    save_default_cache(future_events("Stale"))
+    age_cache(conf_dir, 45)
+    args = get_parser().parse_args(["--cachettl", "30", "--max-stale", "60"])
+
+    events = main.load_events(args)
+    assert [e.summary for e in events] == ["Stale"]
+    assert spawned == [True]
+
+    # Past the hard expiry the refresh is done right away
+    age_cache(conf_dir, 120)
+    events = main.load_events(args)
+    assert [e.summary for e in events] == ["Fresh"]
+    assert spawned == [True]
+
+
+def test_load_events_backs_off_after_failed_refresh(conf_dir, monkeypatch):
+    spawned = []
+    monkeypatch.setattr(main, "spawn_refresh", lambda: spawned.append(True))
+    monkeypatch.setattr(
+        "i3_agenda.api.get_events_by_calendar",
+        lambda *args: ({"primary": None}, None),
+    )
+    save_default_cache(future_events("Stale"))
+    age_cache(conf_dir, 45)
+    args = get_parser().parse_args(["--cachettl", "30", "--max-stale", "60"])
+
+    main.refresh_cache(args)
+    assert (conf_dir / "refresh_failed").exists()
+    main.load_events(args)
+    assert spawned == []
+
+    failed_at = time.time() - 10 * 60
+    os.utime(conf_dir / "refresh_failed", (failed_at, failed_at))
+    main.load_events(args)
+    assert spawned == [True]
+
+
+def test_load_events_while_locked_respects_max_stale(conf_dir, monkeypatch):
+    @contextlib.contextmanager
+    def refreshing_elsewhere(blocking=True):
+        # Held by another instance until it is waited for
+        yield blocking
+
+    monkeypatch.setattr(cache_utils, "refresh_lock", refreshing_elsewhere)
+    monkeypatch.setattr(
+        "i3_agenda.api.get_events_by_calendar",
+        lambda *args: ({"primary": future_events("Fresh")}, None),
+    )
+    save_default_cache(future_events("Stale"))
+    args = get_parser().parse_args(["--cachettl", "30", "--max-stale", "60"])
+
+    age_cache(conf_dir, 45)
+    assert [e.summary for e in main.load_events(args)] == ["Stale"]
+
+    # Too old to be shown, so it waits for the other instance instead
+    age_cache(conf_dir, 120)
+    assert [e.summary for e in main.load_events(args)] == ["Fresh"]
+
+
+def test_refresh_cache(conf_dir, monkeypatch):
+    monkeypatch.setattr(
+        "i3_agenda.api.get_events_by_calendar",
+        lambda *args: ({"primary": future_events("Fresh")}, None),
+    )
+    save_default_cache(future_events("Stale"))
+    age_cache(conf_dir, 45)
+    args = get_parser().parse_args(["--cachettl", "30", "--refresh-only"])
+
+    with cache_utils.refresh_lock():
+        main.refresh_cache(args)
+    assert load_default_cache()[0].summary == "Stale"
+
+    main.refresh_cache(args)
+    assert load_default_cache()[0].summary == "Fresh"
+
+
+def test_sharded_cache_refreshes_expired_calendars_only(
+    conf_dir, monkeypatch
+):
+    fetched = []
+    answers = {"work": future_events("Work"), "holidays": future_events("Off")}
+
+    def fetch(query):
+        fetched.append(query.calendar_ids)
+        return (
+            {
+                calendar_id: answers[calendar_id]
+                for calendar_id in query.calendar_ids
+            },
+            None,
+        )
+
+    monkeypatch.setattr(main, "fetch_events_by_calendar", fetch)
+    cache_utils.save_calendar_list(
+        {"sync_token": "token", "calendars": list(answers)}
+    )
+    args = get_parser().parse_args(
+        ["--cachettl", "30", "--calendar-ttl", "holidays=1440"]
+    )
+
+    # Nothing cached yet, fetches every known calendar
+    events = main.load_events(args)
+    assert sorted(e.summary for e in events) == ["Off", "Work"]
+    assert fetched == [["work", "holidays"]]
+
+    # Within every TTL
+    main.load_events(args)
+    assert len(fetched) == 1
+
+    # Past the default TTL, but not past the holidays one
+    age_cache(conf_dir / "shards", 45)
+    answers["work"] = future_events("Work updated")
+    events = main.load_events(args)
+    assert sorted(e.summary for e in events) == ["Off", "Work updated"]
+    assert fetched[1:] == [["work"]]
+
+    # A calendar that fails keeps its previous events
+    age_cache(conf_dir / "shards", 45)
+    answers["work"] = None
+    events = main.load_events(args)
+    assert sorted(e.summary for e in events) == ["Off", "Work updated"]
+
+
+@pytest.mark.parametrize("cache_format", [JSON_CACHE, BINARY_CACHE])
+def test_cache_expires_with_its_time_window(conf_dir, cache_format):
+    now = time.time()
+    events = future_events()
+    cache_utils.save_cache(events, "open", cache_format, window_end=now + 60)
+    cache_utils.save_cache(events, "closed", cache_format, window_end=now - 1)
+    assert list(cache_utils.load_cache(None, ["open"], cache_format)) == events
+    assert cache_utils.load_cache(None, ["closed"], cache_format) is None
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [
+        ("work@example.com=60", ("work@example.com", 60)),
+        ("a=b=5", ("a=b", 5)),
+    ],
+)
+def test_calendar_ttl(value, expected):
+    assert calendar_ttl(value) == expected
+
+
+@pytest.mark.parametrize("value", ["work", "=60", "work=soon"])
+def test_calendar_ttl_invalid(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        calendar_ttl(value)
+
+
+def test_render_served_from_timeline(conf_dir, monkeypatch, capsys):
+    monkeypatch.setattr(
+        "i3_agenda.api.get_events_by_calendar",
+        lambda *args: ({"primary": future_events("Fresh")}, None),
+    )
+    args = get_parser().parse_args([])
+    # Refreshing builds the timeline of the flags it was run with
+    main.run(args)
+    assert capsys.readouterr().out.endswith("Fresh\n")
+
+    loaded = []
+    load_events = main.load_events
+    monkeypatch.setattr(
+        main, "load_events", lambda args: loaded.append(1) or load_events(args)
+    )
+    main.run(args)
+    assert capsys.readouterr().out.endswith("Fresh\n")
+    assert loaded == []
+
+    # Other flags get one built from the cache the first time
+    skip = get_parser().parse_args(["--skip", "1"])
+    main.run(skip)
+    main.run(skip)
+    assert capsys.readouterr().out == "No events\nNo events\n"
+    assert loaded == [1]
+
+    # Only valid for the events it was built from
+    save_default_cache(future_events("Next"))
+    age_cache(conf_dir, 1)
+    main.run(args)
+    assert capsys.readouterr().out.endswith("Next\n")
+    assert loaded == [1, 1]
+
+
+def test_timelines_end_with_the_time_window(conf_dir, monkeypatch):
+    window_end = time.time() + 120
+    monkeypatch.setattr(
+        "i3_agenda.api.get_events_by_calendar",
+        lambda *args: ({"primary": future_events("Fresh")}, window_end),
+    )
+    args = get_parser().parse_args(["--expand-recurring", "1"])
+    skip = get_parser().parse_args(["--expand-recurring", "1", "--skip", "1"])
+    # Built when refreshing, and from the cache for other flags
+    main.run(args)
+    main.run(skip)
+
+    key = main.query_cache_keys(args)[0]
+    fetched_at = main.fresh_entry(args)
+    for flags in (args, skip):
+        timeline = cache_utils.load_timeline(
+            key, fetched_at, timeline_config(flags)
+        )
+        assert timeline.end == window_end
+
+
+def test_no_timeline_without_a_known_time_window(conf_dir):
+    # The entry was not written by a refresh, where its window ends is not
+    # known
+    args = get_parser().parse_args([])
+    save_default_cache(future_events("Next"))
+    main.run(args)
+    key = main.query_cache_keys(args)[0]
+    assert not os.path.exists(cache_utils.timeline_path(key))
@@ -0,0 +1,78 @@
+import datetime as dt
+import threading
+
+import pytest
+
+from i3_agenda import config
+from i3_agenda.client import query, socket_path
+from i3_agenda.daemon import AgendaServer
+from i3_agenda.event import Event
+
+
+def event_in(minutes, summary):
+    start = dt.datetime.now() + dt.timedelta(minutes=minutes)
+    end = start + dt.timedelta(hours=1)
+    return Event(summary, int(start.timestamp()), int(end.timestamp()), None)
+
+
+@pytest.fixture
+def server(tmp_path):
+    path = str(tmp_path / "i3agenda.sock")
+    args = config.get_parser().parse_args([])
+    events = [event_in(3, "Standup"), event_in(120, "Review")]
+    server = AgendaServer(path, args, events)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_query_renders_with_client_args(server):
+    output, urgent = query(server.server_address, [])
+    assert output.endswith("Standup")
+    assert urgent
+
+    output, urgent = query(server.server_address, ["--skip", "1"])
+    assert output.endswith("Review")
+    assert not urgent
+
+
+def test_query_serves_refreshed_events(server):
+    server.events = []
+    output, urgent = query(server.server_address, [])
+    assert output == "No events"
+    assert not urgent
+
+
+def test_query_invalid_arguments(server):
+    with pytest.raises(ValueError):
+        query(server.server_address, ["--skip", "not a number"])
+
+
+def test_socket_path(monkeypatch):
+    monkeypatch.delenv("I3_AGENDA_SOCKET", raising=False)
+    assert socket_path(["--conf", "/tmp/agenda"]) == "/tmp/agenda/i3agenda.sock"
+    monkeypatch.setenv("I3_AGENDA_SOCKET", "/run/agenda.sock")
+    assert socket_path(["--conf", "/tmp/agenda"]) == "/run/agenda.sock"
+
+
+def test_refresh_waits_at_least_a_minute(tmp_path):
+    args = config.get_parser().parse_args(["--cachettl", "0"])
+    server = AgendaServer(str(tmp_path / "i3agenda.sock"), args, [])
+    waits = []
+
+    class Stopped:
+        def wait(self, timeout):
+            waits.append(timeout)
+            return True
+
+        def set(self):
+            pass
+
+    server.stopped = Stopped()
+    try:
+        server.refresh_forever()
+    finally:
+        server.server_close()
+    assert waits == [60]
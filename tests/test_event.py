@@ -1,14 +1,23 @@
+import dataclasses
 import datetime as dt
+import json
 import os
+import pickle
+import sys
 import time
 
 import pytest
 from freezegun import freeze_time
 
 from i3_agenda.event import (
+    MIN_CHARS,
     MIN_DELAY,
     Event,
+    EventEncoder,
     from_json,
+    from_row,
+    render_context,
+    shape_summary,
     get_closest,
     get_future_events,
 )
@@ -359,3 +368,91 @@ def test_get_string_description(description, expected):
         next_event_time_left=False,
     )
     assert result == expected
+
+
+def test_event_is_frozen_and_hashable():
+    event = Event("Standup", 1670252400, 1670254200, None)
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        event.summary = "Changed"
+    assert event == Event("Standup", 1670252400, 1670254200, None)
+    assert len({event, Event("Standup", 1670252400, 1670254200, None)}) == 1
+    assert not hasattr(event, "__dict__")
+
+
+def test_event_derived_fields_kept():
+    event = Event("Standup", 1670252400, 1670254200, None)
+    assert event.display(3) == "Sta..."
+    assert event.display(3) is event.display(3)
+    assert event.display(-1) == "Standup"
+    assert event.start_date() == dt.date(2022, 12, 5)
+    # Derived fields are not part of the event's identity
+    assert event == Event("Standup", 1670252400, 1670254200, None)
+
+
+def test_event_rows():
+    event = Event("Standup", 1670252400, 1670254200, "https://meet")
+    assert json.loads(EventEncoder().encode([event])) == [event.row()]
+    assert from_row(event.row()) == event
+    assert from_row(
+        {
+            "summary": "Standup",
+            "start_time": 1670252400,
+            "end_time": 1670254200,
+            "location": "https://meet",
+        }
+    ) == event
+    assert pickle.loads(pickle.dumps(event)) == event
+
+
+def test_render_context_is_one_snapshot():
+    event = new_event("2022-12-15 10:00:00", "2022-12-15 11:00:00", "Retro")
+    with freeze_time("2022-12-14 23:59:59") as frozen:
+        ctx = render_context()
+        frozen.tick(dt.timedelta(seconds=2))
+        # The clock moved past midnight, the snapshot did not
+        assert event.is_tomorrow(ctx)
+        assert not event.is_today(ctx)
+        assert event.get_string(-1, "%Y-%m-%d", ctx=ctx) == (
+            "Tomorrow at 10:00 Retro"
+        )
+        assert event.get_string(-1, "%Y-%m-%d") == "10:00 Retro"
+
+
+def test_render_context_day_boundaries():
+    ctx = render_context(
+        dt.datetime(2022, 12, 14, 12, 0).timestamp()
+    )
+    assert ctx.today == dt.date(2022, 12, 14)
+    assert ctx.tomorrow == dt.date(2022, 12, 15)
+    assert ctx.next_week == dt.date(2022, 12, 21)
+    assert ctx.end_of_today == dt.datetime(2022, 12, 14, 23, 59, 59).timestamp()
+
+
+@pytest.mark.parametrize(
+    "summary",
+    [
+        "Standup",
+        "Café crème",
+        "会议 Meeting",
+        "🎉 Party",
+        "הרפתקה חדשה",
+        "Sync with اجراجوییِ",
+        "Quote \u202eevil",
+    ],
+)
+@pytest.mark.parametrize("limit_char", [MIN_CHARS, 5, 100])
+def test_shape_summary_same_as_bidi(summary, limit_char):
+    from bidi.algorithm import get_display
+
+    trimmed = summary
+    if MIN_CHARS < limit_char < len(summary):
+        trimmed = summary[:limit_char] + "..."
+    assert shape_summary(summary, limit_char) == get_display(trimmed)
+
+
+def test_shape_summary_ltr_skips_bidi(monkeypatch):
+    shape_summary.cache_clear()
+    monkeypatch.setitem(sys.modules, "bidi.algorithm", None)
+    assert shape_summary("Café crème brûlée", 4) == "Café..."
+    with pytest.raises(ImportError):
+        shape_summary("הרפתקה חדשה", 4)
@@ -0,0 +1,89 @@
+import datetime as dt
+import os
+import random
+import time
+
+import pytest
+from freezegun import freeze_time
+
+from i3_agenda.event import (
+    MIN_DELAY,
+    Event,
+    get_closest,
+    get_future_events,
+    sort_events,
+)
+from i3_agenda.event_index import EventIndex
+
+os.environ['TZ'] = 'UTC'
+time.tzset()
+
+NOW = "2022-12-14 12:10:07"
+
+
+def random_events(rng, count):
+    now = int(dt.datetime.strptime(NOW, "%Y-%m-%d %H:%M:%S").timestamp())
+    midnight = now - now % 86400
+    events = []
+    for i in range(count):
+        if rng.random() < 0.2:
+            start = midnight + rng.randrange(-3, 4) * 86400
+            end = start + rng.randrange(1, 3) * 86400
+        else:
+            start = now + rng.randrange(-2 * 86400, 2 * 86400, 60)
+            end = start + rng.randrange(0, 10 * 3600, 60)
+        events.append(Event(f"event {i}", start, end, None))
+    return events
+
+
+@freeze_time(NOW)
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize(
+    "hide_event_after,show_event_before",
+    [(MIN_DELAY, MIN_DELAY), (30, MIN_DELAY), (MIN_DELAY, 90), (0, 0)],
+)
+def test_same_events_as_linear_scan(seed, hide_event_after, show_event_before):
+    events = random_events(random.Random(seed), 50)
+    index = EventIndex(events)
+
+    expected = sort_events(
+        get_future_events(events, hide_event_after, show_event_before)
+    )
+    assert list(index.future(hide_event_after, show_event_before)) == expected
+
+    assert index.closest(hide_event_after, show_event_before) == get_closest(
+        expected
+    )
+    for skip in (1, 3):
+        assert index.closest(
+            hide_event_after, show_event_before, skip
+        ) == get_closest(expected[skip:])
+
+
+@freeze_time(NOW)
+def test_until_excludes_later_events():
+    now = time.time()
+    events = [
+        Event("Before", int(now) + 60, int(now) + 120, None),
+        Event("At", int(now) + 600, int(now) + 700, None),
+    ]
+    index = EventIndex(events)
+    assert [
+        e.summary for e in index.future(MIN_DELAY, MIN_DELAY, until=now + 600)
+    ] == ["Before"]
+
+
+def test_long_event_keeps_later_ones_visible():
+    events = [
+        Event("Long", 100, 10000, None),
+        Event("Short", 200, 300, None),
+        Event("Later", 400, 500, None),
+    ]
+    index = EventIndex(events)
+    assert index.first_not_ended(350) == 0
+    assert [
+        e.summary for e in index.future(MIN_DELAY, MIN_DELAY, now=350)
+    ] == [
+        "Long",
+        "Later",
+    ]
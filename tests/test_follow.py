@@ -0,0 +1,86 @@
+import datetime as dt
+import io
+import json
+import os
+import time
+
+import pytest
+from freezegun import freeze_time
+
+from i3_agenda import config, follow
+
+from conftest import new_event
+
+os.environ['TZ'] = 'UTC'
+time.tzset()
+
+
+class StopFollowing(Exception):
+    pass
+
+
+def run_follow(args, events, monkeypatch, wakeups):
+    monkeypatch.setattr(follow, "load_events", lambda args: events)
+    out = io.StringIO()
+    sleeps = []
+
+    with freeze_time("2022-12-14 12:00:00") as frozen:
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            if len(sleeps) == wakeups:
+                raise StopFollowing()
+            frozen.tick(dt.timedelta(seconds=seconds))
+
+        with pytest.raises(StopFollowing):
+            follow.follow(args, out, sleep)
+    return out.getvalue(), sleeps
+
+
+def test_follow_prints_on_change_only(monkeypatch):
+    events = [new_event("2022-12-14 12:30:00", "2022-12-14 13:00:00", "Sync")]
+    args = config.get_parser().parse_args(["--cachettl", "600"])
+
+    output, sleeps = run_follow(args, events, monkeypatch, wakeups=4)
+
+    # Wakes up when it turns urgent, starts and stops being urgent, but the
+    # text only changes once the event is ongoing
+    assert output.splitlines() == ["12:30 Sync", "Sync (ends 13:00)"]
+    assert sleeps[0] == pytest.approx(25 * 60 + follow.WAKEUP_MARGIN)
+
+
+def test_follow_i3bar_protocol(monkeypatch):
+    events = [new_event("2022-12-14 12:30:00", "2022-12-14 13:00:00", "Sync")]
+    args = config.get_parser().parse_args(["--cachettl", "600", "--i3bar"])
+
+    output, _ = run_follow(args, events, monkeypatch, wakeups=2)
+
+    lines = output.splitlines()
+    assert json.loads(lines[0]) == {"version": 1}
+    assert lines[1] == "["
+    assert json.loads(lines[2])[0]["urgent"] is False
+    assert json.loads(lines[3][1:])[0]["urgent"] is True
+
+
+def test_follow_refreshes_at_most_once_a_minute(monkeypatch):
+    loads = []
+    monkeypatch.setattr(
+        follow, "load_events", lambda args: loads.append(1) or []
+    )
+    args = config.get_parser().parse_args(["--cachettl", "0"])
+
+    with freeze_time("2022-12-14 12:00:00") as frozen:
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            if len(sleeps) == 20:
+                raise StopFollowing()
+            frozen.tick(dt.timedelta(seconds=seconds))
+
+        with pytest.raises(StopFollowing):
+            follow.follow(args, io.StringIO(), sleep)
+
+    # Nothing to show, it only wakes up to refresh
+    assert all(seconds >= 60 for seconds in sleeps)
+    assert len(loads) == len(sleeps)
@@ -1,5 +1,8 @@
 
 import datetime as dt
+import os
+import random
+import time
 
 import pytest
 
@@ -21,3 +24,87 @@ from i3_agenda.helpers import *
 def test_human_delta(test_input:Dict[str,int],expected:str):
     assert human_delta(dt.timedelta(**test_input)) == expected
 
+
+
+def make_tz_backward_compatible(full_time: str) -> str:
+    if full_time[-3] == ":":
+        full_time = full_time[:-3] + full_time[-2:]
+    return full_time
+
+
+def strptime_unix_time(full_time: str) -> float:
+    # The previous implementation of get_unix_time
+    if "T" in full_time:
+        event_time_format = "%Y-%m-%dT%H:%M:%S%z"
+    else:
+        event_time_format = "%Y-%m-%d"
+
+    full_time = make_tz_backward_compatible(full_time)
+
+    return time.mktime(
+        dt.datetime.strptime(full_time, event_time_format)
+        .astimezone()
+        .timetuple()
+    )
+
+
+@pytest.fixture(
+    params=["UTC", "Europe/Paris", "America/New_York", "Asia/Kolkata"]
+)
+def local_tz(request):
+    previous = os.environ.get("TZ")
+    os.environ["TZ"] = request.param
+    time.tzset()
+    yield request.param
+    if previous is None:
+        del os.environ["TZ"]
+    else:
+        os.environ["TZ"] = previous
+    time.tzset()
+
+
+def random_rfc3339(rng: random.Random) -> str:
+    value = dt.datetime(2000, 1, 1) + dt.timedelta(
+        seconds=rng.randrange(60 * 365 * 86400)
+    )
+    if rng.random() < 0.3:
+        return value.strftime("%Y-%m-%d")
+    zone = rng.choice(["Z", "+{}:{}", "-{}:{}", "+{}{}"])
+    zone = zone.format(
+        f"{rng.randrange(15):02d}", rng.choice(["00", "30", "45"])
+    )
+    return value.strftime("%Y-%m-%dT%H:%M:%S") + zone
+
+
+def is_ambiguous(timestamp: float) -> bool:
+    # Local times repeated when clocks go back have two timestamps, mktime
+    # may pick either
+    wall_time = time.localtime(timestamp)[:6]
+    return wall_time in (
+        time.localtime(timestamp - 3600)[:6],
+        time.localtime(timestamp + 3600)[:6],
+    )
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_get_unix_time_matches_strptime(local_tz, seed):
+    rng = random.Random(seed)
+    for _ in range(2000):
+        full_time = random_rfc3339(rng)
+        expected = strptime_unix_time(full_time)
+        if is_ambiguous(expected):
+            continue
+        assert get_unix_time(full_time) == expected, full_time
+
+
+@pytest.mark.parametrize(
+    "full_time",
+    [
+        "2022-12-05 15:00:00+01:00",
+        "2022-12-05T15:00:00",
+        "2022-12-05T15:00:00+1",
+    ],
+)
+def test_get_unix_time_invalid(full_time):
+    with pytest.raises(ValueError):
+        get_unix_time(full_time)
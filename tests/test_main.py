@@ -0,0 +1,57 @@
+import os
+import time
+
+import pytest
+from freezegun import freeze_time
+
+from i3_agenda import main
+from i3_agenda.config import get_parser
+from i3_agenda.main import render, render_list
+
+from conftest import new_event
+
+os.environ['TZ'] = 'UTC'
+time.tzset()
+
+
+EVENTS = [
+    new_event("2022-12-15 09:00:00", "2022-12-15 10:00:00", "Planning"),
+    new_event("2022-12-14 12:00:00", "2022-12-14 13:00:00", "Lunch"),
+    new_event("2022-12-14 15:00:00", "2022-12-14 16:00:00", "Review"),
+    new_event("2022-12-13 15:00:00", "2022-12-13 16:00:00", "Yesterday"),
+]
+
+
+@freeze_time("2022-12-14 12:30:00")
+def test_render_closest():
+    text, closest = render(get_parser().parse_args([]), EVENTS)
+    assert text == "Lunch (ends 13:00)"
+
+    text, closest = render(get_parser().parse_args(["--skip", "2"]), EVENTS)
+    assert closest.summary == "Planning"
+
+    args = get_parser().parse_args(["--skip", "2", "--today"])
+    assert render(args, EVENTS) == ("No events", None)
+
+
+@freeze_time("2022-12-14 12:30:00")
+def test_render_list():
+    lines = render_list(get_parser().parse_args([]), EVENTS)
+    assert [line for line, _ in lines] == [
+        "Lunch (ends 13:00)",
+        "15:00 Review",
+        "Tomorrow at 09:00 Planning",
+    ]
+
+    args = get_parser().parse_args(["--today", "--skip", "1"])
+    assert [line for line, _ in render_list(args, EVENTS)] == ["15:00 Review"]
+
+
+@freeze_time("2022-12-14 17:00:00")
+@pytest.mark.parametrize(
+    "argv,output", [([], "No events\n"), (["--list"], "")]
+)
+def test_run_without_events(conf_dir, monkeypatch, capsys, argv, output):
+    monkeypatch.setattr(main, "load_events", lambda args: EVENTS)
+    main.run(get_parser().parse_args(["--today"] + argv))
+    assert capsys.readouterr().out == output
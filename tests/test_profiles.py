@@ -0,0 +1,180 @@
+import json
+import os
+import time
+
+import pytest
+
+from i3_agenda import cache_utils, main, profiles
+from i3_agenda.config import get_parser
+from i3_agenda.event import Event
+
+PROFILES = """
+[DEFAULT]
+no-event-text = Free
+
+[next]
+output = {tmp}/next.txt
+
+[after]
+skip = 1
+output = {tmp}/after.txt
+
+[soon]
+show-event-before = 30
+"""
+
+
+@pytest.fixture
+def profiles_file(conf_dir):
+    path = conf_dir / "profiles.ini"
+    path.write_text(PROFILES.format(tmp=conf_dir))
+    return path
+
+
+@pytest.fixture
+def fetched(monkeypatch):
+    # Counts the fetches, every one returns the same two events
+    now = int(time.time())
+    calls = []
+
+    def get_events(*args):
+        calls.append(1)
+        events = [
+            Event("First", now + 3600, now + 5400, None),
+            Event("Second", now + 2 * 86400, now + 2 * 86400 + 1800, None),
+        ]
+        return {"primary": events}, None
+
+    monkeypatch.setattr("i3_agenda.api.get_events_by_calendar", get_events)
+    return calls
+
+
+def parse(*argv):
+    return get_parser().parse_args(list(argv))
+
+
+def write_profiles(conf_dir, text):
+    path = conf_dir / "profiles.ini"
+    path.write_text(text)
+    return str(path)
+
+
+def test_load_profiles(profiles_file):
+    args = parse("--limchar", "10", "--profiles", str(profiles_file))
+    loaded = profiles.load_profiles(args.profiles, args)
+
+    assert [p.name for p in loaded] == ["next", "after", "soon"]
+    assert [p.output for p in loaded] == [
+        f"{profiles_file.parent}/next.txt",
+        f"{profiles_file.parent}/after.txt",
+        None,
+    ]
+    # DEFAULT is shared, the command line is the base of every profile
+    assert all(p.args.no_event_text == "Free" for p in loaded)
+    assert all(p.args.limchar == 10 for p in loaded)
+    assert [p.args.skip for p in loaded] == [0, 1, 0]
+    assert [p.args.show_event_before for p in loaded] == [-1, -1, 30]
+    assert args.skip == 0 and args.show_event_before == -1
+
+
+def test_profile_turns_boolean_off(conf_dir):
+    path = write_profiles(conf_dir, "[all]\ntoday = no\n")
+    args = parse("--today")
+    assert not profiles.load_profiles(path, args)[0].args.today
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "[broken]\nmaxres = 5\n",
+        "[broken]\ntoday = maybe\n",
+        "[broken]\nskip = many\n",
+        "no section\n",
+        "",
+    ],
+)
+def test_invalid_profiles(conf_dir, text):
+    path = write_profiles(conf_dir, text)
+    with pytest.raises(SystemExit):
+        profiles.load_profiles(path, parse())
+
+
+def test_missing_profiles_file(conf_dir):
+    with pytest.raises(SystemExit):
+        profiles.load_profiles(str(conf_dir / "missing.ini"), parse())
+
+
+def test_render_profiles(profiles_file, fetched, capsys):
+    main.run(parse("--profiles", str(profiles_file)))
+
+    assert (profiles_file.parent / "next.txt").read_text().endswith("First\n")
+    assert (
+        (profiles_file.parent / "after.txt").read_text().endswith("Second\n")
+    )
+    assert capsys.readouterr().out == "Free\n"
+    assert fetched == [1]
+
+
+def test_profiles_share_one_cache_read(profiles_file, fetched, monkeypatch):
+    args = parse("--profiles", str(profiles_file))
+    main.run(args)
+
+    loaded = []
+    load_events = main.load_events
+    monkeypatch.setattr(
+        profiles,
+        "load_events",
+        lambda args: loaded.append(1) or load_events(args),
+    )
+    # No timelines yet, all the profiles are rendered from one load
+    path = cache_utils.timeline_path(main.query_cache_keys(args)[0])
+    with open(path) as f:
+        raw = json.load(f)
+    with open(path, "w") as f:
+        json.dump(dict(raw, timelines={}), f)
+    main.run(args)
+    assert loaded == [1]
+
+    # Then every profile has its timeline
+    main.run(args)
+    assert loaded == [1]
+    assert fetched == [1]
+
+
+def test_profiles_i3bar(profiles_file, fetched, capsys):
+    main.run(parse("--i3bar", "--profiles", str(profiles_file)))
+
+    blocks = json.loads(capsys.readouterr().out)
+    assert [block["name"] for block in blocks] == ["next", "after", "soon"]
+    assert blocks[0]["full_text"].endswith("First")
+    assert blocks[1]["full_text"].endswith("Second")
+    assert blocks[2]["full_text"] == "Free"
+    assert not any(block["urgent"] for block in blocks)
+    # All of them go to stdout
+    assert not (profiles_file.parent / "next.txt").exists()
+
+
+def test_write_output_fifo(tmp_path):
+    path = str(tmp_path / "block")
+    os.mkfifo(path)
+
+    # Nobody reading, nothing written and nothing blocking
+    profiles.write_output(path, "lost")
+
+    reader = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        profiles.write_output(path, "Meeting")
+        assert os.read(reader, 100) == b"Meeting\n"
+    finally:
+        os.close(reader)
+
+
+def test_unwritable_output_is_reported(conf_dir, fetched, capsys):
+    path = write_profiles(
+        conf_dir, f"[gone]\noutput = {conf_dir}/missing/gone.txt\n[ok]\n"
+    )
+    main.run(parse("--profiles", path))
+
+    captured = capsys.readouterr()
+    assert "gone" in captured.err
+    assert captured.out.endswith("First\n")
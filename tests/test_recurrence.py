@@ -0,0 +1,158 @@
+import datetime as dt
+import os
+import time
+
+from i3_agenda.api import parse_events
+from i3_agenda.recurrence import expand
+
+os.environ['TZ'] = 'UTC'
+time.tzset()
+
+
+def timestamp(value: str) -> float:
+    return dt.datetime.fromisoformat(value).timestamp()
+
+
+def weekly(**kwargs):
+    # Mondays at 9:00 in Berlin, from the 25th of March 2024
+    event = {
+        "id": "standup",
+        "summary": "Standup",
+        "start": {
+            "dateTime": "2024-03-25T09:00:00+01:00",
+            "timeZone": "Europe/Berlin",
+        },
+        "end": {
+            "dateTime": "2024-03-25T09:15:00+01:00",
+            "timeZone": "Europe/Berlin",
+        },
+        "recurrence": ["RRULE:FREQ=WEEKLY;BYDAY=MO"],
+    }
+    event.update(kwargs)
+    return event
+
+
+def instance(original: str, **kwargs):
+    event = {
+        "id": f"standup_{original}",
+        "recurringEventId": "standup",
+        "originalStartTime": {
+            "dateTime": original,
+            "timeZone": "Europe/Berlin",
+        },
+    }
+    event.update(kwargs)
+    return event
+
+
+def starts(items):
+    return [item["start"]["dateTime"] for item in items]
+
+
+def test_occurrences_keep_wall_clock_time_across_dst():
+    items = expand(
+        [weekly()],
+        timestamp("2024-03-20T00:00"),
+        timestamp("2024-04-10T00:00"),
+    )
+    assert starts(items) == [
+        "2024-03-25T09:00:00+01:00",
+        "2024-04-01T09:00:00+02:00",
+        "2024-04-08T09:00:00+02:00",
+    ]
+    assert items[1]["end"]["dateTime"] == "2024-04-01T09:15:00+02:00"
+    assert all(item["summary"] == "Standup" for item in items)
+
+
+def test_ongoing_occurrence_is_kept():
+    items = expand(
+        [weekly()],
+        timestamp("2024-04-01T07:10"),
+        timestamp("2024-04-02T00:00"),
+    )
+    assert starts(items) == ["2024-04-01T09:00:00+02:00"]
+
+
+def test_exceptions_replace_occurrences():
+    moved = instance(
+        "2024-04-01T09:00:00+02:00",
+        summary="Standup (moved)",
+        start={"dateTime": "2024-04-02T10:00:00+02:00"},
+        end={"dateTime": "2024-04-02T10:15:00+02:00"},
+    )
+    cancelled = instance("2024-04-08T09:00:00+02:00", status="cancelled")
+    single = {
+        "id": "lunch",
+        "summary": "Lunch",
+        "start": {"dateTime": "2024-04-03T12:00:00+02:00"},
+        "end": {"dateTime": "2024-04-03T13:00:00+02:00"},
+    }
+    events = parse_events(
+        [weekly(), moved, cancelled, single],
+        (timestamp("2024-03-28T00:00"), timestamp("2024-04-20T00:00")),
+        True,
+    )
+    assert sorted((e.start_time, e.summary) for e in events) == [
+        (timestamp("2024-04-02T08:00"), "Standup (moved)"),
+        (timestamp("2024-04-03T10:00"), "Lunch"),
+        (timestamp("2024-04-15T07:00"), "Standup"),
+    ]
+
+
+def test_exception_moved_into_window():
+    moved = instance(
+        "2024-03-25T09:00:00+01:00",
+        summary="Standup (moved)",
+        start={"dateTime": "2024-04-02T10:00:00+02:00"},
+        end={"dateTime": "2024-04-02T10:15:00+02:00"},
+    )
+    items = expand(
+        [weekly(), moved],
+        timestamp("2024-04-02T00:00"),
+        timestamp("2024-04-03T00:00"),
+    )
+    assert [item["summary"] for item in items] == ["Standup (moved)"]
+
+
+def test_exdate_and_until():
+    event = weekly(
+        recurrence=[
+            "RRULE:FREQ=WEEKLY;BYDAY=MO;UNTIL=20240416",
+            "EXDATE;TZID=Europe/Berlin:20240401T090000",
+        ]
+    )
+    items = expand(
+        [event], timestamp("2024-03-20T00:00"), timestamp("2024-05-01T00:00")
+    )
+    assert starts(items) == [
+        "2024-03-25T09:00:00+01:00",
+        "2024-04-08T09:00:00+02:00",
+        "2024-04-15T09:00:00+02:00",
+    ]
+
+
+def test_all_day_occurrences():
+    event = {
+        "id": "gym",
+        "summary": "Gym",
+        "start": {"date": "2024-03-25"},
+        "end": {"date": "2024-03-26"},
+        "recurrence": ["RRULE:FREQ=DAILY;INTERVAL=2;UNTIL=20240330T000000Z"],
+    }
+    items = expand(
+        [event], timestamp("2024-03-26T12:00"), timestamp("2024-04-10T00:00")
+    )
+    assert [item["start"] for item in items] == [
+        {"date": "2024-03-27"},
+        {"date": "2024-03-29"},
+    ]
+    assert items[0]["end"] == {"date": "2024-03-28"}
+
+
+def test_invalid_rule_keeps_the_event(capsys):
+    event = weekly(recurrence=["RRULE:FREQ=SOMETIMES"])
+    items = expand(
+        [event], timestamp("2024-03-20T00:00"), timestamp("2024-04-10T00:00")
+    )
+    assert starts(items) == ["2024-03-25T09:00:00+01:00"]
+    assert "standup" in capsys.readouterr().err
@@ -0,0 +1,91 @@
+import json
+import subprocess
+import sys
+import time
+from typing import List, Tuple
+
+from i3_agenda.cache_utils import cache_keys
+
+# Import time allowed for a render served from the cache, measured with
+# python -X importtime. Generous so that slow CI machines don't flake, the
+# point is to catch a heavy dependency sneaking back into the fast path.
+IMPORT_TIME_BUDGET_MS = 100
+DEFAULT_MAXRES = 10
+
+# Only needed to talk to Google's API, and to shape right-to-left summaries
+HEAVY_MODULES = [
+    "google",
+    "googleapiclient",
+    "google_auth_oauthlib",
+    "httplib2",
+    "bidi",
+]
+if sys.version_info >= (3, 8):
+    HEAVY_MODULES.append("typing_extensions")
+
+
+def parse_importtime(stderr: str) -> List[Tuple[str, int, int]]:
+    # Lines look like "import time:  self [us] | cumulative | package", with
+    # the package name indented by its nesting depth
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), int(cumulative), depth))
+    return imports
+
+
+def run_with_warm_cache(tmp_path) -> List[Tuple[str, int, int]]:
+    start = int(time.time()) + 3600
+    event = {
+        "summary": "Warm",
+        "start_time": start,
+        "end_time": start + 3600,
+        "location": None,
+    }
+    key = cache_keys([], DEFAULT_MAXRES, False, False)[0]
+    (tmp_path / "cache").mkdir()
+    (tmp_path / "cache" / f"{key}.json").write_text(json.dumps([event]))
+
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-m",
+            "i3_agenda.main",
+            "--conf",
+            str(tmp_path),
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip().endswith("Warm")
+    return parse_importtime(result.stderr)
+
+
+def test_warm_cache_skips_heavy_imports(tmp_path):
+    imported = {name for name, _, _ in run_with_warm_cache(tmp_path)}
+    for module in HEAVY_MODULES:
+        assert not any(
+            name == module or name.startswith(module + ".")
+            for name in imported
+        ), f"{module} imported on a cache hit"
+
+
+def test_warm_cache_import_budget(tmp_path):
+    imports = run_with_warm_cache(tmp_path)
+    # Everything imported from the moment the package starts loading
+    first = next(
+        i for i, (name, _, _) in enumerate(imports) if name == "i3_agenda"
+    )
+    total_us = sum(
+        cumulative for _, cumulative, depth in imports[first:] if depth == 0
+    )
+    assert total_us / 1000 < IMPORT_TIME_BUDGET_MS
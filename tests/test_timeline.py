@@ -0,0 +1,167 @@
+import datetime as dt
+import json
+import os
+import random
+import time
+
+import pytest
+
+from i3_agenda import cache_utils
+from i3_agenda.config import get_parser
+from i3_agenda.event import Event, render_context
+from i3_agenda.event_index import EventIndex
+from i3_agenda.main import render
+from i3_agenda.timeline import Timeline, change_instants, timeline_config
+
+from conftest import new_event, timestamp
+
+os.environ['TZ'] = 'UTC'
+time.tzset()
+
+START = dt.datetime(2022, 12, 14, 12, 10, 7).timestamp()
+
+
+def random_events(rng, count):
+    midnight = int(START) - int(START) % 86400
+    events = []
+    for i in range(count):
+        if rng.random() < 0.1:
+            start = midnight + rng.randrange(-1, 3) * 86400
+            end = start + 86400
+        else:
+            start = int(START) + rng.randrange(-3 * 3600, 2 * 86400, 60)
+            end = start + rng.randrange(0, 3 * 3600, 60)
+        location = f"https://meet.example.com/{i}" if i % 3 == 0 else None
+        events.append(Event(f"event {i}", start, end, location))
+    return events
+
+
+@pytest.mark.parametrize("seed", range(10))
+@pytest.mark.parametrize(
+    "argv",
+    [
+        [],
+        ["--skip", "1"],
+        ["--today"],
+        ["--hide-event-after", "20", "--show-event-before", "90"],
+        ["--ongoing-time-left", "--next-event-time-left"],
+    ],
+)
+def test_same_as_render(seed, argv):
+    rng = random.Random(seed)
+    args = get_parser().parse_args(argv)
+    index = EventIndex(random_events(rng, 15))
+    end = START + 2 * 86400
+    timeline = Timeline.build(args, index, START, end)
+
+    # Random times, and right at and around every instant something changes
+    instants = [i for i in change_instants(args, index, START, end)]
+    times = [START + rng.random() * (end - START) for _ in range(200)]
+    times += [
+        t + delta
+        for t in instants
+        for delta in (-0.5, 0, 0.5)
+        if START <= t + delta < end
+    ]
+    for now in times:
+        assert timeline.covers(now)
+        ctx = render_context(now)
+        text, closest = render(args, index, ctx)
+        segment = timeline.at(now)
+        if closest is None:
+            assert segment is None, now
+        else:
+            assert segment.render(now) == text, now
+            assert segment.urgent == closest.is_urgent(ctx), now
+            assert segment.location == closest.location, now
+
+
+def test_next_change_event_boundaries():
+    args = get_parser().parse_args([])
+    events = [new_event("2022-12-14 13:00:00", "2022-12-14 14:00:00")]
+    start = timestamp("2022-12-14 12:00:00")
+    timeline = Timeline.build(args, EventIndex(events), start, start + 86400)
+    # Becomes urgent 5 minutes before it starts
+    assert timeline.next_change(start) == timestamp("2022-12-14 12:55:00")
+
+    args = get_parser().parse_args(["--show-event-before", "10"])
+    timeline = Timeline.build(args, EventIndex(events), start, start + 86400)
+    assert timeline.at(timestamp("2022-12-14 12:40:00")) is None
+    assert timeline.next_change(timestamp("2022-12-14 12:40:00")) == (
+        timestamp("2022-12-14 12:50:00")
+    )
+
+
+def test_next_change_midnight_and_countdown():
+    args = get_parser().parse_args([])
+    events = [new_event("2022-12-15 09:00:00", "2022-12-15 10:00:00")]
+    start = timestamp("2022-12-14 12:00:00")
+    timeline = Timeline.build(args, EventIndex(events), start, start + 86400)
+    # "Tomorrow at" becomes today's time
+    assert timeline.next_change(start) == timestamp("2022-12-15 00:00:00")
+
+    args = get_parser().parse_args(["--next-event-time-left"])
+    timeline = Timeline.build(args, EventIndex(events), start, start + 86400)
+    after_midnight = timestamp("2022-12-15 00:00:00") + 0.5
+    assert timeline.next_change(after_midnight) == int(after_midnight) + 1
+
+    assert (
+        Timeline.build(args, EventIndex([]), start, start + 60).at(start)
+        is None
+    )
+
+
+def test_only_changes_are_kept():
+    args = get_parser().parse_args([])
+    events = [new_event("2022-12-14 13:00:00", "2022-12-14 14:00:00", "Sync")]
+    start = timestamp("2022-12-14 12:00:00")
+    timeline = Timeline.build(args, EventIndex(events), start, start + 86400)
+    assert [(s.render(0), s.urgent) for s in timeline.segments if s] == [
+        ("13:00 Sync", False),
+        ("13:00 Sync", True),
+        ("Sync (ends 14:00)", True),
+        ("Sync (ends 14:00)", False),
+    ]
+    assert timeline.segments[-1] is None
+
+
+def test_rows_round_trip():
+    args = get_parser().parse_args(["--ongoing-time-left"])
+    index = EventIndex(random_events(random.Random(0), 10))
+    timeline = Timeline.build(args, index, START, START + 86400)
+    loaded = Timeline.from_rows(json.loads(json.dumps(timeline.rows())))
+    assert loaded.starts == timeline.starts
+    assert loaded.segments == timeline.segments
+    assert loaded.end == timeline.end
+
+
+def test_cached_per_entry_and_flags(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache_utils, "CACHE_DIR", str(tmp_path))
+    index = EventIndex(random_events(random.Random(0), 10))
+    today = get_parser().parse_args(["--today"])
+    skip = get_parser().parse_args(["--skip", "1"])
+    for args in (today, skip):
+        cache_utils.save_timeline(
+            "key",
+            1000.5,
+            timeline_config(args),
+            Timeline.build(args, index, START, START + 3600),
+        )
+
+    for args in (today, skip):
+        timeline = cache_utils.load_timeline(
+            "key", 1000.5, timeline_config(args)
+        )
+        assert timeline.at(START + 60) == Timeline.build(
+            args, index, START, START + 3600
+        ).at(START + 60)
+    # Built from the events of another fetch
+    assert (
+        cache_utils.load_timeline("key", 2000, timeline_config(skip)) is None
+    )
+    assert (
+        cache_utils.load_timeline(
+            "key", 1000.5, timeline_config(get_parser().parse_args([]))
+        )
+        is None
+    )
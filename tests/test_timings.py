@@ -0,0 +1,97 @@
+import json
+import pstats
+
+import pytest
+
+from i3_agenda import config, timings
+from i3_agenda.api import CountingHttp, authorized_http, fetch_calendars
+from i3_agenda.config import get_parser
+
+
+@pytest.fixture
+def timings_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "CONF_DIR", str(tmp_path))
+    monkeypatch.delenv(timings.PROFILE_ENV, raising=False)
+    return tmp_path
+
+
+def read_log(timings_dir):
+    path = timings_dir / timings.TIMINGS_FILE
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test_nothing_recorded_by_default(timings_dir):
+    args = get_parser().parse_args([])
+    assert timings.requested(args) is None
+    with timings.record(None):
+        with timings.phase("render"):
+            pass
+        assert timings.timed(len) is len
+    assert not (timings_dir / timings.TIMINGS_FILE).exists()
+
+
+@pytest.mark.parametrize(
+    "argv,env,expected",
+    [
+        (["--timings"], None, "timings"),
+        (["--profile"], None, timings.CPROFILE),
+        ([], "1", "timings"),
+        ([], "0", None),
+        ([], timings.CPROFILE, timings.CPROFILE),
+    ],
+)
+def test_requested(timings_dir, monkeypatch, argv, env, expected):
+    if env is not None:
+        monkeypatch.setenv(timings.PROFILE_ENV, env)
+    assert timings.requested(get_parser().parse_args(argv)) == expected
+
+
+def test_phases_and_requests_written_as_json_lines(timings_dir):
+    def fetch(calendar_id):
+        timings.count_bytes(100)
+        timings.count_bytes(20)
+        if calendar_id == "broken":
+            raise ValueError("nope")
+        return calendar_id
+
+    with timings.record("timings"):
+        with timings.phase("fetch"):
+            fetch_calendars(["work", "broken"], fetch, concurrency=2)
+
+    [line] = read_log(timings_dir)
+    assert [p["phase"] for p in line["phases"]] == ["startup", "fetch"]
+    assert line["phases"][1]["wall_ms"] >= 0
+    requests = sorted(line["requests"], key=lambda r: r["calendar"])
+    assert [(r["calendar"], r["bytes"], r["ok"]) for r in requests] == [
+        ("broken", 120, False),
+        ("work", 120, True),
+    ]
+    assert not timings.recording()
+
+
+def test_flush_starts_a_new_line(timings_dir):
+    with timings.record("timings"):
+        with timings.phase("load events"):
+            pass
+        timings.flush()
+        with timings.phase("render"):
+            pass
+
+    first, second = read_log(timings_dir)
+    assert [p["phase"] for p in first["phases"]] == ["startup", "load events"]
+    assert [p["phase"] for p in second["phases"]] == ["render"]
+
+
+def test_cprofile_dump(timings_dir):
+    with timings.record(timings.CPROFILE):
+        sorted(range(100))
+
+    stats = pstats.Stats(str(timings_dir / timings.PROFILE_FILE))
+    assert stats.total_calls > 0
+    assert read_log(timings_dir)
+
+
+def test_responses_counted_only_while_recording(timings_dir):
+    assert not isinstance(authorized_http(None).http, CountingHttp)
+    with timings.record("timings"):
+        assert isinstance(authorized_http(None).http, CountingHttp)